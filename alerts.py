@@ -0,0 +1,372 @@
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+from bisect import bisect_right
+from collections import defaultdict, deque
+
+import pairs
+import storage
+from data_processor import LEGACY_RESULT_KEYS, SERIES_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Правила задаются JSON-файлом, например ALERT_RULES=/path/alerts.json:
+# [{"name": "wide", "pair": "BTC/ETH", "metric": "percentage_diff_norm", "above": 0.5, "minutes": 10},
+#  {"name": "z-up", "pair": "BTC/ETH", "metric": "zscore", "crosses": 2, "direction": "up"}]
+DEFAULT_RULES_PATH = storage.get_db_path().parent / 'alerts.json'
+DEFAULT_LOG_PATH = storage.get_db_path().parent / 'alerts.log'
+RECENT_ALERTS = 100  # Срабатываний в памяти для /api/alerts
+EVENTS_KEEP = 1000  # Срабатываний в таблице alert_events для пересылки другим процессам
+EVENTS_POLL_INTERVAL = 0.5  # Секунды между проверками alert_events
+WEBHOOK_TIMEOUT = 5
+CROSS_DIRECTIONS = ('up', 'down', 'any')
+
+_engine_instance = None
+_engine_lock = threading.Lock()
+
+
+class ThresholdRule:
+    """
+    Значение ряда пары выше (above) или ниже (below) порога на всех свечах в
+    течение duration секунд. Срабатывает один раз, пока условие не нарушится.
+    """
+
+    def __init__(self, name, pair, metric, op, threshold, duration=0):
+        self.name = name
+        self.pair = pair
+        self.metric = metric
+        self.op = op
+        self.threshold = threshold
+        self.duration = duration
+        self._since = None  # Время первой свечи текущего выполнения условия
+        self._fired = False
+
+    def update(self, time, value):
+        """Учитывает закрытую свечу; возвращает текст срабатывания или None"""
+        holds = value is not None and (value > self.threshold if self.op == 'above' else value < self.threshold)
+        if not holds:
+            self._since = None
+            self._fired = False
+            return None
+        if self._since is None:
+            self._since = time
+        if self._fired or time - self._since < self.duration:
+            return None
+        self._fired = True
+        side = '>' if self.op == 'above' else '<'
+        return f"{self.pair} {self.metric} {side} {self.threshold} в течение {self.duration // 60} мин"
+
+    def describe(self):
+        return {'name': self.name, 'pair': self.pair, 'metric': self.metric,
+                self.op: self.threshold, 'minutes': self.duration // 60}
+
+
+class CrossRule:
+    """Значение ряда пары пересекает уровень снизу вверх (up), сверху вниз (down) или в любую сторону"""
+
+    def __init__(self, name, pair, metric, level, direction='any'):
+        self.name = name
+        self.pair = pair
+        self.metric = metric
+        self.level = level
+        self.direction = direction
+        self._previous = None
+
+    def update(self, time, value):
+        """Учитывает закрытую свечу; возвращает текст срабатывания или None"""
+        previous, self._previous = self._previous, value
+        if previous is None or value is None:
+            return None
+        if previous <= self.level < value and self.direction in ('up', 'any'):
+            return f"{self.pair} {self.metric} пересёк {self.level} вверх"
+        if previous >= self.level > value and self.direction in ('down', 'any'):
+            return f"{self.pair} {self.metric} пересёк {self.level} вниз"
+        return None
+
+    def describe(self):
+        return {'name': self.name, 'pair': self.pair, 'metric': self.metric,
+                'crosses': self.level, 'direction': self.direction}
+
+
+def parse_rule(spec):
+    """Правило из словаря конфигурации; ValueError при ошибке в описании"""
+    metric = spec.get('metric', 'percentage_diff_norm')
+    if metric not in SERIES_FIELDS:
+        raise ValueError(f"Неизвестный ряд {metric!r}")
+    pair = pairs.parse_pair(spec['pair']).name if 'pair' in spec else pairs.get_pairs()[0].name
+    name = spec.get('name') or f"{pair} {metric}"
+
+    if 'crosses' in spec:
+        direction = spec.get('direction', 'any')
+        if direction not in CROSS_DIRECTIONS:
+            raise ValueError(f"Неизвестное направление {direction!r}")
+        return CrossRule(name, pair, metric, float(spec['crosses']), direction)
+    for op in ('above', 'below'):
+        if op in spec:
+            minutes = float(spec.get('minutes', 0))
+            if minutes < 0:
+                raise ValueError("minutes не может быть отрицательным")
+            return ThresholdRule(name, pair, metric, op, float(spec[op]), int(minutes * 60))
+    raise ValueError(f"Правило {name!r}: нужно одно из above, below, crosses")
+
+
+def load_rules(path=None):
+    """Правила из файла ALERT_RULES (по умолчанию alerts.json рядом с базой); ошибочные пропускаются"""
+    path = path or os.environ.get('ALERT_RULES') or DEFAULT_RULES_PATH
+    try:
+        with open(path, encoding='utf-8') as f:
+            specs = json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось прочитать правила оповещений {path}: {e}")
+        return []
+
+    rules = []
+    for spec in specs:
+        try:
+            rules.append(parse_rule(spec))
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Правило оповещения {spec!r} пропущено: {e}")
+    logger.info(f"Загружено правил оповещений: {len(rules)}")
+    return rules
+
+
+class LogSink:
+    """Срабатывания строками JSON в файл"""
+
+    def __init__(self, path=DEFAULT_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def deliver(self, alert):
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(alert, ensure_ascii=False) + '\n')
+
+
+class WebhookSink:
+    """POST срабатывания в JSON на url; отправка в отдельном потоке, чтобы не задерживать обновление"""
+
+    def __init__(self, url, timeout=WEBHOOK_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def deliver(self, alert):
+        threading.Thread(target=self._post, args=(alert,), daemon=True).start()
+
+    def _post(self, alert):
+        request = urllib.request.Request(
+            self.url, data=json.dumps(alert).encode(), headers={'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except Exception as e:
+            logger.warning(f"Оповещение не доставлено на {self.url}: {e}")
+
+
+class BroadcastSink:
+    """Событие alert подписчикам /api/stream"""
+
+    def __init__(self, broadcaster, event='alert'):
+        self.broadcaster = broadcaster
+        self.event = event
+
+    def deliver(self, alert):
+        self.broadcaster.publish(self.event, json.dumps(alert).encode())
+
+
+class MemorySink:
+    """Последние срабатывания в памяти (для /api/alerts)"""
+
+    def __init__(self, maxlen=RECENT_ALERTS):
+        self._alerts = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def deliver(self, alert):
+        with self._lock:
+            self._alerts.append(alert)
+
+    def recent(self):
+        with self._lock:
+            return list(self._alerts)
+
+
+class DatabaseSink:
+    """
+    Срабатывания в таблицу alert_events: правила проверяет один процесс, а серверы
+    в других процессах пересылают срабатывания своим подписчикам (watch_events)
+    """
+
+    def __init__(self, keep=EVENTS_KEEP):
+        self.keep = keep
+
+    def deliver(self, alert):
+        with storage.connection() as conn, conn:
+            ensure_events_table(conn)
+            cursor = conn.execute(
+                "INSERT INTO alert_events (created_at, payload) VALUES (?, ?)",
+                (int(time.time() * 1000), json.dumps(alert, ensure_ascii=False))
+            )
+            conn.execute("DELETE FROM alert_events WHERE id <= ?", (cursor.lastrowid - self.keep,))
+
+
+def ensure_events_table(conn):
+    """Журнал срабатываний для других процессов: id растёт с каждым срабатыванием"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS alert_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at INTEGER,
+            payload TEXT
+        )
+    ''')
+
+
+def read_events(conn, after_id=None, limit=None):
+    """
+    Срабатывания из alert_events по возрастанию id: [(id, срабатывание)].
+    after_id=None - последние limit записей (все, если limit не задан).
+    """
+    ensure_events_table(conn)
+    limit = -1 if limit is None else limit
+    if after_id is None:
+        rows = conn.execute("SELECT id, payload FROM alert_events ORDER BY id DESC LIMIT ?", (limit,)).fetchall()[::-1]
+    else:
+        rows = conn.execute(
+            "SELECT id, payload FROM alert_events WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)
+        ).fetchall()
+    return [(event_id, json.loads(payload)) for event_id, payload in rows]
+
+
+def watch_events(sinks, history=None, interval=EVENTS_POLL_INTERVAL):
+    """
+    Фоновый поток, пересылающий приёмникам sinks новые срабатывания из alert_events.
+    history (MemorySink для /api/alerts) при запуске получает последние RECENT_ALERTS
+    срабатываний, чтобы история не начиналась с перезапуска сервера.
+    """
+    with storage.connection() as conn:
+        events = read_events(conn, limit=RECENT_ALERTS)
+    if history is not None:
+        for _, alert in events:
+            history.deliver(alert)
+
+    def watcher(last):
+        while True:
+            time.sleep(interval)
+            try:
+                with storage.connection() as conn:
+                    events = read_events(conn, last)
+            except sqlite3.Error as e:
+                logger.warning(f"Не удалось прочитать срабатывания оповещений: {e}")
+                continue
+            for event_id, alert in events:
+                last = event_id
+                deliver(sinks, alert)
+
+    thread = threading.Thread(target=watcher, args=(events[-1][0] if events else 0,), daemon=True)
+    thread.start()
+    return thread
+
+
+def deliver(sinks, alert):
+    """Передаёт срабатывание приёмникам; ошибка одного приёмника не мешает остальным"""
+    for sink in sinks:
+        try:
+            sink.deliver(alert)
+        except Exception as e:
+            logger.error(f"Ошибка доставки оповещения в {type(sink).__name__}: {e}")
+
+
+def delivery_sinks(shared=False):
+    """
+    Приёмники процесса, проверяющего правила: файл журнала, webhook из ALERT_WEBHOOK_URL
+    и, при shared=True, таблица alert_events для серверов в других процессах
+    """
+    sinks = [LogSink()]
+    if os.environ.get('ALERT_WEBHOOK_URL'):
+        sinks.append(WebhookSink(os.environ['ALERT_WEBHOOK_URL']))
+    if shared:
+        sinks.append(DatabaseSink())
+    return sinks
+
+
+class AlertEngine:
+    """
+    Проверка правил на каждом обновлении данных. Правила хранят своё состояние
+    и получают только закрытые свечи, появившиеся после предыдущей проверки, поэтому
+    обновление стоит O(числа правил) и не зависит от длины истории.
+    Срабатывания передаются всем приёмникам (объектам с методом deliver).
+    """
+
+    def __init__(self, rules=(), sinks=()):
+        self.sinks = list(sinks)
+        self._rules = defaultdict(list)  # (пара, ряд) -> правила
+        self._last_time = {}  # пара -> время последней проверенной свечи
+        self._lock = threading.Lock()
+        for rule in rules:
+            self.add_rule(rule)
+
+    @property
+    def rules(self):
+        return [rule for rules in self._rules.values() for rule in rules]
+
+    def add_rule(self, rule):
+        with self._lock:
+            self._rules[(rule.pair, rule.metric)].append(rule)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def evaluate(self, result):
+        """Проверяет правила на новых закрытых свечах ответа формата columnar; возвращает срабатывания"""
+        fired = []
+        with self._lock:
+            for pair_name, entry in pair_entries(result):
+                series = [(metric, rules) for (pair, metric), rules in self._rules.items() if pair == pair_name]
+                if not series:
+                    continue
+                times = entry['time']
+                # Последняя свеча ещё не закрыта и будет проверена, когда закроется
+                stop = len(times) - 1
+                last = self._last_time.get(pair_name)
+                # При первой проверке история не перебирается - только последняя закрытая свеча
+                start = max(stop - 1, 0) if last is None else bisect_right(times, last)
+                for i in range(start, stop):
+                    for metric, rules in series:
+                        value = entry[metric][i]
+                        value = None if value is None or math.isnan(value) else value
+                        for rule in rules:
+                            message = rule.update(times[i], value)
+                            if message is not None:
+                                fired.append({
+                                    'rule': rule.name, 'pair': pair_name, 'metric': metric,
+                                    'time': times[i], 'value': value, 'message': message,
+                                })
+                if stop > 0:
+                    self._last_time[pair_name] = times[stop - 1]
+
+        for alert in fired:
+            logger.warning(f"Оповещение {alert['rule']}: {alert['message']} ({alert['value']})")
+            deliver(self.sinks, alert)
+        return fired
+
+
+def pair_entries(result):
+    """Записи пар ответа [(имя пары, ряды)]: первая пара - из исторических ключей верхнего уровня"""
+    first = {field: result[legacy] for field, legacy in LEGACY_RESULT_KEYS.items() if legacy in result}
+    first['time'] = result['time']
+    return [(result['pair'], first), *result['pairs'].items()]
+
+
+def get_engine():
+    """Движок оповещений (Singleton) с правилами из load_rules()"""
+    global _engine_instance
+    with _engine_lock:
+        if _engine_instance is None:
+            _engine_instance = AlertEngine(load_rules())
+        return _engine_instance
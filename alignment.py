@@ -0,0 +1,144 @@
+import logging
+import os
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+import instrumentation
+from lazy_modules import lazy_import
+
+pd = lazy_import('pandas')
+logger = logging.getLogger(__name__)
+
+# Сколько свечей подряд можно заполнить последней известной ценой ряда;
+# более длинные пропуски остаются пропусками, и строка сетки не сохраняется.
+# Переопределяется переменной окружения, например GAP_FILL_TOLERANCE=0 - без заполнения
+FILL_TOLERANCE_CANDLES = 3
+
+
+class SeriesCompleteness(NamedTuple):
+    """Полнота ряда на сетке: точных свечей, заполненных предыдущей ценой и пропущенных"""
+    expected: int
+    present: int
+    filled: int
+    missing: int
+
+    @property
+    def ratio(self):
+        return self.present / self.expected if self.expected else 1.0
+
+
+def get_fill_tolerance():
+    """Допуск заполнения пропусков в свечах из GAP_FILL_TOLERANCE (по умолчанию FILL_TOLERANCE_CANDLES)"""
+    value = os.environ.get('GAP_FILL_TOLERANCE', '').strip()
+    if not value:
+        return FILL_TOLERANCE_CANDLES
+    try:
+        tolerance = int(value)
+    except ValueError:
+        raise ValueError(f"Некорректный GAP_FILL_TOLERANCE: {value!r}") from None
+    if tolerance < 0:
+        raise ValueError("GAP_FILL_TOLERANCE не может быть отрицательным")
+    return tolerance
+
+
+def find_gaps(timestamps, step_ms, start, end):
+    """
+    Пропуски ряда на сетке с шагом step_ms в [start, end] (мс): список
+    (первая пропущенная свеча, последняя пропущенная свеча).
+    """
+    timestamps = np.unique(np.asarray(timestamps, dtype=np.int64))
+    timestamps = timestamps[(timestamps >= start) & (timestamps <= end)]
+    # Границы диапазона - мнимые свечи сразу за его краями
+    points = np.concatenate([[start - step_ms], timestamps, [end + step_ms]])
+    holes = np.flatnonzero(np.diff(points) > step_ms)
+    return [(int(points[i] + step_ms), int(points[i + 1] - step_ms)) for i in holes]
+
+
+def align_series(series, step_ms, tolerance=FILL_TOLERANCE_CANDLES):
+    """
+    Выравнивание рядов {актив: (timestamps в мс, цены)} на общую регулярную сетку
+    с шагом step_ms от первой до последней свечи всех рядов. Каждый ряд
+    присоединяется к сетке as-of (merge_asof): свеча сетки без точного совпадения
+    получает последнюю цену не старше tolerance свечей, иначе NaN.
+    Возвращает (сетка, матрица цен [время, актив], {актив: SeriesCompleteness}).
+    """
+    frames = {
+        asset: pd.DataFrame({'timestamp': np.asarray(timestamps, dtype=np.int64), 'close': closes})
+        .dropna()
+        .drop_duplicates('timestamp', keep='last')
+        .sort_values('timestamp')
+        for asset, (timestamps, closes) in series.items()
+    }
+    bounds = [(df['timestamp'].iloc[0], df['timestamp'].iloc[-1]) for df in frames.values() if not df.empty]
+    if not bounds:
+        return np.empty(0, np.int64), np.empty((0, len(frames))), {}
+
+    start = min(first for first, _ in bounds) // step_ms * step_ms
+    end = max(last for _, last in bounds)
+    grid = pd.DataFrame({'timestamp': np.arange(start, end + 1, step_ms, dtype=np.int64)})
+
+    prices = np.full((len(grid), len(frames)), np.nan)
+    stats = {}
+    for k, (asset, df) in enumerate(frames.items()):
+        joined = pd.merge_asof(grid, df, on='timestamp', direction='backward', tolerance=tolerance * step_ms)
+        prices[:, k] = joined['close'].to_numpy(dtype=np.float64)
+        present = int(np.isin(grid['timestamp'].to_numpy(), df['timestamp'].to_numpy()).sum())
+        known = int(np.count_nonzero(~np.isnan(prices[:, k])))
+        stats[asset] = SeriesCompleteness(len(grid), present, known - present, len(grid) - known)
+    return grid['timestamp'].to_numpy(), prices, stats
+
+
+def ensure_completeness_table(conn):
+    """Полнота рядов в последней записанной пачке свечей по таблице и активу"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS series_completeness (
+            table_name TEXT,
+            asset TEXT,
+            first_timestamp INTEGER,
+            last_timestamp INTEGER,
+            expected INTEGER,
+            present INTEGER,
+            filled INTEGER,
+            missing INTEGER,
+            updated_at INTEGER,
+            PRIMARY KEY (table_name, asset)
+        )
+    ''')
+
+
+def record_completeness(conn, table_name, grid, stats):
+    """Сохраняет полноту рядов пачки и добавляет её в метрики"""
+    if not len(grid):
+        return
+    now = int(time.time() * 1000)
+    with conn:
+        ensure_completeness_table(conn)
+        conn.executemany(
+            "INSERT OR REPLACE INTO series_completeness "
+            "(table_name, asset, first_timestamp, last_timestamp, expected, present, filled, missing, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(table_name, asset, int(grid[0]), int(grid[-1]), *completeness, now) for asset, completeness in stats.items()]
+        )
+    for asset, completeness in stats.items():
+        instrumentation.inc('candles_filled_total', completeness.filled, table=table_name, asset=asset)
+        instrumentation.inc('candles_missing_total', completeness.missing, table=table_name, asset=asset)
+        if completeness.filled or completeness.missing:
+            logger.warning(
+                f"{table_name} {asset}: заполнено {completeness.filled}, "
+                f"пропущено {completeness.missing} из {completeness.expected} свечей"
+            )
+
+
+def get_completeness(conn, table_name=None):
+    """Записи series_completeness в виде словарей"""
+    ensure_completeness_table(conn)
+    query = "SELECT * FROM series_completeness"
+    params = ()
+    if table_name is not None:
+        query += " WHERE table_name = ?"
+        params = (table_name,)
+    cursor = conn.execute(query + " ORDER BY table_name, asset", params)
+    names = [column[0] for column in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
@@ -0,0 +1,212 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
+import numpy as np
+
+import pairs
+from lazy_modules import lazy_import
+from normalization import scale_to_bounds
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FEE = 0.0004  # Комиссия за сделку по одной ноге (доля от объёма)
+DEFAULT_SLIPPAGE = 0.0002  # Проскальзывание по одной ноге
+SIGNAL_WINDOW = 24 * 60  # Окно нормализации сигнала, минут - как окно 24h дашборда
+BLOCK_CELLS = 4_000_000  # Ячеек (бары x комбинации) в одном векторном блоке перебора
+
+_worker_data = None  # Сигнал и доходности, переданные процессу перебора один раз
+
+
+class BacktestResult(NamedTuple):
+    """Итог стратегии на одной паре при одних порогах"""
+    pair: str
+    entry: float
+    exit: float
+    pnl: float  # Суммарная доходность (доля капитала на ногу), за вычетом издержек
+    max_drawdown: float
+    turnover: float  # Суммарное изменение позиции (в ногах по 1 капиталу)
+    trades: int  # Число входов в позицию
+    exposure: float  # Доля баров в позиции
+
+
+def trailing_signal(prices, pair_list=None, window=SIGNAL_WINDOW):
+    """
+    percentage_diff_normalized каждой пары так, как его видел бы дашборд в момент
+    каждого бара: среднее соотношение и min/max считаются по предшествующему окну
+    window баров (включая текущий), без заглядывания в будущее. Матрица (бары, пары);
+    все пары считаются разом над массивами (бары, пары).
+    """
+    pair_list = pair_list or pairs.get_pairs()
+    assets = pairs.get_assets(pair_list)
+    base_idx = [assets.index(pair.base) for pair in pair_list]
+    quote_idx = [assets.index(pair.quote) for pair in pair_list]
+    rolling = pd.DataFrame(prices).rolling(window, min_periods=1)
+    lows = rolling.min().to_numpy()
+    highs = rolling.max().to_numpy()
+
+    base, quote = prices[:, base_idx], prices[:, quote_idx]
+    ratio = pd.DataFrame(base / quote).rolling(window, min_periods=1).mean().to_numpy()
+    avg_ratio = np.round(ratio, 2)
+    base_as_quote = np.round(base / avg_ratio, 2)
+    base_norm = scale_to_bounds(
+        base_as_quote, np.round(lows[:, base_idx] / avg_ratio, 2), np.round(highs[:, base_idx] / avg_ratio, 2)
+    )
+    quote_norm = scale_to_bounds(quote, lows[:, quote_idx], highs[:, quote_idx])
+    return base_norm - quote_norm
+
+
+def spread_returns(prices, pair_list=None):
+    """Доходность бара позиции «base против quote» равными объёмами: (бары, пары), первый бар 0"""
+    pair_list = pair_list or pairs.get_pairs()
+    assets = pairs.get_assets(pair_list)
+    returns = np.zeros_like(prices, dtype=float)
+    returns[1:] = prices[1:] / prices[:-1] - 1
+    base_idx = [assets.index(pair.base) for pair in pair_list]
+    quote_idx = [assets.index(pair.quote) for pair in pair_list]
+    return returns[:, base_idx] - returns[:, quote_idx]
+
+
+def positions(signal, entries, exits):
+    """
+    Позиции (бары, комбинации) для порогов entries/exits (по комбинации):
+    signal > entry - base переоценён, продаём спред (-1); signal < -entry - покупаем (+1);
+    |signal| < exit - закрываем. Между порогами позиция сохраняется.
+    """
+    s = signal[:, np.newaxis]
+    short = s > entries
+    long = s < -entries
+    code = long.astype(np.int8) - short.astype(np.int8)
+    event = short | long | (np.abs(s) < exits)
+    event[0] = True  # До первого сигнала позиции нет
+
+    # Позиция - код последнего события: протягиваем индекс события вперёд
+    index = np.where(event, np.arange(len(signal))[:, np.newaxis], 0)
+    np.maximum.accumulate(index, axis=0, out=index)
+    return np.take_along_axis(code, index, axis=0)
+
+
+def evaluate(signal, returns, entries, exits, fee=DEFAULT_FEE, slippage=DEFAULT_SLIPPAGE):
+    """Метрики стратегии для блока комбинаций порогов; словарь массивов длины комбинаций"""
+    entries = np.asarray(entries, dtype=float)
+    exits = np.asarray(exits, dtype=float)
+    position = positions(signal, entries, exits).astype(float)
+
+    # Позиция, открытая на закрытии бара t, получает доходность бара t + 1
+    held = np.zeros_like(position)
+    held[1:] = position[:-1]
+    change = np.abs(np.diff(position, axis=0, prepend=0))
+    # Смена позиции затрагивает обе ноги спреда
+    net = held * returns[:, np.newaxis] - change * 2 * (fee + slippage)
+
+    equity = np.cumsum(net, axis=0)
+    peak = np.maximum(np.maximum.accumulate(equity, axis=0), 0)
+    opened = (position != 0) & (np.vstack([np.zeros((1, position.shape[1])), position[:-1]]) != position)
+    return {
+        'pnl': equity[-1],
+        'max_drawdown': (peak - equity).max(axis=0),
+        'turnover': change.sum(axis=0) * 2,
+        'trades': opened.sum(axis=0),
+        'exposure': (position != 0).mean(axis=0),
+    }
+
+
+def run_backtest(signal, returns, pair_list, entry, exit, fee=DEFAULT_FEE, slippage=DEFAULT_SLIPPAGE):
+    """Бэктест одних порогов на всех парах: список BacktestResult по парам"""
+    return sweep(signal, returns, pair_list, [entry], [exit], fee, slippage, workers=1)
+
+
+def sweep(signal, returns, pair_list, entries, exits, fee=DEFAULT_FEE, slippage=DEFAULT_SLIPPAGE, workers=None):
+    """
+    Перебор всех сочетаний порогов entries x exits (exit < entry) на каждой паре.
+    Комбинации считаются блоками по BLOCK_CELLS ячеек через broadcasting, блоки
+    распределяются по процессам. Возвращает BacktestResult, лучшие по PnL первыми.
+    """
+    grid = [(entry, exit) for entry in entries for exit in exits if exit < entry]
+    if not grid:
+        return []
+    grid = np.array(grid, dtype=float)
+    block = max(1, BLOCK_CELLS // max(len(signal), 1))
+    tasks = [(k, grid[i:i + block]) for k in range(len(pair_list)) for i in range(0, len(grid), block)]
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) == 1:
+        _init_worker(signal, returns, fee, slippage)
+        outputs = [_evaluate_block(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker,
+                                 initargs=(signal, returns, fee, slippage)) as pool:
+            outputs = list(pool.map(_evaluate_block, tasks))
+
+    results = []
+    for (k, combos), metrics in zip(tasks, outputs):
+        for i, (entry, exit) in enumerate(combos):
+            results.append(BacktestResult(
+                pair_list[k].name, float(entry), float(exit),
+                float(metrics['pnl'][i]), float(metrics['max_drawdown'][i]),
+                float(metrics['turnover'][i]), int(metrics['trades'][i]), float(metrics['exposure'][i]),
+            ))
+    results.sort(key=lambda result: result.pnl, reverse=True)
+    return results
+
+
+def _init_worker(signal, returns, fee, slippage):
+    global _worker_data
+    _worker_data = (signal, returns, fee, slippage)
+
+
+def _evaluate_block(task):
+    k, combos = task
+    signal, returns, fee, slippage = _worker_data
+    return evaluate(signal[:, k], returns[:, k], combos[:, 0], combos[:, 1], fee, slippage)
+
+
+def parse_grid(value):
+    """Сетка порогов 'start:stop:step' (stop включительно) или список через запятую"""
+    if ':' in value:
+        start, stop, step = (float(part) for part in value.split(':'))
+        return np.round(np.arange(start, stop + step / 2, step), 10).tolist()
+    return [float(part) for part in value.split(',')]
+
+
+def main(argv=None):
+    import history_store
+
+    parser = argparse.ArgumentParser(description="Бэктест сигнала нормализованного спреда по долгой истории")
+    parser.add_argument('--days', type=int, default=30, help="Глубина истории, дней")
+    parser.add_argument('--pair', action='append', default=[], help="Пара BASE/QUOTE (по умолчанию - все)")
+    parser.add_argument('--entry', default='0.5', help="Порог входа или сетка start:stop:step")
+    parser.add_argument('--exit', default='0.1', help="Порог выхода или сетка start:stop:step")
+    parser.add_argument('--fee', type=float, default=DEFAULT_FEE)
+    parser.add_argument('--slippage', type=float, default=DEFAULT_SLIPPAGE)
+    parser.add_argument('--workers', type=int, default=None, help="Процессов перебора")
+    parser.add_argument('--top', type=int, default=20, help="Сколько лучших комбинаций вывести")
+    args = parser.parse_args(argv)
+
+    pair_list = pairs.select_pairs([name for value in args.pair for name in value.split(',')])
+    start = int(time.time() * 1000) - args.days * 24 * 60 * 60 * 1000
+    _, prices = history_store.get_store().load_prices(pairs.get_assets(pair_list), start)
+    if len(prices) < 2:
+        raise SystemExit("Нет истории для бэктеста: запустите python history_store.py backfill")
+
+    started = time.perf_counter()
+    signal = trailing_signal(prices, pair_list)
+    returns = spread_returns(prices, pair_list)
+    results = sweep(signal, returns, pair_list, parse_grid(args.entry), parse_grid(args.exit),
+                    args.fee, args.slippage, args.workers)
+    logger.info(f"{len(results)} комбинаций на {len(prices)} барах за {time.perf_counter() - started:.1f} с")
+
+    print(f"{'pair':<10} {'entry':>6} {'exit':>6} {'pnl':>9} {'max_dd':>8} {'turnover':>9} {'trades':>7} {'exposure':>8}")
+    for result in results[:args.top]:
+        print(f"{result.pair:<10} {result.entry:>6.2f} {result.exit:>6.2f} {result.pnl:>9.4f} "
+              f"{result.max_drawdown:>8.4f} {result.turnover:>9.1f} {result.trades:>7d} {result.exposure:>8.2%}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
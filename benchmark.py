@@ -0,0 +1,229 @@
+import argparse
+import http.server
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SCALES = (1, 10, 100)  # Множители текущего числа строк таблиц
+# Текущее число строк таблиц и глубина их окна (мс): при масштабе свечи идут чаще
+BASE_ROWS = {'market_data_24h': 24 * 60, 'market_data_180d': 180 * 2}
+WINDOW_MS = {'market_data_24h': 24 * 60 * 60 * 1000, 'market_data_180d': 180 * 24 * 60 * 60 * 1000}
+SYNTHETIC_PRICES = {'BTC': 60000.0, 'ETH': 3000.0}  # Начальные цены; остальные активы - 100
+DEFAULT_REPEATS = 5
+DEFAULT_OUTPUT = 'benchmark.json'
+REGRESSION_THRESHOLD = 0.2  # Рост медианы больше чем на 20% считается регрессией
+
+
+def synthetic_ohlcv(count, end_ms, step_ms, price=100.0, seed=0, volatility=0.001):
+    """
+    Свечи [timestamp, open, high, low, close, volume] в формате ccxt: геометрическое
+    случайное блуждание из count свечей с шагом step_ms, последняя - на end_ms.
+    Одинаковые аргументы дают одинаковые свечи.
+    """
+    rng = np.random.default_rng(seed)
+    closes = price * np.exp(np.cumsum(rng.normal(0, volatility, count)))
+    opens = np.concatenate([[price], closes[:-1]])
+    wicks = np.abs(rng.normal(0, volatility, count)) * closes
+    highs = np.maximum(opens, closes) + wicks
+    lows = np.minimum(opens, closes) - wicks
+    volumes = rng.uniform(1, 100, count)
+    timestamps = end_ms - (count - 1 - np.arange(count)) * step_ms
+    return [
+        [int(t), float(o), float(h), float(l), float(c), float(v)]
+        for t, o, h, l, c, v in zip(timestamps, opens, highs, lows, closes, volumes)
+    ]
+
+
+def measure(name, scale, rows, fn, repeats, setup=None):
+    """Время fn() за repeats запусков (setup перед каждым не входит в замер)"""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    result = {
+        'name': name, 'scale': scale, 'rows': rows, 'repeats': repeats,
+        'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+    }
+    logger.info(f"{name} x{scale} ({rows} строк): медиана {result['median'] * 1000:.1f} мс")
+    return result
+
+
+def run_benchmarks(scales=SCALES, repeats=DEFAULT_REPEATS):
+    """
+    Замеры этапов ingest -> metrics -> serialize на синтетических свечах. Модули
+    проекта импортируются здесь: к этому моменту MARKET_DATA_DIR уже указывает на
+    отдельный каталог данных, и рабочая база не затрагивается.
+    """
+    import db_utils
+    import pairs
+    import run_server
+    from data_processor import DataProcessor, calculate_metrics
+
+    assets = pairs.get_assets()
+    columns = [pairs.asset_column(asset) for asset in assets]
+    end_ms = int(time.time() * 1000) // 60000 * 60000
+
+    run_server.init_database()
+    db_utils.create_tables()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), run_server.AutoRefreshHTTPRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/api/processed-data'
+
+    def request(query=''):
+        with urllib.request.urlopen(url + query) as response:
+            response.read()
+
+    results = []
+    try:
+        for scale in scales:
+            frames, raw_data, steps = {}, {}, {}
+            for table_name, base_rows in BASE_ROWS.items():
+                count = base_rows * scale
+                steps[table_name] = WINDOW_MS[table_name] // count
+                # Свечи ложатся на сетку шага, иначе выравнивание заполнит их все
+                table_end_ms = end_ms // steps[table_name] * steps[table_name]
+                candles = {
+                    asset: synthetic_ohlcv(count, table_end_ms, steps[table_name],
+                                           SYNTHETIC_PRICES.get(asset, 100.0), seed=i)
+                    for i, asset in enumerate(assets)
+                }
+                frames[table_name] = {asset: db_utils.ohlcv_to_frame(ohlcv) for asset, ohlcv in candles.items()}
+                # Строки в том виде, в каком их читает из базы get_processed_data
+                raw_data[table_name] = [
+                    {'timestamp': row[0][0], **{column: candle[4] for column, candle in zip(columns, row)}}
+                    for row in zip(*candles.values())
+                ]
+            rows_24h = len(raw_data['market_data_24h'])
+            rows_180d = len(raw_data['market_data_180d'])
+
+            for table_name in BASE_ROWS:
+                results.append(measure(
+                    f'save_data_in_db[{table_name}]', scale, len(raw_data[table_name]),
+                    lambda: db_utils.save_data_in_db(frames[table_name], table_name, steps[table_name]), repeats,
+                    setup=lambda: db_utils.create_tables(clear=True),
+                ))
+            for table_name in BASE_ROWS:
+                db_utils.save_data_in_db(frames[table_name], table_name, steps[table_name])
+            db_utils.bump_data_version()
+
+            results.append(measure(
+                'calculate_metrics', scale, rows_24h,
+                lambda: calculate_metrics(raw_data['market_data_24h']), repeats,
+            ))
+            results.append(measure(
+                'process_market_data', scale, rows_24h + rows_180d,
+                lambda: DataProcessor.process_market_data(raw_data['market_data_24h'], raw_data['market_data_180d']),
+                repeats,
+            ))
+            # Первый вызов после записи перестраивает скользящее окно, следующие - инкрементальные
+            results.append(measure(
+                'get_processed_data[cold]', scale, rows_24h + rows_180d, DataProcessor.get_processed_data, 1,
+            ))
+            results.append(measure(
+                'get_processed_data', scale, rows_24h + rows_180d, DataProcessor.get_processed_data, repeats,
+            ))
+            # Смена версии данных сбрасывает кеш ответов: ответ строится заново
+            results.append(measure(
+                'http_processed_data', scale, rows_24h + rows_180d, request, repeats,
+                setup=db_utils.bump_data_version,
+            ))
+            results.append(measure(
+                'http_processed_data[cached]', scale, rows_24h + rows_180d, request, repeats,
+            ))
+            results.append(measure(
+                'http_processed_data[bin]', scale, rows_24h + rows_180d, lambda: request('?format=bin'), repeats,
+                setup=db_utils.bump_data_version,
+            ))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def environment_info():
+    """Версия кода и окружения, в котором сделаны замеры"""
+    import pandas
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pandas.__version__,
+    }
+
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """Замеры current, медиана которых выросла относительно baseline больше чем на threshold"""
+    previous = {(result['name'], result['scale']): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = previous.get((result['name'], result['scale']))
+        if before is None or not before['median']:
+            continue
+        ratio = result['median'] / before['median']
+        if ratio > 1 + threshold:
+            regressions.append({**result, 'baseline_median': before['median'], 'ratio': ratio})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера ingest -> metrics -> serialize")
+    parser.add_argument('--scales', default=','.join(map(str, SCALES)), help="Множители числа строк через запятую")
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="Файл JSON с результатами")
+    parser.add_argument('--compare', help="JSON предыдущего запуска: выход с кодом 1 при регрессии")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as directory:
+        os.environ['MARKET_DATA_DIR'] = directory
+        results = run_benchmarks([int(scale) for scale in args.scales.split(',')], args.repeats)
+
+    report = {**environment_info(), 'results': results}
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    logger.info(f"Результаты записаны в {args.output}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        regressions = compare(baseline, report, args.threshold)
+        for result in regressions:
+            logger.warning(
+                f"Регрессия {result['name']} x{result['scale']}: "
+                f"{result['baseline_median'] * 1000:.1f} -> {result['median'] * 1000:.1f} мс ({result['ratio']:.2f}x)"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    # Журнал самих этапов (записи, обновления) заглушил бы результаты замеров
+    for name in ('db_utils', 'data_processor', 'run_server', 'rollups', 'storage', 'history_store'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    main()
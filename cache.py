@@ -0,0 +1,88 @@
+import threading
+
+
+class _Entry:
+    """Значение кеша; event выставляется, когда вычисление завершено"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class VersionedCache:
+    """
+    Кеш готовых ответов, действительный до смены версии данных.
+
+    version_fn возвращает текущую версию данных; при её смене все записи сбрасываются.
+    Параллельные запросы одного ключа одной версии ждут единственного вычисления.
+    Значение, посчитанное из данных прежней версии, возвращается без кеширования.
+    """
+
+    def __init__(self, version_fn, max_entries=64):
+        self.version_fn = version_fn
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute, version=None):
+        """
+        Возвращает значение ключа для текущей версии, вычисляя его через compute() один раз.
+        version - версия данных, из которых compute() строит значение (по умолчанию -
+        текущая): если она уже устарела, значение вычисляется, но не кешируется.
+        """
+        with self._lock:
+            # Версия читается под блокировкой: поток с устаревшим значением не откатит кеш назад
+            current = self.version_fn()
+            if version is None:
+                version = current
+            if current != self._version:
+                self._version = current
+                self._entries = {}
+            stale = version != current
+            entry = None if stale else self._entries.get(key)
+            owner = entry is None
+            if stale:
+                self.misses += 1
+            elif owner:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.pop(next(iter(self._entries)))
+                entry = self._entries[key] = _Entry()
+                self.misses += 1
+            else:
+                # Перемещаем запись в конец: вытесняются давно не запрашивавшиеся ключи
+                self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+
+        if stale:
+            return compute()
+
+        if not owner:
+            entry.event.wait()
+            if entry.error is not None:
+                raise entry.error
+            return entry.value
+
+        try:
+            entry.value = compute()
+        except Exception as e:
+            entry.error = e
+            raise
+        finally:
+            # Пустой результат и ошибки не кешируем: следующий запрос повторит вычисление
+            if entry.value is None:
+                self._discard(version, key, entry)
+            entry.event.set()
+        return entry.value
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def _discard(self, version, key, entry):
+        with self._lock:
+            if self._version == version and self._entries.get(key) is entry:
+                del self._entries[key]
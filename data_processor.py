@@ -1,12 +1,26 @@
 import sqlite3
 import logging
-import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
+import threading
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+
+import numpy as np
+
 import db_utils
+import instrumentation
+import live_feed
+import pairs
+import storage
+from lazy_modules import lazy_import
+from metrics import epoch_seconds, calculate_pair_metrics, calculate_relative_spread
+from rolling_metrics import RollingMetricsEngine
+from spread_stats import calculate_spread_stats
 from zoneinfo import ZoneInfo
 
+pd = lazy_import('pandas')
+
 
-DB_PATH = db_utils.get_db_path()
 logger = logging.getLogger(__name__)
 
 
@@ -33,181 +47,333 @@ class DataProcessor:
         ]
 
     @staticmethod
-    def process_market_data(raw_data_24h, raw_data_180d):
-        """Обрабатывает рыночные данные и вычисляет метрики."""
-        result = {
-            'btc': [],
-            'eth': [],
-            'btc_as_eth': [],
-            'btc_as_eth_norm': [],
-            'eth_norm': [],
-            'percentage_diff_norm': [],
-            'percentage_diff': [],
-            'relative_spread': [],
-            "avg_ratio_24h": 0,
-            "avg_ratio_180d": 0,
-            'btc_as_eth_min': 0,
-            'btc_as_eth_max': 0,
-            'eth_min': 0,
-            'eth_max': 0
-        }
+    @instrumentation.timed()
+    def process_market_data(raw_data_24h, raw_data_180d, pair_list=None, shape='points'):
+        """Обрабатывает рыночные данные и вычисляет метрики.
 
-        data_24h, avg_24h = calculate_metrics(raw_data_24h)
-        data_180d, avg_180d = calculate_metrics(raw_data_180d)
-
-        # Вычисляем min и max
-        btc_as_eth_min = data_24h['btc_as_eth'].min()
-        btc_as_eth_max = data_24h['btc_as_eth'].max()
-        eth_min = data_24h['close_eth'].min()
-        eth_max = data_24h['close_eth'].max()
-        result['btc_as_eth_min'] = btc_as_eth_min
-        result['btc_as_eth_max'] = btc_as_eth_max
-        result['eth_min'] = eth_min
-        result['eth_max'] = eth_max
-        result['avg_ratio_24h'] = avg_24h
-        result['avg_ratio_180d'] = avg_180d
-
-        for row in data_24h.itertuples(index=False):
-            try:
-                time = int(pd.to_datetime(row.timestamp).timestamp())
-                btc = float(row.close_btc)
-                eth = float(row.close_eth)
-                btc_as_eth = float(row.btc_as_eth)
-                btc_as_eth_norm = float(row.btc_as_eth_norm)
-                eth_norm = float(row.eth_norm)
-                percentage_diff_normalized = float(row.percentage_diff_normalized)
-                percentage_diff = float(row.percentage_diff)
-
-                result['btc'].append({'time': time, 'value': btc})
-                result['eth'].append({'time': time, 'value': eth})
-                result['btc_as_eth'].append({'time': time, 'value': btc_as_eth})
-                result['btc_as_eth_norm'].append({'time': time, 'value': btc_as_eth_norm})
-                result['eth_norm'].append({'time': time, 'value': eth_norm})
-                result['percentage_diff_norm'].append({'time': time, 'value': percentage_diff_normalized})
-                result['percentage_diff'].append({'time': time, 'value': percentage_diff})
-
-            except (ValueError, KeyError) as e:
-                logger.warning(f"Ошибка обработки записи: {e}")
-            except Exception as e:
-                logger.error(f"Ошибка нормализации данных: {e}")
-
-        # --- Первая точка: среднее за первый месяц в data_180d ---
-        start_time_180d = pd.to_datetime(data_180d['timestamp'].iloc[0])
-        end_time_180d = start_time_180d + pd.DateOffset(days=7)
-
-        # Фильтруем первые 30 дней
-        first_month_data = data_180d[(pd.to_datetime(data_180d['timestamp']) >= start_time_180d) &
-                                     (pd.to_datetime(data_180d['timestamp']) < end_time_180d)]
-
-        avg_180d = first_month_data['percentage_diff_normalized'].mean()
-
-        result['relative_spread'].append({
-            'time': start_time_180d.timestamp(),
-            'value': avg_180d
-        })
-
-        # --- Вторая точка: среднее за последние 24 часа в data_24h ---
-        # Предполагаем, что data_24h уже содержит данные только за последние 24 часа
-        avg_24h = data_24h['percentage_diff_normalized'].mean()
-        last_timestamp = pd.to_datetime(data_24h['timestamp'].iloc[-1])
-
-        result['relative_spread'].append({
-            'time': last_timestamp.timestamp(),
-            'value': avg_24h
-        })
+        Верхнеуровневые ключи (btc, eth, btc_as_eth, ...) описывают первую пару
+        выборки, остальные пары выборки возвращаются в 'pairs' по имени пары.
+        shape='points' - ряды в виде [{'time', 'value'}, ...];
+        shape='columnar' - общая ось 'time' и ряды в виде списков значений.
+        """
+        pair_list = pair_list or pairs.get_pairs()
+
+        metrics_24h = calculate_pair_metrics(raw_data_24h, pair_list)
+        metrics_180d = calculate_pair_metrics(raw_data_180d, pair_list)
+        return DataProcessor.build_result(metrics_24h, metrics_180d, shape)
+
+    @staticmethod
+    @instrumentation.timed()
+    def build_result(metrics_24h, metrics_180d, shape='points'):
+        """Формирует ответ API из метрик окна 24h и окна 180d"""
+        if shape not in RESULT_SHAPES:
+            raise ValueError(f"Неизвестный формат ответа: {shape}")
+        pair_list = metrics_24h.pairs
+        relative_spread = calculate_relative_spread(metrics_24h, metrics_180d)
+        spread_stats = calculate_spread_stats(metrics_24h)
+
+        # Время в секундах вычисляется один раз для всех рядов
+        times = epoch_seconds(metrics_24h.timestamps).tolist()
+        base_idx, quote_idx = metrics_24h.asset_indices()
+        base = metrics_24h.prices[:, base_idx]
+        quote = metrics_24h.prices[:, quote_idx]
+
+        if shape == 'columnar':
+            def series(values):
+                return values
+        else:
+            def series(values):
+                return [{'time': time, 'value': value} for time, value in zip(times, values)]
+
+        # Колонки матриц переводятся в списки Python за один вызов на матрицу;
+        # в строках без цены актива ряды его пар - null
+        columns = {
+            'base': nullable_columns(base),
+            'quote': nullable_columns(quote),
+            'base_as_quote': nullable_columns(metrics_24h.base_as_quote),
+            'base_as_quote_norm': nullable_columns(metrics_24h.base_as_quote_norm),
+            'quote_norm': nullable_columns(metrics_24h.quote_norm),
+            'percentage_diff_norm': nullable_columns(metrics_24h.percentage_diff_normalized),
+            'percentage_diff': nullable_columns(metrics_24h.percentage_diff),
+            # Скользящие ряды не определены в начале окна - там null
+            'zscore': nullable_columns(spread_stats.zscore),
+            'hedge_ratio': nullable_columns(spread_stats.hedge_ratio),
+            'coint_stat': nullable_columns(spread_stats.coint_stat),
+        }
+        scalars = {
+            'avg_ratio_24h': nullable_columns(metrics_24h.avg_ratio),
+            'avg_ratio_180d': nullable_columns(metrics_180d.avg_ratio),
+            'base_as_quote_min': nullable_columns(np.fmin.reduce(metrics_24h.base_as_quote, axis=0)),
+            'base_as_quote_max': nullable_columns(np.fmax.reduce(metrics_24h.base_as_quote, axis=0)),
+            'quote_min': nullable_columns(np.fmin.reduce(quote, axis=0)),
+            'quote_max': nullable_columns(np.fmax.reduce(quote, axis=0)),
+            'cointegrated': spread_stats.cointegrated.tolist(),
+        }
 
+        entries = []
+        for k in range(len(pair_list)):
+            entry = {key: series(values[k]) for key, values in columns.items()}
+            entry['relative_spread'] = relative_spread[k]
+            entry.update({key: values[k] for key, values in scalars.items()})
+            entry['coint_critical'] = spread_stats.coint_critical
+            if shape == 'columnar':
+                entry['time'] = times
+            entries.append(entry)
+
+        result = {'pair': pair_list[0].name}
+        result.update({legacy: entries[0][key] for key, legacy in LEGACY_RESULT_KEYS.items()})
+        if shape == 'columnar':
+            result['time'] = times
+        result['pairs'] = {pair.name: entry for pair, entry in zip(pair_list[1:], entries[1:])}
+        # Отпечаток параметров нормализации: пока он не изменился, ранее полученные
+        # клиентом точки остаются верными и достаточно дельты
+        norm_params = [scalars[key] for key in NORM_FIELDS]
+        result['norm_key'] = f"{zlib.crc32(repr(norm_params).encode()):08x}"
         return result
 
     @staticmethod
-    def get_processed_data():
+    def build_delta(result, since):
+        """
+        Дельта ответа: точки рядов с time >= since и текущие скаляры. Точка since
+        включается, чтобы клиент получил окончательное значение своей последней свечи.
+        window_start - первая точка окна сервера: более ранние точки клиент отбрасывает.
+        """
+        delta = slice_series(result, since, LEGACY_SERIES_KEYS)
+        delta['pairs'] = {
+            name: slice_series(entry, since, SERIES_FIELDS)
+            for name, entry in result['pairs'].items()
+        }
+        delta['delta'] = True
+        delta['since'] = since
+        delta['window_start'] = window_start(result, since)
+        return delta
+
+    @staticmethod
+    @instrumentation.timed()
+    def get_processed_data(pair_list=None, shape='points'):
         """Получение и обработка данных из БД с улучшенной обработкой ошибок"""
-        conn = None
+        pair_list = pair_list or pairs.get_pairs()
+        columns = [pairs.asset_column(asset) for asset in pairs.get_assets(pair_list)]
         try:
-            logger.info(f"Путь к бд: {DB_PATH}")
-            conn = sqlite3.connect(DB_PATH, timeout=30)
-            conn.row_factory = sqlite3.Row
-
-            # Проверяем существование таблиц
-            cursor = conn.cursor()
-            for table in ['market_data_24h', 'market_data_180d']:
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
-                if not cursor.fetchone():
-                    logger.error(f"Таблица {table} не найдена в базе данных")
+            with storage.connection() as conn:
+                # Проверяем существование таблиц
+                cursor = conn.cursor()
+                for table in ['market_data_24h', 'market_data_180d']:
+                    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+                    if not cursor.fetchone():
+                        logger.error(f"Таблица {table} не найдена в базе данных")
+                        return None
+
+                # Получаем данные с обработкой возможных ошибок
+                try:
+                    with instrumentation.span('read_180d'):
+                        cursor.execute(f"""
+                            SELECT timestamp, {', '.join(columns)}
+                            FROM market_data_180d
+                            WHERE {pairs_present_sql(pair_list)}
+                            ORDER BY timestamp
+                        """)
+                        raw_data_180d = [dict(row) for row in cursor.fetchall()]
+
+                    # Окно 24h ведётся скользящим движком: из БД читаются только новые свечи
+                    metrics_24h = sync_rolling_metrics(conn, pair_list)
+
+                    if metrics_24h is None or not raw_data_180d:
+                        logger.error("Одна из таблиц не содержит данных")
+                        return None
+
+                    metrics_180d = calculate_pair_metrics(raw_data_180d, pair_list)
+                    return DataProcessor.build_result(metrics_24h, metrics_180d, shape)
+
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка при выполнении SQL-запроса: {e}")
                     return None
 
-            # Получаем данные с обработкой возможных ошибок
-            try:
-                cursor.execute("""
-                    SELECT timestamp, close_btc, close_eth 
-                    FROM market_data_24h 
-                    ORDER BY timestamp
-                """)
-                raw_data_24h = [dict(row) for row in cursor.fetchall()]
-
-                cursor.execute("""
-                    SELECT timestamp, close_btc, close_eth 
-                    FROM market_data_180d 
-                    ORDER BY timestamp
-                """)
-                raw_data_180d = [dict(row) for row in cursor.fetchall()]
-
-                if not raw_data_24h or not raw_data_180d:
-                    logger.error("Одна из таблиц не содержит данных")
-                    return None
-
-                return DataProcessor.process_market_data(raw_data_24h, raw_data_180d)
-
-            except sqlite3.Error as e:
-                logger.error(f"Ошибка при выполнении SQL-запроса: {e}")
-                return None
-
         except Exception as e:
             logger.error(f"Неожиданная ошибка при получении данных: {e}")
             return None
-        finally:
-            if conn:
-                conn.close()
-
-
-def calculate_metrics(raw_data):
-    """Вычисление метрик и сохранение в базу"""
-    if not raw_data:
-        logger.error("Ошибка: пустые данные")
-        return
-
-    # Преобразуем список словарей в DataFrame
-    df = pd.DataFrame(raw_data)
-
-    # Проверяем, есть ли все нужные колонки
-    required_columns = {'timestamp', 'close_btc', 'close_eth'}
-    if not required_columns.issubset(df.columns):
-        logger.error("Ошибка: отсутствуют необходимые столбцы")
-        return
-
-    # Преобразуем timestamp в datetime для удобства
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
 
-    # Сортируем по времени
-    df = df.sort_values('timestamp')
 
-    # Вычисляем соотношение BTC/ETH
-    df['btc_to_eth'] = df['close_btc'] / df['close_eth']
-    avg_ratio = round(df['btc_to_eth'].mean(), 2)
-
-    df = df.drop(columns=['btc_to_eth'])
-
-    # Вычисляем btc_as_eth
-    df['btc_as_eth'] = round(df['close_btc'] / avg_ratio, 2)
-
-    # Нормализация
-    scaler = MinMaxScaler()
-    df[['btc_as_eth_norm', 'eth_norm']] = scaler.fit_transform(
-        df[['btc_as_eth', 'close_eth']]
+RESULT_SHAPES = ('points', 'columnar')
+
+# Скользящие движки окна 24h по набору пар (отсортированному: порядок ?pair= не важен),
+# вытесняются давно не запрошенные
+_rolling_engines = OrderedDict()
+_rolling_engines_lock = threading.Lock()
+ROLLING_ENGINES_MAX = 8
+
+# Соответствие полей пары историческим ключам ответа (первая пара выборки)
+LEGACY_RESULT_KEYS = {
+    'base': 'btc',
+    'quote': 'eth',
+    'base_as_quote': 'btc_as_eth',
+    'base_as_quote_norm': 'btc_as_eth_norm',
+    'quote_norm': 'eth_norm',
+    'percentage_diff_norm': 'percentage_diff_norm',
+    'percentage_diff': 'percentage_diff',
+    'relative_spread': 'relative_spread',
+    'avg_ratio_24h': 'avg_ratio_24h',
+    'avg_ratio_180d': 'avg_ratio_180d',
+    'base_as_quote_min': 'btc_as_eth_min',
+    'base_as_quote_max': 'btc_as_eth_max',
+    'quote_min': 'eth_min',
+    'quote_max': 'eth_max',
+    'zscore': 'zscore',
+    'hedge_ratio': 'hedge_ratio',
+    'coint_stat': 'coint_stat',
+    'coint_critical': 'coint_critical',
+    'cointegrated': 'cointegrated',
+}
+
+# Ряды точек в ответе по паре и их исторические имена для первой пары выборки
+SERIES_FIELDS = (
+    'base', 'quote', 'base_as_quote', 'base_as_quote_norm', 'quote_norm',
+    'percentage_diff_norm', 'percentage_diff', 'zscore', 'hedge_ratio', 'coint_stat',
+)
+LEGACY_SERIES_KEYS = tuple(LEGACY_RESULT_KEYS[key] for key in SERIES_FIELDS)
+# Скаляры, от которых зависят уже отданные точки нормализованных рядов
+NORM_FIELDS = ('avg_ratio_24h', 'base_as_quote_min', 'base_as_quote_max', 'quote_min', 'quote_max')
+
+
+def pairs_present_sql(pair_list):
+    """Условие SQL: в строке есть обе цены хотя бы одной пары (пропуски остальных - NaN их пар)"""
+    conditions = (
+        f"({pairs.asset_column(pair.base)} IS NOT NULL AND {pairs.asset_column(pair.quote)} IS NOT NULL)"
+        for pair in pair_list
     )
+    return f"({' OR '.join(conditions)})"
+
+
+@instrumentation.timed('read_rolling_rows')
+def _read_rolling_rows(conn, columns, present, since_ms=None, until_ms=None):
+    """Строки окна 24h с условием present в виде [(timestamp_ms, prices), ...] в диапазоне [since_ms, until_ms)"""
+    where = present
+    params = ()
+    if since_ms is not None:
+        where += " AND timestamp >= ?"
+        params += (since_ms,)
+    if until_ms is not None:
+        where += " AND timestamp < ?"
+        params += (until_ms,)
+    rows = conn.execute(
+        f"SELECT timestamp, {', '.join(columns)} FROM market_data_24h WHERE {where} ORDER BY timestamp",
+        params
+    ).fetchall()
+    return [(row[0], tuple(row)[1:]) for row in rows]
+
+
+@instrumentation.timed()
+def sync_rolling_metrics(conn, pair_list):
+    """
+    Догружает в скользящий движок окна 24h свечи, появившиеся в БД, и возвращает
+    PairMetrics окна. Последняя строка таблицы считается незакрытой свечой;
+    последние SYNC_OVERLAP_CANDLES свечей перечитываются, чтобы заметить их ревизии,
+    и при расхождении с БД движок перестраивается с нуля.
 
-    # Вычисляем разницу нормализованных значений
-    df['percentage_diff_normalized'] = df['btc_as_eth_norm'] - df['eth_norm']
-
-    df['percentage_diff'] = df['btc_as_eth'] - df['close_eth']
+    В режиме потока цен свечи, ещё не сохранённые приёмом, берутся из памяти
+    (включая текущую незакрытую) и заменяют строки БД с того же времени.
+    """
+    key = tuple(sorted(pair_list))
+    with _rolling_engines_lock:
+        if key in _rolling_engines:
+            _rolling_engines.move_to_end(key)
+        else:
+            _rolling_engines[key] = (RollingMetricsEngine(key), threading.Lock())
+            if len(_rolling_engines) > ROLLING_ENGINES_MAX:
+                _rolling_engines.popitem(last=False)
+        engine, lock = _rolling_engines[key]
+
+    # Движок хранит активы в порядке своего набора пар
+    assets = engine.assets
+    columns = [pairs.asset_column(asset) for asset in assets]
+    present = pairs_present_sql(engine.pairs)
+    timeframe_ms = 60 * 1000
+
+    # Строки потока читаются до БД: сохранённая приёмом строка сначала попадает
+    # в БД и только потом исчезает из памяти, поэтому не теряется между чтениями
+    live_rows = live_feed.current_rows(assets)
+    live_start = live_rows[0][0] if live_rows else None
+
+    with lock:
+        in_sync = False
+        if engine.last_closed_timestamp is not None:
+            since_ms = engine.last_closed_timestamp - db_utils.SYNC_OVERLAP_CANDLES * timeframe_ms
+            rows = _read_rolling_rows(conn, columns, present, since_ms, live_start)
+            closed_before = live_start if live_rows else (rows[-1][0] if rows else None)
+            in_sync = bool(rows or live_rows) and engine.apply_rows(rows, closed_before)
+        if in_sync:
+            # Строки могли быть удалены из БД (полное обновление) - сверяем количество
+            where = f"timestamp >= ? AND {present}"
+            params = (engine.first_timestamp,)
+            if live_rows:
+                where += " AND timestamp < ?"
+                params += (live_start,)
+            count = conn.execute(f"SELECT COUNT(*) FROM market_data_24h WHERE {where}", params).fetchone()[0]
+            expected = len(engine) - (engine.count_since(live_start) if live_rows else 0)
+            in_sync = count == expected
+        if in_sync and live_rows:
+            in_sync = engine.apply_rows(live_rows, closed_before=live_rows[-1][0])
+        if not in_sync:
+            engine.reset()
+            rows = _read_rolling_rows(conn, columns, present, until_ms=live_start) + live_rows
+            if not rows:
+                return None
+            engine.apply_rows(rows, closed_before=rows[-1][0])
+
+        return engine.snapshot().reorder(pair_list)
+
+
+def nullable_columns(matrix):
+    """Колонки матрицы (или значения вектора) списками Python, NaN заменяется на None (null в JSON)"""
+    if not np.isnan(matrix).any():
+        return matrix.T.tolist()
+    values = matrix.T.astype(object)
+    values[np.isnan(matrix.T)] = None
+    return values.tolist()
+
+
+def slice_series(entry, since, series_keys):
+    """Копия записи ответа, в которой ряды series_keys обрезаны до точек с time >= since"""
+    sliced = {key: value for key, value in entry.items() if key != 'pairs'}
+    if 'time' in entry:
+        start = bisect_left(entry['time'], since)
+        for key in (*series_keys, 'time'):
+            sliced[key] = entry[key][start:]
+    else:
+        for key in series_keys:
+            points = entry[key]
+            sliced[key] = points[bisect_left(points, since, key=lambda point: point['time']):]
+    return sliced
+
+
+def window_start(result, default=None):
+    """Время первой точки рядов ответа (оси time или первого непустого ряда точек)"""
+    if 'time' in result:
+        return result['time'][0] if len(result['time']) else default
+    for key in LEGACY_SERIES_KEYS:
+        if result.get(key):
+            return result[key][0]['time']
+    return default
+
+
+@instrumentation.timed()
+def calculate_metrics(raw_data, pair=None):
+    """Метрики одной пары (по умолчанию - основной) в виде DataFrame и среднего соотношения"""
+    pair = pair or pairs.get_pairs()[0]
+    metrics = calculate_pair_metrics(raw_data, [pair])
+    if metrics is None:
+        return
 
-    return df, avg_ratio
+    base, quote = pair.base.lower(), pair.quote.lower()
+    df = pd.DataFrame({
+        'timestamp': metrics.timestamps,
+        pairs.asset_column(pair.base): metrics.prices[:, 0],
+        pairs.asset_column(pair.quote): metrics.prices[:, 1],
+        f'{base}_as_{quote}': metrics.base_as_quote[:, 0],
+        f'{base}_as_{quote}_norm': metrics.base_as_quote_norm[:, 0],
+        f'{quote}_norm': metrics.quote_norm[:, 0],
+        'percentage_diff_normalized': metrics.percentage_diff_normalized[:, 0],
+        'percentage_diff': metrics.percentage_diff[:, 0],
+    })
+
+    return df, float(metrics.avg_ratio[0])
@@ -1,102 +1,249 @@
-import sys
-from pathlib import Path
-
-import ccxt
+import json
 import sqlite3
-import pandas as pd
 from datetime import datetime, timedelta
 import time
 import logging
+import threading
+
+import numpy as np
+
+import alignment
+import fetcher
+import history_store
+import instrumentation
+import pairs
+import rollups
+import storage
+import venues
+from lazy_modules import lazy_import
+from metrics import epoch_ms
+from storage import ensure_market_table
+
+pd = lazy_import('pandas')
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-_exchange_instance = None  # Глобальная переменная для хранения экземпляра биржи
+_stream_exchange_instance = None  # Экземпляр биржи с websocket-потоками (ccxt.pro)
+_scheduler_instance = None  # Планировщик загрузки, общий для всех циклов обновления
+_data_version = 0  # Растёт после каждого зафиксированного обновления данных
+_data_version_lock = threading.Lock()
+
+# Площадка основных таблиц market_data_* в реестре venues
+MAIN_VENUE = 'binance_futures'
+# Окна хранения таблиц: таймфрейм свечей и глубина истории
+SYNC_WINDOWS = {
+    'market_data_24h': {'timeframe': '1m', 'hours': 24},
+    'market_data_180d': {'timeframe': '12h', 'days': 180},
+}
+# Сколько последних свечей перезапрашиваем, чтобы подхватить их ревизии
+SYNC_OVERLAP_CANDLES = 3
+# Секунды между проверками версии данных, опубликованной процессом загрузки
+DATA_VERSION_POLL_INTERVAL = 0.5
 
 
 def initialize_exchange():
-    """Инициализация подключения к бирже (Singleton)"""
-    global _exchange_instance
-    if _exchange_instance is None:  # Если объект ещё не создан, создаём его
-        _exchange_instance = ccxt.binance({
+    """
+    Клиент биржи основных таблиц - клиент площадки MAIN_VENUE из реестра venues:
+    синхронизация таблиц и свечи площадок расходуют один бюджет запросов
+    """
+    exchange, _ = venues.get_client(venues.VENUE_PRESETS[MAIN_VENUE])
+    return exchange
+
+
+def initialize_stream_exchange():
+    """Подключение к websocket-потокам биржи (Singleton)"""
+    global _stream_exchange_instance
+    if _stream_exchange_instance is None:
+        # ccxt.pro тяжелее REST-клиента, поэтому импортируется только в режиме потоков
+        import ccxt.pro as ccxtpro
+        _stream_exchange_instance = ccxtpro.binance({
             'enableRateLimit': True,
             'options': {'defaultType': 'future'}
         })
-    return _exchange_instance  # Возвращаем существующий экземпляр
-
-def get_db_path():
-    """Получает правильный путь к базе данных, учитывая запуск как EXE и удаляет 'lib\\library.zip' из пути"""
-    if hasattr(sys, '_MEIPASS'):
-        # Если программа упакована в EXE, извлекаем базу данных из архивированного файла
-        base_path = sys._MEIPASS
-    else:
-        # Если запущено как скрипт, используем текущую директорию
-        base_path = Path(__file__).parent
-
-    # Преобразуем путь в строку для дальнейших манипуляций
-    base_path_str = str(base_path)
-
-    # Удаляем 'lib\library.zip' из пути, если она там есть
-    if 'lib\\library.zip' in base_path_str:
-        base_path_str = base_path_str.replace('lib\\library.zip', '')
-
-    # Возвращаем путь, добавив 'market_data.db'
-    db_path = Path(base_path_str) / 'market_data.db'
-
-    return db_path
-
-def create_tables():
-    """Создание таблиц в SQLite"""
-    conn = sqlite3.connect("market_data.db")
-    cursor = conn.cursor()
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS market_data_24h (
-            timestamp TEXT  PRIMARY KEY,
-            close_btc REAL,
-            close_eth REAL
+    return _stream_exchange_instance
+
+def get_data_version():
+    """Текущая версия данных: меняется после каждого обновления таблиц"""
+    return _data_version
+
+
+def bump_data_version():
+    """Отмечает, что данные в таблицах изменились"""
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
+        return _data_version
+
+
+def publish_data_version():
+    """
+    Увеличивает версию данных, хранящуюся в базе: серверы в других процессах
+    отслеживают её через watch_published_version. Вызывается после того, как
+    обновление целиком записано, поэтому промежуточное состояние не публикуется.
+    """
+    with storage.connection() as conn, conn:
+        ensure_state_table(conn)
+        conn.execute(
+            "INSERT INTO data_state (key, value) VALUES ('data_version', 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+        )
+
+
+def get_published_version():
+    """Версия данных, опубликованная в базе, или None, если её ещё не публиковали"""
+    with storage.connection() as conn:
+        try:
+            row = conn.execute("SELECT value FROM data_state WHERE key = 'data_version'").fetchone()
+        except sqlite3.OperationalError:
+            # Таблицы ещё нет: процесс загрузки ни разу не публиковал версию
+            return None
+        return row[0] if row else None
+
+
+def watch_published_version(on_change, interval=DATA_VERSION_POLL_INTERVAL):
+    """
+    Фоновый поток, следящий за версией данных в базе: при её смене локальная
+    версия увеличивается (сбрасывая кеши ответов) и вызывается on_change().
+    Проверка - чтение одной строки, поэтому за одной базой могут следить
+    сколько угодно серверов.
+    """
+    def watcher():
+        last = get_published_version()
+        while True:
+            time.sleep(interval)
+            try:
+                version = get_published_version()
+            except sqlite3.Error as e:
+                logger.warning(f"Не удалось прочитать версию данных: {e}")
+                continue
+            if version == last:
+                continue
+            last = version
+            bump_data_version()
+            try:
+                on_change()
+            except Exception as e:
+                logger.error(f"Ошибка обработки новой версии данных: {e}")
+
+    thread = threading.Thread(target=watcher, daemon=True)
+    thread.start()
+    return thread
+
+
+def publish_metrics_snapshot(process):
+    """
+    Записывает в базу снимок метрик процесса без HTTP-сервера (ingest_worker.py):
+    серверы отдают его в /api/metrics с меткой process
+    """
+    body = json.dumps(instrumentation.snapshot())
+    with storage.connection() as conn, conn:
+        ensure_state_table(conn)
+        conn.execute(
+            "INSERT INTO metric_snapshots (process, updated_at, body) VALUES (?, ?, ?) "
+            "ON CONFLICT(process) DO UPDATE SET updated_at = excluded.updated_at, body = excluded.body",
+            (process, time.time(), body)
         )
-    ''')
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS market_data_180d (
-            timestamp TEXT PRIMARY KEY,
-            close_btc REAL,
-            close_eth REAL
+
+def read_metrics_snapshots():
+    """Источник метрик сервера: [(процесс, снимок), ...] процессов, публикующих метрики через базу"""
+    with storage.connection() as conn:
+        try:
+            rows = conn.execute("SELECT process, body FROM metric_snapshots ORDER BY process").fetchall()
+        except sqlite3.OperationalError:
+            # Таблицы ещё нет: процесс загрузки ни разу не публиковал метрики
+            return []
+    return [(process, json.loads(body)) for process, body in rows]
+
+
+def ensure_state_table(conn):
+    """Таблицы общих для процессов значений (версия данных) и снимков их метрик"""
+    conn.execute("CREATE TABLE IF NOT EXISTS data_state (key TEXT PRIMARY KEY, value INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS metric_snapshots (process TEXT PRIMARY KEY, updated_at REAL, body TEXT)")
+
+
+def create_tables(clear=False):
+    """Создание таблиц в SQLite (clear=True - полная очистка данных)"""
+    with storage.connection() as conn, conn:
+        # Схему могут одновременно проверять сервер и процесс загрузки - берём блокировку записи
+        conn.execute("BEGIN IMMEDIATE")
+        for table_name in SYNC_WINDOWS:
+            ensure_market_table(conn, table_name)
+
+        # Отметки последней сохранённой свечи по таблице и символу (мс, UTC)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                table_name TEXT,
+                symbol TEXT,
+                last_timestamp INTEGER,
+                PRIMARY KEY (table_name, symbol)
+            )
+        ''')
+        ensure_state_table(conn)
+        venues.ensure_venue_table(conn)
+        alignment.ensure_completeness_table(conn)
+
+        if clear:
+            for table_name in SYNC_WINDOWS:
+                conn.execute(f"DELETE FROM {table_name}")
+            conn.execute("DELETE FROM sync_state")
+            conn.execute("DELETE FROM venue_candles")
+
+        # Агрегаты хранят историю дольше минутных свечей, поэтому не очищаются
+        rollups.ensure_rollup_tables(conn)
+
+
+def get_sync_state(table_name, symbol):
+    """Возвращает отметку последней сохранённой свечи (мс) или None"""
+    with storage.connection() as conn:
+        row = conn.execute(
+            "SELECT last_timestamp FROM sync_state WHERE table_name = ? AND symbol = ?",
+            (table_name, symbol)
+        ).fetchone()
+        return row[0] if row else None
+
+
+def update_sync_state(table_name, symbol, last_timestamp):
+    """Сохраняет отметку последней сохранённой свечи (мс)"""
+    with storage.connection() as conn, conn:
+        conn.execute(
+            "INSERT INTO sync_state (table_name, symbol, last_timestamp) VALUES (?, ?, ?) "
+            "ON CONFLICT(table_name, symbol) DO UPDATE SET last_timestamp = excluded.last_timestamp",
+            (table_name, symbol, int(last_timestamp))
         )
-    ''')
 
-    # Очистка данных при запуске
-    cursor.execute("DELETE FROM market_data_24h")
-    cursor.execute("DELETE FROM market_data_180d")
 
-    conn.commit()
-    conn.close()
+def get_scheduler(exchange):
+    """Планировщик загрузки с общим бюджетом запросов: у клиента реестра venues - его планировщик"""
+    scheduler = venues.find_scheduler(exchange)
+    if scheduler is not None:
+        return scheduler
+    global _scheduler_instance
+    if _scheduler_instance is None or _scheduler_instance.exchange is not exchange:
+        _scheduler_instance = fetcher.FetchScheduler(exchange)
+    return _scheduler_instance
 
 
-def get_data(exchange, symbol, timeframe='1m', hours=None, days=None):
-    all_data = []
-    if hours:
-        since = int((datetime.utcnow() - timedelta(hours=hours - 3)).timestamp() * 1000)  # Время начала (за последние часы)
-    elif days:
-        since = int((datetime.utcnow() - timedelta(days=days)).timestamp() * 1000)  # Время начала (за последние дни)
+def get_timeframe_ms(timeframe):
+    """Длина свечи таймфрейма в мс: '1m' -> 60000"""
+    return pd.Timedelta(timeframe.replace('m', 'min')).value // 10 ** 6
 
-    while True:
-        ohlcv = exchange.fetch_ohlcv(symbol, timeframe=timeframe, since=since,
-                                     limit=1000)  # Binance ограничение в 1000 свечей
-        if not ohlcv:
-            break
 
-        df = pd.DataFrame(ohlcv, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-        all_data.append(df)
+def get_window_since(hours=None, days=None):
+    """Начало окна загрузки (мс) для заданной глубины истории"""
+    if hours:
+        return int((datetime.utcnow() - timedelta(hours=hours - 3)).timestamp() * 1000)  # Время начала (за последние часы)
+    return int((datetime.utcnow() - timedelta(days=days)).timestamp() * 1000)  # Время начала (за последние дни)
 
-        since = int(df['timestamp'].iloc[-1]) + 1  # Сдвигаем начало запроса на последнюю загруженную свечу
-        if len(df) < 1000:  # Если Binance вернул меньше 1000 свечей, значит данные закончились
-            break
 
-    # Объединяем все части данных
-    full_df = pd.concat(all_data, ignore_index=True)
+def ohlcv_to_frame(ohlcv):
+    """Преобразует свечи биржи в DataFrame с московским временем"""
+    if not ohlcv:
+        return pd.DataFrame(columns=['timestamp', 'close'])
+
+    full_df = pd.DataFrame(ohlcv, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
     full_df['timestamp'] = pd.to_datetime(full_df['timestamp'], unit='ms')
 
     full_df['timestamp'] = full_df['timestamp'].dt.tz_localize('UTC').dt.tz_convert(
@@ -105,59 +252,202 @@ def get_data(exchange, symbol, timeframe='1m', hours=None, days=None):
     return full_df[['timestamp', 'close']]
 
 
-def save_data_in_db(btc_data, eth_data, table_name):
-    """Вычисление метрик и сохранение в базу"""
-    if btc_data.empty or eth_data.empty:
-        logger.error("Ошибка: пустые данные")
-        return
-
-    merged = pd.merge(btc_data, eth_data, on='timestamp', suffixes=('_btc', '_eth'))
+def get_data(exchange, symbol, timeframe='1m', hours=None, days=None, since=None):
+    """Загружает свечи с биржи; since (мс) имеет приоритет над hours/days"""
+    if since is None:
+        since = get_window_since(hours, days)
 
-    # Преобразуем типы данных
-    merged['timestamp'] = pd.to_datetime(merged['timestamp'])
-    merged['close_btc'] = pd.to_numeric(merged['close_btc'], errors='coerce')
-    merged['close_eth'] = pd.to_numeric(merged['close_eth'], errors='coerce')
+    ohlcv = get_scheduler(exchange).fetch_one(symbol, timeframe, int(since))
+    return ohlcv_to_frame(ohlcv)
 
-    conn = sqlite3.connect("market_data.db")
 
-    # Проверяем существующие данные
-    existing = pd.read_sql(f"SELECT timestamp FROM {table_name}", conn)
+@instrumentation.timed()
+def save_data_in_db(frames, table_name, step_ms=None, tolerance=alignment.FILL_TOLERANCE_CANDLES):
+    """Сохранение цен активов в базу с перезаписью пересекающихся свечей.
 
-    # Фильтруем только новые данные
-    if not existing.empty:
-        merged = merged[~merged['timestamp'].isin(existing['timestamp'])]
-
-    if not merged.empty:
-        try:
-            # Добавляем только новые данные
-            merged[['timestamp', 'close_btc', 'close_eth']].to_sql(
-                table_name,
-                conn,
-                if_exists='append',
-                index=False
-            )
-            logger.info(f"Добавлено {len(merged)} записей в {table_name}")
-        except sqlite3.IntegrityError as e:
-            logger.error(f"Ошибка при вставке данных: {e}")
-    else:
+    frames - словарь {актив: DataFrame[timestamp, close]}. Ряды выравниваются на
+    регулярную сетку с шагом step_ms (по умолчанию - таймфрейм таблицы): пропуск
+    ряда заполняется его последней ценой не дальше tolerance свечей, строки
+    с более длинными пропусками не сохраняются. Полнота рядов записывается
+    в series_completeness. Возвращает время последней сохранённой свечи (мс, UTC) или None.
+    """
+    if not frames or any(df.empty for df in frames.values()):
+        logger.error("Ошибка: пустые данные")
+        return None
+
+    step_ms = step_ms or get_timeframe_ms(SYNC_WINDOWS[table_name]['timeframe'])
+    series = {
+        asset: (epoch_ms(df['timestamp']), pd.to_numeric(df['close'], errors='coerce').to_numpy(dtype=float))
+        for asset, df in frames.items()
+    }
+    grid, prices, stats = alignment.align_series(series, step_ms, tolerance)
+    with storage.connection() as conn:
+        alignment.record_completeness(conn, table_name, grid, stats)
+
+    complete = ~np.isnan(prices).any(axis=1)
+    if not complete.any():
         logger.info(f"Нет новых данных для {table_name}")
+        return None
+
+    rows = list(zip(grid[complete].tolist(), map(tuple, prices[complete].tolist())))
+    return save_candles(rows, table_name, list(frames))
+
+
+@instrumentation.timed()
+def save_candles(rows, table_name, assets):
+    """Сохранение строк [(timestamp в мс, цены в порядке assets), ...]; возвращает время последней"""
+    if not rows:
+        return None
+    try:
+        with storage.connection() as conn:
+            storage.upsert_rows(conn, table_name, assets, [(int(timestamp), *prices) for timestamp, prices in rows])
+            if table_name == rollups.SOURCE_TABLE:
+                # Агрегаты обновляются только в интервалах, затронутых новыми свечами
+                rollups.update_rollups(conn, min(row[0] for row in rows), max(row[0] for row in rows), assets)
+        logger.info(f"Записано {len(rows)} записей в {table_name}")
+        instrumentation.inc('rows_ingested_total', len(rows), table=table_name)
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при вставке данных: {e}")
+        return None
+
+    if table_name == rollups.SOURCE_TABLE:
+        # Минутные свечи копятся и в долгой истории, которая не обрезается окном 24h
+        try:
+            history_store.get_store().append_rows(rows, assets)
+        except OSError as e:
+            logger.error(f"Ошибка записи истории: {e}")
+    last_timestamp = int(max(row[0] for row in rows))
+    instrumentation.set_gauge('last_candle_timestamp_seconds', last_timestamp / 1000, table=table_name)
+    return last_timestamp
+
+
+def trim_table(table_name, hours=None, days=None):
+    """Удаляет записи, вышедшие за окно хранения таблицы"""
+    window = timedelta(hours=hours) if hours else timedelta(days=days)
+    cutoff = int(time.time()) * 1000 - int(window.total_seconds() * 1000)
+
+    with storage.connection() as conn, conn:
+        deleted = conn.execute(f"DELETE FROM {table_name} WHERE timestamp < ?", (cutoff,)).rowcount
+    if deleted:
+        logger.info(f"Удалено {deleted} устаревших записей из {table_name}")
+
+
+def get_sync_since(table_name, symbol, timeframe):
+    """Начало инкрементальной загрузки (мс) или None, если данных ещё нет"""
+    last_timestamp = get_sync_state(table_name, symbol)
+    if last_timestamp is None:
+        return None
+    return last_timestamp - SYNC_OVERLAP_CANDLES * get_timeframe_ms(timeframe)
+
+
+def refetch_gaps(scheduler, jobs, results):
+    """
+    Дозапрашивает только пропущенные свечи рядов (например, потерянные страницы):
+    пропуском считается отсутствие свечи там, где её получил другой актив той же таблицы.
+    Найденные свечи добавляются в results.
+    """
+    by_table = {}
+    for job in jobs:
+        by_table.setdefault(job.key[0], []).append(job)
+
+    retry = []
+    for table_jobs in by_table.values():
+        loaded = [results[job.key] for job in table_jobs if results[job.key]]
+        if not loaded:
+            continue
+        step_ms = get_timeframe_ms(table_jobs[0].timeframe)
+        start = min(ohlcv[0][0] for ohlcv in loaded)
+        end = max(ohlcv[-1][0] for ohlcv in loaded)
+        for job in table_jobs:
+            timestamps = [candle[0] for candle in results[job.key]]
+            for k, (gap_start, gap_end) in enumerate(alignment.find_gaps(timestamps, step_ms, start, end)):
+                retry.append(fetcher.FetchJob((job.key, k), job.symbol, job.timeframe, gap_start, gap_end))
+    if not retry:
+        return
 
-    conn.close()
-
-
-def main():
-    """Основная функция"""
+    logger.info(f"Дозапрос пропущенных свечей: {len(retry)} интервалов")
+    fetched = scheduler.fetch(retry)
+    for job in retry:
+        key = job.key[0]
+        merged = {candle[0]: candle for candle in results[key]}
+        merged.update((candle[0], candle) for candle in fetched[job.key])
+        results[key] = [merged[timestamp] for timestamp in sorted(merged)]
+
+
+@instrumentation.timed()
+def sync_tables(exchange):
+    """Догружает новые свечи во все таблицы и обрезает их по окнам хранения.
+
+    Ряды всех таблиц и активов загружаются одним параллельным пакетом. Таблицы,
+    которые покрываются минутной историей, пересчитываются из агрегатов без
+    обращения к бирже.
+    """
+    assets = pairs.get_assets()
+    jobs = []
+    derived = {}
+    for table_name, window in SYNC_WINDOWS.items():
+        symbols = [pairs.asset_symbol(asset) for asset in assets]
+        states = [get_sync_state(table_name, symbol) for symbol in symbols]
+        if None not in states:
+            with storage.connection() as conn:
+                start = rollups.derivable_since(conn, table_name, min(states))
+            if start is not None:
+                derived[table_name] = start
+                continue
+
+        # Строки хранят все активы сразу, поэтому окно загрузки общее для таблицы:
+        # новый актив без отметки подтягивает всю историю окна
+        marks = [get_sync_since(table_name, symbol, window['timeframe']) for symbol in symbols]
+        if None in marks:
+            since = get_window_since(window.get('hours'), window.get('days'))
+        else:
+            since = min(marks)
+        for asset in assets:
+            jobs.append(fetcher.FetchJob((table_name, asset), pairs.asset_symbol(asset), window['timeframe'], since))
+
+    scheduler = get_scheduler(exchange)
+    results = scheduler.fetch(jobs)
+    refetch_gaps(scheduler, jobs, results)
+    tolerance = alignment.get_fill_tolerance()
+
+    for table_name, window in SYNC_WINDOWS.items():
+        if table_name in derived:
+            continue
+        frames = {asset: ohlcv_to_frame(results[(table_name, asset)]) for asset in assets}
+
+        last_timestamp = save_data_in_db(frames, table_name, tolerance=tolerance)
+        if last_timestamp is not None:
+            for asset in assets:
+                update_sync_state(table_name, pairs.asset_symbol(asset), last_timestamp)
+
+    # Выводимые таблицы пересчитываются после записи минутных свечей
+    with storage.connection() as conn:
+        for table_name, start in derived.items():
+            last_timestamp = rollups.derive_table(conn, table_name, start, assets)
+            logger.info(f"Таблица {table_name} пересчитана из агрегатов с {storage.format_timestamp(start)}")
+            if last_timestamp is not None:
+                for asset in assets:
+                    update_sync_state(table_name, pairs.asset_symbol(asset), last_timestamp)
+        rollups.trim_rollups(conn)
+
+    for table_name, window in SYNC_WINDOWS.items():
+        trim_table(table_name, hours=window.get('hours'), days=window.get('days'))
+
+
+def main(full_refresh=False):
+    """Основная функция: инкрементальная синхронизация (full_refresh - загрузка с нуля)"""
     exchange = initialize_exchange()
 
-    create_tables()
-
-    btc_data_24h = get_data(exchange, 'BTC/USDT', '1m', hours=24)
-    eth_data_24h = get_data(exchange, 'ETH/USDT', '1m', hours=24)
-    btc_data_180d = get_data(exchange, 'BTC/USDT', '12h', days=180)
-    eth_data_180d = get_data(exchange, 'ETH/USDT', '12h', days=180)
+    create_tables(clear=full_refresh)
 
-    save_data_in_db(btc_data_24h, eth_data_24h, "market_data_24h")
-    save_data_in_db(btc_data_180d, eth_data_180d, "market_data_180d")
+    try:
+        sync_tables(exchange)
+        # Свечи других площадок нужны только для межплощадочного базиса
+        if len(venues.get_venues()) > 1:
+            venues.sync_venue_candles()
+    finally:
+        # Часть таблиц могла обновиться даже при ошибке
+        bump_data_version()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import instrumentation
+from lazy_modules import lazy_import
+
+ccxt = lazy_import('ccxt')
+logger = logging.getLogger(__name__)
+
+FETCH_LIMIT = 1000  # Binance ограничение в 1000 свечей на запрос
+MAX_WORKERS = 8
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5  # Секунды, удваиваются на каждой следующей попытке
+
+
+class FetchJob(NamedTuple):
+    """Задание на загрузку одного ряда свечей"""
+    key: object
+    symbol: str
+    timeframe: str
+    since: int  # мс, UTC
+    until: Optional[int] = None  # мс, UTC; по умолчанию - текущее время
+
+
+class RateLimiter:
+    """Общий бюджет запросов: не чаще одного запроса в interval секунд на все потоки"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class FetchScheduler:
+    """
+    Планировщик загрузки свечей: разбивает каждое задание на страницы по FETCH_LIMIT
+    свечей и загружает все страницы всех заданий параллельно в ограниченном пуле потоков.
+    """
+
+    def __init__(self, exchange, max_workers=MAX_WORKERS, rate_limit_ms=None):
+        self.exchange = exchange
+        self.max_workers = max_workers
+        if rate_limit_ms is None:
+            rate_limit_ms = getattr(exchange, 'rateLimit', 50)
+        self.limiter = RateLimiter(rate_limit_ms / 1000)
+
+    def fetch(self, jobs):
+        """Загружает задания и возвращает {job.key: [[timestamp, o, h, l, c, v], ...]}"""
+        jobs = list(jobs)
+        pages = [(job, start) for job in jobs for start in self._page_starts(job)]
+        if not pages:
+            return {job.key: [] for job in jobs}
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pages))) as pool:
+            futures = [
+                (job, pool.submit(self._fetch_page, job.symbol, job.timeframe, start))
+                for job, start in pages
+            ]
+            collected = {job.key: {} for job in jobs}
+            for job, future in futures:
+                for candle in future.result():
+                    if job.until is None or candle[0] <= job.until:
+                        # Повторная свеча из соседней страницы заменяется более свежей
+                        collected[job.key][candle[0]] = candle
+
+        return {key: [candles[ts] for ts in sorted(candles)] for key, candles in collected.items()}
+
+    def fetch_one(self, symbol, timeframe, since, until=None):
+        """Загружает один ряд свечей"""
+        return self.fetch([FetchJob(symbol, symbol, timeframe, since, until)])[symbol]
+
+    def _page_starts(self, job):
+        """Начала страниц задания: диапазон известен заранее, поэтому страницы независимы"""
+        timeframe_ms = self.exchange.parse_timeframe(job.timeframe) * 1000
+        until = job.until if job.until is not None else int(time.time() * 1000)
+        page_span = FETCH_LIMIT * timeframe_ms
+        return list(range(int(job.since), until + 1, page_span)) or [int(job.since)]
+
+    def _fetch_page(self, symbol, timeframe, since):
+        """Загрузка одной страницы с повторами и экспоненциальной задержкой"""
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.acquire()
+            try:
+                with instrumentation.span('get_data_page'):
+                    return self.exchange.fetch_ohlcv(symbol, timeframe=timeframe, since=since, limit=FETCH_LIMIT)
+            except ccxt.NetworkError as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = BACKOFF_BASE * 2 ** attempt
+                logger.warning(f"Ошибка загрузки {symbol} {timeframe} с {since}: {e}, повтор через {delay} с")
+                time.sleep(delay)
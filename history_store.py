@@ -0,0 +1,415 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import numpy as np
+
+import fetcher
+import pairs
+import storage
+from lazy_modules import lazy_import
+from metrics import pair_metrics_from_prices
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+HISTORY_DIR = storage.get_db_path().parent / 'history'
+TIMEFRAME = '1m'
+TIMEFRAME_MS = 60 * 1000
+GROW_SLOTS = 24 * 60  # Минутных слотов в файле суток
+DAY_MS = GROW_SLOTS * TIMEFRAME_MS
+BACKFILL_CHUNK = fetcher.FETCH_LIMIT * fetcher.MAX_WORKERS  # Свечей на шаг докачки
+
+_store_instance = None
+_store_lock = threading.Lock()
+
+
+class ColumnFile:
+    """
+    Колонка цен закрытия одного символа: каталог с файлом на каждые сутки (UTC),
+    в файле GROW_SLOTS float64 по минутам, пропуски - NaN. Метка слота вычисляется
+    из номера суток и слота, поэтому разметка файлов никогда не меняется и запись
+    из нескольких процессов не сдвигает чужие смещения. Запись идёт под файловой
+    блокировкой; рядом лежит JSON с меткой последней записанной свечи и
+    диапазонами, для которых у биржи заведомо нет свечей (gaps).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta_path = path / 'meta.json'
+        self.lock_path = path / '.lock'
+
+    def day_path(self, day):
+        return self.path / f'{day}.f8'
+
+    def days(self):
+        """Номера суток (от эпохи), для которых есть файлы"""
+        if not self.path.exists():
+            return []
+        return sorted(int(path.stem) for path in self.path.glob('*.f8'))
+
+    @property
+    def origin(self):
+        days = self.days()
+        return days[0] * DAY_MS if days else None
+
+    @property
+    def last_timestamp(self):
+        return self._load_meta().get('last')
+
+    def __len__(self):
+        days = self.days()
+        return (days[-1] - days[0] + 1) * GROW_SLOTS if days else 0
+
+    @contextmanager
+    def locked(self):
+        """Блокировка записи колонки, общая для всех процессов"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, 'a+b') as f:
+            _lock_file(f)
+            try:
+                yield
+            finally:
+                _unlock_file(f)
+
+    def write(self, timestamps, closes):
+        """Записывает свечи (мс, цена) в их слоты; существующие слоты перезаписываются"""
+        with self.locked():
+            self._write(timestamps, closes)
+
+    def _write(self, timestamps, closes):
+        # Вызывается только под блокировкой колонки
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        closes = np.asarray(closes, dtype=np.float64)
+        if not len(timestamps):
+            return
+        days = timestamps // DAY_MS
+        for day in np.unique(days).tolist():
+            mask = days == day
+            path = self.day_path(day)
+            if not path.exists():
+                # Читатели не блокируют файлы - новый файл появляется целиком
+                tmp = path.with_suffix('.tmp')
+                np.full(GROW_SLOTS, np.nan).tofile(tmp)
+                os.replace(tmp, path)
+            column = np.memmap(path, dtype=np.float64, mode='r+', shape=(GROW_SLOTS,))
+            column[(timestamps[mask] - day * DAY_MS) // TIMEFRAME_MS] = closes[mask]
+            column.flush()
+            del column
+
+        # Метка читается заново под блокировкой: её мог сдвинуть другой процесс
+        meta = self._load_meta()
+        last = int(timestamps.max())
+        meta['last'] = max(last, meta.get('last') or last)
+        meta['timeframe'] = TIMEFRAME
+        self._save_meta(meta)
+
+    def bounds(self, start=None, end=None):
+        """Первая и последняя минуты [start, end] (мс) в пределах файлов колонки или None"""
+        days = self.days()
+        if not days:
+            return None
+        first = days[0] * DAY_MS
+        if start is not None:
+            first = max(first, -(-int(start) // TIMEFRAME_MS) * TIMEFRAME_MS)
+        last = (days[-1] + 1) * DAY_MS - TIMEFRAME_MS
+        if end is not None:
+            last = min(last, int(end) // TIMEFRAME_MS * TIMEFRAME_MS)
+        return (first, last) if first <= last else None
+
+    def read(self, start=None, end=None):
+        """
+        Цены за [start, end] (мс): (метка первого слота, массив цен). Диапазон
+        внутри одних суток - view memmap без копирования; диапазон через несколько
+        суток копируется в новый массив.
+        """
+        bounds = self.bounds(start, end)
+        if bounds is None:
+            return None, np.empty(0)
+        first, last = bounds
+        day = first // DAY_MS
+        if last // DAY_MS == day and self.day_path(day).exists():
+            lo = (first - day * DAY_MS) // TIMEFRAME_MS
+            column = np.memmap(self.day_path(day), dtype=np.float64, mode='r', shape=(GROW_SLOTS,))
+            return first, column[lo:lo + (last - first) // TIMEFRAME_MS + 1]
+        values = np.empty((last - first) // TIMEFRAME_MS + 1)
+        self.copy_to(values, first)
+        return first, values
+
+    def copy_to(self, out, start):
+        """Копирует в out цены len(out) минут начиная со start (мс); минуты без файла суток - NaN"""
+        position = 0
+        while position < len(out):
+            timestamp = start + position * TIMEFRAME_MS
+            day = timestamp // DAY_MS
+            lo = (timestamp - day * DAY_MS) // TIMEFRAME_MS
+            count = min(GROW_SLOTS - lo, len(out) - position)
+            path = self.day_path(day)
+            if path.exists():
+                out[position:position + count] = np.memmap(path, dtype=np.float64, mode='r', shape=(GROW_SLOTS,))[lo:lo + count]
+            else:
+                out[position:position + count] = np.nan
+            position += count
+
+    def first_missing(self, start, end):
+        """
+        Метка первой минуты [start, end] без цены или None, если диапазон заполнен.
+        Минуты из известных пропусков биржи (gaps) не считаются отсутствующими.
+        """
+        start = -(-int(start) // TIMEFRAME_MS) * TIMEFRAME_MS
+        end = int(end) // TIMEFRAME_MS * TIMEFRAME_MS
+        if start > end:
+            return None
+        missing = np.isnan(self._slots(start, end)) & ~self._gap_mask(start, end)
+        index = np.flatnonzero(missing)
+        return start + int(index[0]) * TIMEFRAME_MS if len(index) else None
+
+    def record_gaps(self, start, end):
+        """
+        Отмечает минуты [start, end] без цены как известные пропуски биржи: она уже
+        отдала более поздние свечи, и повторная докачка их не запрашивает
+        """
+        start = -(-int(start) // TIMEFRAME_MS) * TIMEFRAME_MS
+        end = int(end) // TIMEFRAME_MS * TIMEFRAME_MS
+        if start > end:
+            return
+        with self.locked():
+            edges = np.diff(np.concatenate([[0], np.isnan(self._slots(start, end)).astype(np.int8), [0]]))
+            runs = zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+            gaps = [[start + int(lo) * TIMEFRAME_MS, start + int(hi - 1) * TIMEFRAME_MS] for lo, hi in runs]
+            if not gaps:
+                return
+            meta = self._load_meta()
+            meta['gaps'] = _merge_ranges(meta.get('gaps', []) + gaps)
+            self._save_meta(meta)
+            logger.info(f"{self.path.name}: известных пропусков биржи {len(meta['gaps'])}")
+
+    def _slots(self, start, end):
+        """Цены всех минут [start, end] (вне файлов - NaN), копия"""
+        values = np.empty((end - start) // TIMEFRAME_MS + 1)
+        self.copy_to(values, start)
+        return values
+
+    def _gap_mask(self, start, end):
+        mask = np.zeros((end - start) // TIMEFRAME_MS + 1, dtype=bool)
+        for first, last in self._load_meta().get('gaps', []):
+            lo, hi = max(first, start), min(last, end)
+            if lo <= hi:
+                mask[(lo - start) // TIMEFRAME_MS:(hi - start) // TIMEFRAME_MS + 1] = True
+        return mask
+
+    def import_legacy(self, legacy_path):
+        """Переносит колонку старого формата (один файл от origin) в файлы по суткам; только под locked()"""
+        meta_path = legacy_path.with_suffix('.json')
+        meta = json.loads(meta_path.read_text())
+        values = np.fromfile(legacy_path, dtype=np.float64)
+        present = np.flatnonzero(~np.isnan(values))
+        if len(present):
+            self._write(meta['origin'] + present * TIMEFRAME_MS, values[present])
+        legacy_path.unlink()
+        meta_path.unlink()
+        logger.info(f"История {legacy_path.name} перенесена в файлы по суткам: {len(present)} свечей")
+
+    def _load_meta(self):
+        try:
+            return json.loads(self.meta_path.read_text())
+        except FileNotFoundError:
+            return {}
+
+    def _save_meta(self, meta):
+        # Только под блокировкой колонки
+        tmp = self.meta_path.with_suffix('.json.tmp')
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, self.meta_path)
+
+
+def _merge_ranges(ranges):
+    """Объединение пересекающихся и смежных диапазонов минут [first, last]"""
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + TIMEFRAME_MS:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+    else:
+        # Windows: блокировка первого байта, msvcrt повторяет попытки сам
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class HistoryStore:
+    """
+    Долгая история минутных свечей вне SQLite: каталог с колонкой на символ.
+    Дописывается при каждой синхронизации и докачкой backfill; читается
+    срезами memmap прямо в матрицу цен для расчёта метрик.
+    """
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self._columns = {}
+        self._lock = threading.Lock()
+
+    def column(self, asset):
+        with self._lock:
+            if asset not in self._columns:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                name = pairs.asset_symbol(asset).replace('/', '_')
+                column = ColumnFile(self.directory / f'{name}.{TIMEFRAME}')
+                legacy = self.directory / f'{name}.{TIMEFRAME}.f8'
+                if legacy.exists():
+                    with column.locked():
+                        if legacy.exists():
+                            column.import_legacy(legacy)
+                self._columns[asset] = column
+            return self._columns[asset]
+
+    def append(self, asset, timestamps, closes):
+        column = self.column(asset)
+        with self._lock:
+            column.write(timestamps, closes)
+
+    def append_rows(self, rows, assets):
+        """Дописывает строки [(timestamp в мс, цены в порядке assets), ...]"""
+        if not rows:
+            return
+        timestamps = [row[0] for row in rows]
+        closes = np.array([row[1] for row in rows], dtype=np.float64)
+        for i, asset in enumerate(assets):
+            self.append(asset, timestamps, closes[:, i])
+
+    def view(self, asset, start=None, end=None):
+        """
+        Цены одного актива за [start, end] (мс): (метка первой, массив). В пределах
+        одних суток - view memmap без копирования, иначе копия.
+        """
+        return self.column(asset).read(start, end)
+
+    def load_prices(self, assets, start=None, end=None):
+        """
+        Выровненная матрица цен активов за [start, end]: (метки в мс, матрица).
+        Минуты, где нет цены хотя бы одного актива, отбрасываются. Колонки активов
+        лежат в разных файлах, поэтому матрица - копия: суточные memmap копируются
+        прямо в её столбцы, без промежуточных массивов.
+        """
+        columns = [self.column(asset) for asset in assets]
+        bounds = [column.bounds(start, end) for column in columns]
+        if any(bound is None for bound in bounds):
+            return np.empty(0, dtype=np.int64), np.empty((0, len(assets)))
+
+        # Колонки начинаются в разных слотах - берём общий диапазон
+        begin = max(first for first, _ in bounds)
+        stop = min(last for _, last in bounds) + TIMEFRAME_MS
+        if begin >= stop:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(assets)))
+        count = (stop - begin) // TIMEFRAME_MS
+        prices = np.empty((count, len(assets)))
+        for k, column in enumerate(columns):
+            column.copy_to(prices[:, k], begin)
+        timestamps = begin + np.arange(count, dtype=np.int64) * TIMEFRAME_MS
+        present = ~np.isnan(prices).any(axis=1)
+        return timestamps[present], prices[present]
+
+    def load_metrics(self, pair_list=None, start=None, end=None):
+        """PairMetrics пар по истории за [start, end] (мс) или None, если данных нет"""
+        pair_list = pair_list or pairs.get_pairs()
+        timestamps, prices = self.load_prices(pairs.get_assets(pair_list), start, end)
+        if not len(timestamps):
+            return None
+        return pair_metrics_from_prices(pd.Series(pd.to_datetime(timestamps, unit='ms', utc=True)), prices, pair_list)
+
+    def last_timestamp(self, asset):
+        return self.column(asset).last_timestamp
+
+
+def get_store():
+    """Хранилище истории (Singleton)"""
+    global _store_instance
+    with _store_lock:
+        if _store_instance is None:
+            _store_instance = HistoryStore()
+        return _store_instance
+
+
+def backfill(exchange, assets=None, since=None, until=None, store=None):
+    """
+    Докачка минутной истории в хранилище с since (мс) до until. Загрузка каждого
+    актива начинается с первой минуты без цены, поэтому прерванную докачку
+    достаточно запустить снова. Минуты, которых нет у биржи, хотя более поздние
+    свечи она уже отдала, запоминаются как пропуски, и следующая докачка их
+    пропускает. Возвращает число записанных свечей.
+    """
+    assets = assets or pairs.get_assets()
+    store = store or get_store()
+    until = until if until is not None else int(time.time() * 1000)
+    scheduler = fetcher.FetchScheduler(exchange)
+
+    written = 0
+    for asset in assets:
+        column = store.column(asset)
+        start = since if since is not None else column.origin
+        if start is None:
+            raise ValueError(f"Для {asset} нет истории - нужно указать начало докачки")
+        # Продолжение прерванной докачки с первой отсутствующей минуты
+        cursor = column.first_missing(start, until)
+        if cursor is None:
+            continue
+
+        # Шагами по BACKFILL_CHUNK свечей: каждый шаг загружается параллельно и сразу сохраняется
+        gap_from = cursor
+        while cursor <= until:
+            chunk_end = min(until, cursor + BACKFILL_CHUNK * TIMEFRAME_MS - 1)
+            candles = scheduler.fetch_one(pairs.asset_symbol(asset), TIMEFRAME, cursor, chunk_end)
+            if candles:
+                store.append(asset, [c[0] for c in candles], [c[4] for c in candles])
+                written += len(candles)
+                column.record_gaps(gap_from, candles[-1][0])
+                gap_from = candles[-1][0] + TIMEFRAME_MS
+            logger.info(f"{asset}: история загружена до {storage.format_timestamp(chunk_end)}")
+            cursor = chunk_end + 1
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Хранилище долгой истории минутных свечей")
+    commands = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = commands.add_parser('backfill', help="Докачать историю с биржи")
+    backfill_parser.add_argument('--days', type=int, default=30, help="Глубина истории, дней")
+    backfill_parser.add_argument('--assets', help="Активы через запятую (по умолчанию - активы пар)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'backfill':
+        import db_utils
+        assets = [asset.strip().upper() for asset in args.assets.split(',')] if args.assets else None
+        since = int(time.time() * 1000) - args.days * 24 * 60 * TIMEFRAME_MS
+        written = backfill(db_utils.initialize_exchange(), assets, since)
+        logger.info(f"Докачка завершена: {written} свечей")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import logging
+import time
+
+import alerts
+import db_utils
+import instrumentation
+import live_feed
+import pairs
+from data_processor import DataProcessor
+
+logger = logging.getLogger(__name__)
+
+UPDATE_INTERVAL = 60  # Секунды между синхронизациями с биржей
+METRICS_PROCESS = 'ingest'  # Метка process метрик этого процесса в /api/metrics серверов
+
+
+def init_alerts():
+    """
+    Правила оповещений проверяются только здесь, один раз на все серверы: срабатывания
+    уходят в журнал, на webhook и в таблицу alert_events, откуда серверы
+    пересылают их своим подписчикам
+    """
+    engine = alerts.get_engine()
+    for sink in alerts.delivery_sinks(shared=True):
+        engine.add_sink(sink)
+
+
+def evaluate_alerts():
+    """Проверка правил на записанных данных (тот же колоночный ответ, что получают серверы)"""
+    engine = alerts.get_engine()
+    if not engine.rules:
+        return
+    result = DataProcessor.get_processed_data(pairs.get_pairs(), 'columnar')
+    if result is not None:
+        engine.evaluate(result)
+
+
+def publish():
+    """
+    Проверяет оповещения и публикует версию данных: сервер, узнав о новой версии,
+    уже находит её срабатывания в базе. Снимок метрик загрузки публикуется
+    через базу - своего HTTP-сервера у процесса нет.
+    """
+    try:
+        evaluate_alerts()
+    except Exception as e:
+        logger.error(f"Ошибка проверки оповещений: {e}")
+    db_utils.publish_data_version()
+    try:
+        db_utils.publish_metrics_snapshot(METRICS_PROCESS)
+    except Exception as e:
+        logger.error(f"Ошибка публикации метрик: {e}")
+
+
+def run_once():
+    """Одна синхронизация таблиц с публикацией новой версии данных"""
+    started = time.perf_counter()
+    db_utils.main()
+    instrumentation.set_gauge('updater_last_success_timestamp_seconds', time.time())
+    publish()
+    logger.info(f"Данные обновлены за {time.perf_counter() - started:.1f} с")
+
+
+def run(interval=UPDATE_INTERVAL, live=False):
+    """
+    Отдельный процесс загрузки: синхронизирует базу раз в interval секунд и
+    публикует версию данных, за которой следят серверы (run_server.py
+    --external-ingest). Один процесс загрузки обслуживает любое число серверов.
+    live=True - закрытые свечи из websocket-потоков пишутся и публикуются
+    по мере прихода, не дожидаясь синхронизации.
+    """
+    if live:
+        live_feed.start_ingestor(on_flush=publish)
+    while True:
+        try:
+            run_once()
+        except Exception as e:
+            logger.error(f"Ошибка обновления данных: {e}")
+        time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Процесс загрузки данных с биржи для серверов run_server.py")
+    parser.add_argument('--interval', type=float, default=UPDATE_INTERVAL, help="Секунды между синхронизациями")
+    parser.add_argument('--live', action='store_true', help="Дополнительно принимать цены из websocket-потоков")
+    parser.add_argument('--once', action='store_true', help="Одна синхронизация и выход")
+    args = parser.parse_args(argv)
+
+    init_alerts()
+    if args.once:
+        run_once()
+    else:
+        run(args.interval, args.live)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
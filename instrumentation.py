@@ -0,0 +1,201 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+PREFIX = 'spread_monitor_'
+# Границы корзин гистограмм длительности, секунды
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DESCRIPTIONS = {
+    'span_seconds': "Длительность этапов обработки",
+    'http_request_duration_seconds': "Длительность обработки HTTP-запросов",
+    'http_requests_total': "Число HTTP-запросов",
+    'rows_ingested_total': "Число записанных строк свечей",
+    'cache_requests_total': "Обращения к кешу ответов",
+    'cache_hit_ratio': "Доля попаданий в кеш ответов",
+    'updater_last_success_timestamp_seconds': "Время последнего успешного обновления данных",
+    'updater_lag_seconds': "Секунд с последнего успешного обновления данных",
+    'last_candle_timestamp_seconds': "Время последней записанной свечи",
+    'data_lag_seconds': "Отставание последней записанной свечи от текущего времени",
+    'stream_subscribers': "Подписчики /api/stream",
+    'candles_filled_total': "Свечи, заполненные последней ценой ряда при выравнивании",
+    'candles_missing_total': "Свечи сетки, которые не удалось заполнить при выравнивании",
+    'series_completeness_ratio': "Доля точных свечей ряда в последней записанной пачке",
+}
+
+# Отметки времени и отставания от них, вычисляемые при выдаче
+LAG_GAUGES = {
+    'updater_last_success_timestamp_seconds': 'updater_lag_seconds',
+    'last_candle_timestamp_seconds': 'data_lag_seconds',
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (имя, метки) -> Histogram
+_counters = {}  # (имя, метки) -> значение
+_gauges = {}  # (имя, метки) -> значение
+_collectors = []  # Функции, возвращающие значения, вычисляемые в момент выдачи
+_sources = []  # Функции, возвращающие снимки метрик других процессов
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: наблюдение стоит O(log числа корзин)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Накопленные счётчики корзин [(граница, число), ...] в формате Prometheus"""
+        total = 0
+        result = []
+        for bound, count in zip((*self.buckets, float('inf')), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def observe(name, value, **labels):
+    """Добавляет наблюдение в гистограмму name с метками labels"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def get_gauge(name, **labels):
+    with _lock:
+        return _gauges.get((name, tuple(sorted(labels.items()))))
+
+
+@contextmanager
+def span(name, **labels):
+    """Замер длительности блока: with span('save_data_in_db'): ..."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('span_seconds', time.perf_counter() - started, span=name, **labels)
+
+
+def timed(name=None):
+    """Декоратор: длительность каждого вызова функции в span_seconds{span=name}"""
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_collector(collector):
+    """collector() -> [(имя, тип, метки, значение), ...] вызывается при каждой выдаче метрик"""
+    _collectors.append(collector)
+
+
+def register_source(source):
+    """
+    source() -> [(процесс, снимок snapshot()), ...] вызывается при каждой выдаче метрик:
+    так отдаются метрики процессов без своего HTTP-сервера. Их ряды получают метку process.
+    """
+    _sources.append(source)
+
+
+def snapshot():
+    """Накопленные гистограммы, счётчики и показатели процесса в виде, пригодном для JSON"""
+    with _lock:
+        return {
+            'histograms': [[name, labels, h.buckets, list(h.counts), h.sum, h.count] for (name, labels), h in _histograms.items()],
+            'counters': [[name, labels, value] for (name, labels), value in _counters.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in _gauges.items()],
+        }
+
+
+def _snapshot_items(data, extra=()):
+    # Метки после JSON приходят списками пар - приводим к кортежам и добавляем extra
+    def labels(pairs):
+        return tuple(sorted((*(tuple(pair) for pair in pairs), *extra)))
+
+    histograms = []
+    for name, pairs, buckets, counts, total, count in data['histograms']:
+        histogram = Histogram(buckets)
+        histogram.counts = list(counts)
+        histograms.append((name, labels(pairs), histogram.cumulative(), total, count))
+    samples = [(name, 'counter', labels(pairs), value) for name, pairs, value in data['counters']]
+    samples += [(name, 'gauge', labels(pairs), value) for name, pairs, value in data['gauges']]
+    return histograms, samples
+
+
+def render_prometheus():
+    """Все метрики в текстовом формате Prometheus (свои и зарегистрированных источников)"""
+    now = time.time()
+    histograms, samples = _snapshot_items(snapshot())
+    for source in _sources:
+        for process, data in source():
+            more_histograms, more_samples = _snapshot_items(data, (('process', process),))
+            histograms += more_histograms
+            samples += more_samples
+
+    # Отставания считаются на момент запроса
+    samples += [
+        (LAG_GAUGES[name], 'gauge', labels, now - value)
+        for name, kind, labels, value in list(samples) if name in LAG_GAUGES
+    ]
+    for collector in _collectors:
+        samples += [(name, kind, tuple(sorted(labels.items())), value) for name, kind, labels, value in collector()]
+
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in DESCRIPTIONS:
+                lines.append(f"# HELP {PREFIX}{name} {DESCRIPTIONS[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    for name, labels, buckets, total, count in sorted(histograms, key=lambda item: item[:2]):
+        header(name, 'histogram')
+        for bound, value in buckets:
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels + (('le', le),))} {value}")
+        lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+    for name, kind, labels, value in sorted(samples, key=lambda item: (item[0], item[2])):
+        header(name, kind)
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
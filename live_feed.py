@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import threading
+import time
+
+import db_utils
+import pairs
+
+logger = logging.getLogger(__name__)
+
+LIVE_TABLE = 'market_data_24h'
+LIVE_TIMEFRAME = '1m'
+TIMEFRAME_MS = 60 * 1000
+FLUSH_INTERVAL = 5  # Секунды между пакетной записью закрытых свечей в БД
+UPDATE_INTERVAL = 0.5  # Секунды между уведомлениями об изменении незакрытой свечи
+RECONNECT_DELAY = 5
+
+_ingestor_instance = None  # Запущенный приём потока цен
+
+
+class CandleAggregator:
+    """
+    Сборка строк свечей из обновлений потока: тики и обновления свечей каждого
+    актива складываются в незакрытые свечи, общие для всех активов по времени начала.
+
+    Строка закрывается, когда все активы перешли к более поздним свечам, либо
+    (если поток одного актива отстаёт) через одну свечу после самой свежей.
+    Пропуски актива в закрытой строке заполняются его предыдущей ценой.
+    """
+
+    def __init__(self, assets, timeframe_ms=TIMEFRAME_MS):
+        self.assets = list(assets)
+        self.timeframe_ms = timeframe_ms
+        self._lock = threading.Lock()
+        self._open = {}  # начало свечи -> {актив: цена закрытия}
+        self._latest = {}  # актив -> начало его последней свечи
+        self._closed = []  # закрытые, ещё не сохранённые строки [(timestamp, prices)]
+        self._carry = {}  # последние цены активов в закрытых строках
+        self._closed_until = None  # свечи с началом раньше этой метки закрыты
+
+    def add_tick(self, asset, timestamp, price):
+        """Сделка (timestamp в мс) - обновляет цену закрытия её свечи"""
+        timestamp = int(timestamp)
+        return self._update(asset, timestamp - timestamp % self.timeframe_ms, float(price))
+
+    def update_candle(self, asset, candle):
+        """Обновление свечи из watch_ohlcv: [timestamp, open, high, low, close, volume]"""
+        return self._update(asset, int(candle[0]), float(candle[4]))
+
+    def closed_rows(self):
+        """Закрытые строки, ещё не отмеченные как сохранённые"""
+        with self._lock:
+            return list(self._closed)
+
+    def discard_closed(self, until):
+        """Убирает сохранённые закрытые строки с timestamp <= until"""
+        with self._lock:
+            self._closed = [row for row in self._closed if row[0] > until]
+
+    def current_rows(self):
+        """Несохранённые закрытые строки и незакрытые строки; последняя - текущая свеча"""
+        with self._lock:
+            rows = list(self._closed)
+            carry = dict(self._carry)
+            for timestamp in sorted(self._open):
+                prices = self._fill(self._open[timestamp], carry)
+                if prices is not None:
+                    rows.append((timestamp, prices))
+            return rows
+
+    def _update(self, asset, timestamp, price):
+        with self._lock:
+            if self._closed_until is not None and timestamp < self._closed_until:
+                # Запоздавшее обновление уже закрытой свечи
+                return False
+            self._open.setdefault(timestamp, {})[asset] = price
+            self._latest[asset] = max(self._latest.get(asset, timestamp), timestamp)
+            self._close_rows()
+            return True
+
+    def _close_rows(self):
+        horizon = max(self._latest.values()) - self.timeframe_ms
+        if len(self._latest) == len(self.assets):
+            horizon = max(horizon, min(self._latest.values()))
+
+        for timestamp in sorted(t for t in self._open if t < horizon):
+            prices = self._fill(self._open.pop(timestamp), self._carry)
+            if prices is not None:
+                self._closed.append((timestamp, prices))
+        if self._closed_until is None or horizon > self._closed_until:
+            self._closed_until = horizon
+
+    def _fill(self, row, carry):
+        """Цены строки в порядке self.assets с заполнением пропусков из carry (обновляется)"""
+        prices = tuple(row.get(asset, carry.get(asset)) for asset in self.assets)
+        if None in prices:
+            return None
+        carry.update(zip(self.assets, prices))
+        return prices
+
+
+class ReplayExchange:
+    """
+    Воспроизведение записанного потока с интерфейсом watch_ohlcv ccxt.pro для
+    локальной проверки без биржи. updates - {symbol: [свеча, ...]}: каждый вызов
+    watch_ohlcv возвращает следующее обновление; по окончании записи - EOFError.
+    """
+
+    def __init__(self, updates, interval=0.0):
+        self.interval = interval
+        self._updates = {symbol: list(candles) for symbol, candles in updates.items()}
+        self._positions = dict.fromkeys(self._updates, 0)
+
+    async def watch_ohlcv(self, symbol, timeframe=LIVE_TIMEFRAME, since=None, limit=None):
+        position = self._positions.get(symbol, 0)
+        candles = self._updates.get(symbol, [])
+        if position >= len(candles):
+            raise EOFError(f"Запись потока {symbol} закончилась")
+        await asyncio.sleep(self.interval)
+        self._positions[symbol] = position + 1
+        return [candles[position]]
+
+    async def close(self):
+        pass
+
+
+class LiveIngestor:
+    """
+    Приём цен из websocket-потоков биржи (watch_ohlcv) в отдельном потоке с
+    собственным циклом asyncio. Незакрытая свеча доступна сразу через
+    current_rows(), закрытые свечи пишутся в БД пакетами раз в flush_interval.
+    После изменений версия данных увеличивается и вызывается on_update
+    (не чаще раза в UPDATE_INTERVAL), после записи закрытых свечей - on_flush.
+    """
+
+    def __init__(self, exchange, assets=None, table_name=LIVE_TABLE, flush_interval=FLUSH_INTERVAL, on_update=None,
+                 on_flush=None):
+        self.exchange = exchange
+        self.assets = list(assets or pairs.get_assets())
+        self.table_name = table_name
+        self.flush_interval = flush_interval
+        self.on_update = on_update
+        self.on_flush = on_flush
+        self.aggregator = CandleAggregator(self.assets)
+        self._changed = False
+        self._loop = None
+        self._task = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        logger.info(f"Приём потока цен запущен: {', '.join(self.assets)}")
+        return self._thread
+
+    def stop(self, timeout=None):
+        """Останавливает приём и сохраняет закрытые свечи"""
+        if self._loop is not None and self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        """Цикл приёма до остановки или окончания всех потоков"""
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._task = self._loop.create_task(self._run())
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+            self.flush()
+            self._notify()
+
+    def flush(self):
+        """Пакетная запись закрытых свечей в БД"""
+        rows = self.aggregator.closed_rows()
+        last_timestamp = db_utils.save_candles(rows, self.table_name, self.assets)
+        if last_timestamp is None:
+            return 0
+        for asset in self.assets:
+            db_utils.update_sync_state(self.table_name, pairs.asset_symbol(asset), last_timestamp)
+        # Строки убираются из памяти только после записи: читатель видит их всегда
+        self.aggregator.discard_closed(last_timestamp)
+        if self.on_flush is not None:
+            try:
+                self.on_flush()
+            except Exception as e:
+                logger.error(f"Ошибка обработки записи свечей потока: {e}")
+        return len(rows)
+
+    def current_rows(self, assets):
+        """Строки потока с ценами в порядке assets; [] если какой-то актив не принимается"""
+        if any(asset not in self.assets for asset in assets):
+            return []
+        indices = [self.assets.index(asset) for asset in assets]
+        return [
+            (timestamp, tuple(prices[i] for i in indices))
+            for timestamp, prices in self.aggregator.current_rows()
+        ]
+
+    async def _run(self):
+        watchers = [asyncio.create_task(self._watch(asset)) for asset in self.assets]
+        publisher = asyncio.create_task(self._publish())
+        try:
+            await asyncio.gather(*watchers)
+        finally:
+            publisher.cancel()
+            for watcher in watchers:
+                watcher.cancel()
+            if hasattr(self.exchange, 'close'):
+                await self.exchange.close()
+
+    async def _watch(self, asset):
+        symbol = pairs.asset_symbol(asset)
+        while True:
+            try:
+                candles = await self.exchange.watch_ohlcv(symbol, LIVE_TIMEFRAME)
+            except EOFError:
+                logger.info(f"Поток {symbol} завершён")
+                return
+            except Exception as e:
+                logger.warning(f"Ошибка потока {symbol}: {e}, переподключение через {RECONNECT_DELAY} с")
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            for candle in candles:
+                self.aggregator.update_candle(asset, candle)
+            self._changed = True
+
+    async def _publish(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            await asyncio.sleep(UPDATE_INTERVAL)
+            if time.monotonic() >= next_flush:
+                await asyncio.to_thread(self.flush)
+                next_flush = time.monotonic() + self.flush_interval
+            await asyncio.to_thread(self._notify)
+
+    def _notify(self):
+        if not self._changed:
+            return
+        self._changed = False
+        db_utils.bump_data_version()
+        if self.on_update is not None:
+            try:
+                self.on_update()
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления потока: {e}")
+
+
+def start_ingestor(exchange=None, on_update=None, on_flush=None):
+    """Запускает приём потока цен (Singleton); по умолчанию - websocket-потоки биржи"""
+    global _ingestor_instance
+    if _ingestor_instance is None:
+        _ingestor_instance = LiveIngestor(
+            exchange or db_utils.initialize_stream_exchange(), on_update=on_update, on_flush=on_flush
+        )
+        _ingestor_instance.start()
+    return _ingestor_instance
+
+
+def stop_ingestor():
+    global _ingestor_instance
+    if _ingestor_instance is not None:
+        _ingestor_instance.stop()
+        _ingestor_instance = None
+
+
+def current_rows(assets):
+    """Несохранённые строки потока [(timestamp, prices), ...] или [] вне режима потока"""
+    if _ingestor_instance is None:
+        return []
+    return _ingestor_instance.current_rows(assets)
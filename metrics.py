@@ -0,0 +1,175 @@
+import logging
+from typing import NamedTuple
+
+import numpy as np
+
+import instrumentation
+import pairs
+from lazy_modules import lazy_import
+from normalization import min_max_scale
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+
+class PairMetrics(NamedTuple):
+    """Метрики всех пар на выровненной матрице цен: строки - время, колонки - пары"""
+    timestamps: 'pd.Series'
+    assets: list
+    pairs: list
+    prices: np.ndarray
+    avg_ratio: np.ndarray
+    base_as_quote: np.ndarray
+    base_as_quote_norm: np.ndarray
+    quote_norm: np.ndarray
+    percentage_diff_normalized: np.ndarray
+    percentage_diff: np.ndarray
+
+    def asset_indices(self):
+        """Индексы колонок base и quote каждой пары в матрице цен"""
+        base_idx = np.array([self.assets.index(pair.base) for pair in self.pairs], dtype=int)
+        quote_idx = np.array([self.assets.index(pair.quote) for pair in self.pairs], dtype=int)
+        return base_idx, quote_idx
+
+    def reorder(self, pair_list):
+        """Те же метрики с парами (и активами) в порядке pair_list - перестановки self.pairs"""
+        pair_list = list(pair_list)
+        if pair_list == self.pairs:
+            return self
+        order = [self.pairs.index(pair) for pair in pair_list]
+        assets = pairs.get_assets(pair_list)
+        return self._replace(
+            assets=assets,
+            pairs=pair_list,
+            prices=self.prices[:, [self.assets.index(asset) for asset in assets]],
+            **{field: getattr(self, field)[..., order] for field in PAIR_FIELDS},
+        )
+
+
+# Поля PairMetrics с отдельным значением (колонкой) на каждую пару
+PAIR_FIELDS = ('avg_ratio', 'base_as_quote', 'base_as_quote_norm', 'quote_norm',
+               'percentage_diff_normalized', 'percentage_diff')
+
+
+def epoch_ms(timestamps):
+    """Unix-время в миллисекундах для ряда дат (наивные даты считаются UTC)"""
+    index = pd.DatetimeIndex(timestamps)
+    if index.tz is None:
+        index = index.tz_localize('UTC')
+    return index.as_unit('ns').asi8 // 10 ** 6
+
+
+def epoch_seconds(timestamps):
+    """Unix-время в секундах для ряда дат (наивные даты считаются UTC)"""
+    return epoch_ms(timestamps) // 1000
+
+
+def to_datetimes(timestamps):
+    """Ряд дат из меток времени таблиц: INTEGER (мс, UTC) или прежний текстовый формат"""
+    if pd.api.types.is_numeric_dtype(timestamps):
+        return pd.to_datetime(timestamps, unit='ms', utc=True)
+    return pd.to_datetime(timestamps)
+
+
+@instrumentation.timed()
+def calculate_pair_metrics(raw_data, pair_list=None):
+    """Вычисление метрик всех пар за один векторизованный проход по матрице цен"""
+    if not raw_data:
+        logger.error("Ошибка: пустые данные")
+        return
+
+    pair_list = pair_list or pairs.get_pairs()
+    assets = pairs.get_assets(pair_list)
+    columns = [pairs.asset_column(asset) for asset in assets]
+
+    # Преобразуем список словарей в DataFrame
+    df = pd.DataFrame(raw_data)
+
+    # Проверяем, есть ли все нужные колонки
+    if not {'timestamp', *columns}.issubset(df.columns):
+        logger.error("Ошибка: отсутствуют необходимые столбцы")
+        return
+
+    # Преобразуем timestamp в datetime и сортируем по времени
+    df['timestamp'] = to_datetimes(df['timestamp'])
+    df = df.sort_values('timestamp', ignore_index=True)
+    prices = df[columns].to_numpy(dtype=float)
+
+    # Пропуск цены актива - NaN только в рядах его пар; строка отбрасывается,
+    # если ни у одной пары нет обеих цен
+    keep = pairs_present(prices, assets, pair_list).any(axis=1)
+    return pair_metrics_from_prices(df['timestamp'][keep].reset_index(drop=True), prices[keep], pair_list)
+
+
+def pairs_present(prices, assets, pair_list):
+    """Маска (строки, пары): у пары в строке есть обе цены"""
+    base_idx = [assets.index(pair.base) for pair in pair_list]
+    quote_idx = [assets.index(pair.quote) for pair in pair_list]
+    return ~(np.isnan(prices[:, base_idx]) | np.isnan(prices[:, quote_idx]))
+
+
+def column_means(values):
+    """Средние по колонкам без учёта NaN (NaN для колонки без значений)"""
+    valid = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(valid, values, 0.0).sum(axis=0) / valid.sum(axis=0)
+
+
+def pair_metrics_from_prices(timestamps, prices, pair_list=None):
+    """
+    Метрики пар по готовой матрице цен (строки - время, колонки - активы get_assets(pair_list)).
+    NaN цены не участвуют в средних и min/max и дают NaN в рядах своих пар.
+    """
+    pair_list = pair_list or pairs.get_pairs()
+    assets = pairs.get_assets(pair_list)
+    metrics = PairMetrics(timestamps, assets, list(pair_list), prices, *([None] * 6))
+    base_idx, quote_idx = metrics.asset_indices()
+    base = prices[:, base_idx]
+    quote = prices[:, quote_idx]
+
+    # Среднее соотношение base/quote по каждой паре
+    avg_ratio = np.round(column_means(base / quote), 2)
+
+    # base в единицах quote
+    base_as_quote = np.round(base / avg_ratio, 2)
+
+    # Нормализация всех колонок разом
+    scaled = min_max_scale(np.hstack([base_as_quote, quote]))
+    base_as_quote_norm = scaled[:, :len(pair_list)]
+    quote_norm = scaled[:, len(pair_list):]
+
+    return metrics._replace(
+        avg_ratio=avg_ratio,
+        base_as_quote=base_as_quote,
+        base_as_quote_norm=base_as_quote_norm,
+        quote_norm=quote_norm,
+        # Разница нормализованных значений
+        percentage_diff_normalized=base_as_quote_norm - quote_norm,
+        percentage_diff=base_as_quote - quote,
+    )
+
+
+def calculate_relative_spread(metrics_24h, metrics_180d):
+    """Две точки relative_spread для каждой пары: первая неделя 180d и последние 24 часа"""
+    times_180d = epoch_seconds(metrics_180d.timestamps)
+
+    # --- Первая точка: среднее за первую неделю в data_180d ---
+    start_time_180d = int(times_180d[0])
+    first_week = times_180d < start_time_180d + 7 * 24 * 3600
+    avg_180d = column_means(metrics_180d.percentage_diff_normalized[first_week]).tolist()
+
+    # --- Вторая точка: среднее за последние 24 часа в data_24h ---
+    avg_24h = column_means(metrics_24h.percentage_diff_normalized).tolist()
+    last_timestamp = int(epoch_seconds(metrics_24h.timestamps[-1:])[0])
+
+    # У пары без цен в окне среднего нет - null в JSON
+    avg_180d = [None if value != value else value for value in avg_180d]
+    avg_24h = [None if value != value else value for value in avg_24h]
+    return [
+        [
+            {'time': start_time_180d, 'value': avg_180d[k]},
+            {'time': last_timestamp, 'value': avg_24h[k]},
+        ]
+        for k in range(len(metrics_24h.pairs))
+    ]
@@ -0,0 +1,58 @@
+import json
+import logging
+from bisect import bisect_left
+from pathlib import Path
+
+import fetcher
+
+logger = logging.getLogger(__name__)
+
+# Секунды в единицах таймфреймов ccxt
+TIMEFRAME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+class RecordedExchange:
+    """
+    Локальная биржа с интерфейсом ccxt (fetch_ohlcv, parse_timeframe), отдающая
+    записанные свечи: {символ: {таймфрейм: [[timestamp, o, h, l, c, v], ...]}}.
+    Позволяет прогонять загрузку и расчёты без сети.
+    """
+
+    rateLimit = 0
+
+    def __init__(self, recording, name='recorded'):
+        self.id = name
+        self.candles = {
+            symbol: {timeframe: sorted(ohlcv) for timeframe, ohlcv in timeframes.items()}
+            for symbol, timeframes in recording.items()
+        }
+        self.calls = 0
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        return cls(json.loads(path.read_text()), name=path.stem)
+
+    def save(self, path):
+        Path(path).write_text(json.dumps(self.candles))
+
+    @staticmethod
+    def parse_timeframe(timeframe):
+        return int(timeframe[:-1]) * TIMEFRAME_UNITS[timeframe[-1]]
+
+    def fetch_ohlcv(self, symbol, timeframe='1m', since=None, limit=None):
+        """Записанные свечи символа начиная с since (мс); неизвестный символ - пустой список"""
+        self.calls += 1
+        ohlcv = self.candles.get(symbol, {}).get(timeframe, [])
+        start = bisect_left(ohlcv, since, key=lambda candle: candle[0]) if since is not None else 0
+        return [list(candle) for candle in ohlcv[start:start + limit if limit else None]]
+
+
+def record_ohlcv(exchange, symbols, timeframe, since, path):
+    """Записывает свечи symbols настоящей биржи с since (мс) в файл для RecordedExchange"""
+    scheduler = fetcher.FetchScheduler(exchange)
+    candles = scheduler.fetch(fetcher.FetchJob(symbol, symbol, timeframe, since) for symbol in symbols)
+    recording = RecordedExchange({symbol: {timeframe: ohlcv} for symbol, ohlcv in candles.items()})
+    recording.save(path)
+    logger.info(f"Записано свечей {sum(map(len, candles.values()))} в {path}")
+    return recording
@@ -0,0 +1,17 @@
+import numpy as np
+
+
+def scale_to_bounds(values, low, high):
+    """Масштабирование в [0, 1] по известным min/max; нулевой размах, как в MinMaxScaler, даёт 0"""
+    span = np.asarray(high - low, dtype=float)
+    span = np.where(span == 0, 1.0, span)
+    return (values - low) / span
+
+
+def min_max_scale(values):
+    """
+    Поколоночная min-max нормализация, эквивалентная MinMaxScaler().fit_transform(values);
+    NaN не участвуют в min/max и остаются NaN
+    """
+    values = np.asarray(values, dtype=float)
+    return scale_to_bounds(values, np.fmin.reduce(values, axis=0), np.fmax.reduce(values, axis=0))
@@ -0,0 +1,71 @@
+import os
+from typing import NamedTuple
+
+QUOTE_CURRENCY = 'USDT'
+# Пары задаются через переменную окружения, например ARBITRAGE_PAIRS="BTC/ETH,SOL/ETH,BTC/SOL"
+DEFAULT_PAIRS = 'BTC/ETH'
+
+
+class Pair(NamedTuple):
+    """Пара активов, спред которой отслеживается: base выражается в единицах quote"""
+    base: str
+    quote: str
+
+    @property
+    def name(self):
+        return f"{self.base}/{self.quote}"
+
+
+def parse_pair(name):
+    """Разбор имени пары вида 'BTC/ETH'"""
+    base, sep, quote = name.strip().upper().partition('/')
+    if not sep or not base or not quote or base == quote:
+        raise ValueError(f"Некорректная пара: {name!r}")
+    return Pair(base, quote)
+
+
+def get_pairs():
+    """Зарегистрированные пары в порядке объявления (первая - основная)"""
+    pairs = []
+    for name in os.environ.get('ARBITRAGE_PAIRS', DEFAULT_PAIRS).split(','):
+        if name.strip():
+            pair = parse_pair(name)
+            if pair not in pairs:
+                pairs.append(pair)
+    return pairs
+
+
+def get_assets(pairs=None):
+    """Уникальные активы пар в порядке первого упоминания"""
+    assets = []
+    for pair in pairs if pairs is not None else get_pairs():
+        for asset in pair:
+            if asset not in assets:
+                assets.append(asset)
+    return assets
+
+
+def select_pairs(names=None):
+    """Отбор зарегистрированных пар по именам; None - все пары"""
+    registered = get_pairs()
+    if not names:
+        return registered
+
+    selected = []
+    for name in names:
+        pair = parse_pair(name)
+        if pair not in registered:
+            raise ValueError(f"Пара {pair.name} не зарегистрирована")
+        if pair not in selected:
+            selected.append(pair)
+    return selected
+
+
+def asset_symbol(asset):
+    """Символ биржи для актива: BTC -> BTC/USDT"""
+    return f"{asset}/{QUOTE_CURRENCY}"
+
+
+def asset_column(asset):
+    """Колонка цены закрытия актива в таблицах market_data_*"""
+    return f"close_{asset.lower()}"
@@ -0,0 +1,299 @@
+from collections import deque
+from itertools import islice
+
+import numpy as np
+
+import pairs
+from lazy_modules import lazy_import
+from metrics import PairMetrics
+from normalization import scale_to_bounds
+
+pd = lazy_import('pandas')
+
+DEFAULT_WINDOW_MS = 24 * 60 * 60 * 1000
+
+
+class MonotonicDeque:
+    """Минимум (sign=1) или максимум (sign=-1) скользящего окна за амортизированное O(1)"""
+
+    def __init__(self, sign=1):
+        self.sign = sign
+        self._items = deque()  # (timestamp, value * sign), ключи строго возрастают
+
+    def push(self, timestamp, value):
+        key = value * self.sign
+        while self._items and self._items[-1][1] >= key:
+            self._items.pop()
+        self._items.append((timestamp, key))
+
+    def evict(self, cutoff):
+        """Удаляет значения с меткой времени <= cutoff"""
+        while self._items and self._items[0][0] <= cutoff:
+            self._items.popleft()
+
+    def value(self):
+        return self._items[0][1] * self.sign if self._items else None
+
+
+class RollingMetricsEngine:
+    """
+    Скользящий расчёт метрик пар по окну свечей.
+
+    Сумма соотношений base/quote и монотонные очереди min/max цен активов обновляются
+    за O(1) на свечу (амортизированно), вышедшие из окна свечи вытесняются. Производные
+    ряды получаются из этого состояния одним векторным преобразованием и совпадают
+    с результатом calculate_pair_metrics на тех же свечах.
+
+    Последняя, ещё не закрытая свеча хранится отдельно (pending) и может перезаписываться
+    сколько угодно раз, не затрагивая состояние закрытых свечей. Массивы закрытых свечей
+    и их производные ряды хранятся между вызовами snapshot и только дополняются.
+
+    Пропущенная цена актива (NaN) не входит в суммы и очереди и даёт NaN только
+    в рядах пар этого актива.
+    """
+
+    def __init__(self, pair_list=None, window_ms=DEFAULT_WINDOW_MS):
+        self.pairs = list(pair_list or pairs.get_pairs())
+        self.assets = pairs.get_assets(self.pairs)
+        self.window_ms = window_ms
+        self._base_idx = np.array([self.assets.index(pair.base) for pair in self.pairs], dtype=int)
+        self._quote_idx = np.array([self.assets.index(pair.quote) for pair in self.pairs], dtype=int)
+        self.reset()
+
+    def reset(self):
+        self._times = deque()
+        self._prices = deque()
+        self._ratio_sum = np.zeros(len(self.pairs))
+        self._ratio_count = np.zeros(len(self.pairs), dtype=int)  # Свечи окна с обеими ценами пары
+        self._pushes_since_resum = 0
+        self._mins = [MonotonicDeque(1) for _ in self.assets]
+        self._maxs = [MonotonicDeque(-1) for _ in self.assets]
+        self._pending = None  # (timestamp, prices)
+        self._pushed = 0  # Закрытых свечей добавлено с последнего сброса
+        self._evicted = 0  # Из них вытеснено из окна
+        self._cache = None  # Массивы закрытых свечей последнего snapshot (см. _closed_arrays)
+
+    def __len__(self):
+        return len(self._times) + (self._pending is not None)
+
+    @property
+    def last_closed_timestamp(self):
+        return self._times[-1] if self._times else None
+
+    @property
+    def first_timestamp(self):
+        if self._times:
+            return self._times[0]
+        return self._pending[0] if self._pending is not None else None
+
+    @property
+    def last_timestamp(self):
+        if self._pending is not None:
+            return self._pending[0]
+        return self.last_closed_timestamp
+
+    def count_since(self, timestamp):
+        """Число свечей окна (включая незакрытую) с меткой времени >= timestamp"""
+        count = int(self._pending is not None and self._pending[0] >= timestamp)
+        for i in range(len(self._times) - 1, -1, -1):
+            if self._times[i] < timestamp:
+                break
+            count += 1
+        return count
+
+    def push(self, timestamp, prices):
+        """Добавляет закрытую свечу (timestamp в мс, цены в порядке self.assets)"""
+        timestamp = int(timestamp)
+        prices = np.asarray(prices, dtype=float)
+        if self._times and timestamp <= self._times[-1]:
+            raise ValueError(f"Свеча {timestamp} не новее последней закрытой {self._times[-1]}")
+        if self._pending is not None and self._pending[0] <= timestamp:
+            self._pending = None
+
+        self._times.append(timestamp)
+        self._prices.append(prices)
+        self._pushed += 1
+        self._add_ratio(prices, 1)
+        for s, price in enumerate(prices):
+            if not np.isnan(price):
+                self._mins[s].push(timestamp, price)
+                self._maxs[s].push(timestamp, price)
+        self._evict(self.last_timestamp)
+
+        # Периодический пересчёт суммы убирает накопленную погрешность вычитаний
+        self._pushes_since_resum += 1
+        if self._pushes_since_resum >= max(len(self._times), 1):
+            ratios = self._ratio(np.array(self._prices))
+            self._ratio_sum = np.where(np.isnan(ratios), 0.0, ratios).sum(axis=0)
+            self._pushes_since_resum = 0
+
+    def set_pending(self, timestamp, prices):
+        """Устанавливает (или обновляет) текущую незакрытую свечу"""
+        timestamp = int(timestamp)
+        if self._pending is not None and self._pending[0] < timestamp:
+            # Предыдущая незакрытая свеча уже не последняя - значит, она закрылась
+            self.push(*self._pending)
+        self._pending = (timestamp, np.asarray(prices, dtype=float))
+        self._evict(timestamp)
+
+    def apply_rows(self, rows, closed_before):
+        """
+        Применяет отсортированные строки [(timestamp, prices), ...]: свечи с
+        timestamp < closed_before считаются закрытыми, остальные - незакрытыми.
+        Возвращает False, если изменилась уже учтённая закрытая свеча и состояние
+        нужно перестроить с нуля.
+        """
+        for timestamp, prices in rows:
+            timestamp = int(timestamp)
+            if self._times and timestamp <= self._times[-1]:
+                if timestamp < self._times[0]:
+                    continue
+                known = self._find_closed(timestamp)
+                if known is None or not np.array_equal(known, np.asarray(prices, dtype=float), equal_nan=True):
+                    return False
+                continue
+            if timestamp < closed_before:
+                self.push(timestamp, prices)
+            else:
+                self.set_pending(timestamp, prices)
+        return True
+
+    def avg_ratio(self):
+        """Среднее соотношение base/quote по окну, округлённое как в пакетном расчёте"""
+        total = self._ratio_sum.copy()
+        count = self._ratio_count.copy()
+        if self._pending is not None:
+            ratio = self._ratio(self._pending[1])
+            present = ~np.isnan(ratio)
+            total += np.where(present, ratio, 0.0)
+            count += present
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.round(total / count, 2)
+
+    def price_extrema(self):
+        """Минимумы и максимумы цен активов по окну"""
+        lows = np.array([dq.value() for dq in self._mins], dtype=float)
+        highs = np.array([dq.value() for dq in self._maxs], dtype=float)
+        if self._pending is not None:
+            pending = self._pending[1]
+            lows = np.fmin(lows, pending)
+            highs = np.fmax(highs, pending)
+        return lows, highs
+
+    def latest(self):
+        """Метрики последней свечи окна за O(числа пар)"""
+        if not len(self):
+            return None
+        timestamp, prices = self._pending if self._pending is not None else (self._times[-1], self._prices[-1])
+        params = self._params()
+        result = {'timestamp': timestamp, 'avg_ratio': params[0]}
+        result.update({key: value[0] for key, value in self._derive(prices[np.newaxis, :], params).items()})
+        return result
+
+    def snapshot(self):
+        """
+        Метрики всего окна в виде PairMetrics. Стоимость - новые с прошлого вызова
+        свечи плюс копирование готовых массивов; производные ряды всего окна
+        пересчитываются, только если изменились среднее соотношение или min/max окна.
+        Массивы могут быть общими с кешем движка - их нельзя изменять.
+        """
+        if not len(self):
+            return None
+        params = self._params()
+        times, prices, derived = self._closed_arrays(params)
+        if self._pending is not None:
+            pending = self._pending[1][np.newaxis, :]
+            times = np.append(times, self._pending[0])
+            prices = np.vstack([prices, pending])
+            derived = {key: np.vstack([value, row]) for (key, value), row in
+                       zip(derived.items(), self._derive(pending, params).values())}
+        timestamps = pd.Series(pd.to_datetime(times, unit='ms', utc=True))
+        return PairMetrics(timestamps, self.assets, self.pairs, prices, avg_ratio=params[0], **derived)
+
+    def _params(self):
+        """Состояние окна, от которого зависят производные ряды: (avg_ratio, lows, highs)"""
+        return (self.avg_ratio(), *self.price_extrema())
+
+    def _closed_arrays(self, params):
+        """
+        Метки, цены и производные ряды закрытых свечей окна. Массивы прошлого вызова
+        переиспользуются: от них отрезаются вытесненные свечи и дописываются новые.
+        """
+        if self._cache is None:
+            start = end = self._evicted
+            times = np.empty(0, dtype=np.int64)
+            prices = np.empty((0, len(self.assets)))
+            derived = cached_params = None
+        else:
+            start, end, times, prices, derived, cached_params = self._cache
+        drop = self._evicted - start
+        times, prices = times[drop:], prices[drop:]
+
+        added = self._pushed - max(end, self._evicted)
+        if added:
+            # Новые свечи - в конце очередей
+            new_times = np.array(list(islice(reversed(self._times), added))[::-1], dtype=np.int64)
+            new_prices = np.array(list(islice(reversed(self._prices), added))[::-1])
+            times = np.concatenate([times, new_times])
+            prices = np.concatenate([prices, new_prices])
+
+        same_params = cached_params is not None and all(
+            np.array_equal(a, b, equal_nan=True) for a, b in zip(params, cached_params)
+        )
+        if same_params:
+            derived = {key: value[drop:] for key, value in derived.items()}
+            if added:
+                derived = {key: np.concatenate([value, row]) for (key, value), row in
+                           zip(derived.items(), self._derive(new_prices, params).values())}
+        else:
+            derived = self._derive(prices, params)
+        self._cache = (self._evicted, self._pushed, times, prices, derived, params)
+        return times, prices, derived
+
+    def _derive(self, prices, params):
+        """Производные ряды для строк prices при состоянии окна params"""
+        avg_ratio, lows, highs = params
+        base = prices[:, self._base_idx]
+        quote = prices[:, self._quote_idx]
+
+        # Округление монотонно, поэтому min/max округлённого ряда - округлённые min/max цен
+        base_as_quote = np.round(base / avg_ratio, 2)
+        base_as_quote_low = np.round(lows[self._base_idx] / avg_ratio, 2)
+        base_as_quote_high = np.round(highs[self._base_idx] / avg_ratio, 2)
+
+        base_as_quote_norm = scale_to_bounds(base_as_quote, base_as_quote_low, base_as_quote_high)
+        quote_norm = scale_to_bounds(quote, lows[self._quote_idx], highs[self._quote_idx])
+        return {
+            'base_as_quote': base_as_quote,
+            'base_as_quote_norm': base_as_quote_norm,
+            'quote_norm': quote_norm,
+            'percentage_diff_normalized': base_as_quote_norm - quote_norm,
+            'percentage_diff': base_as_quote - quote,
+        }
+
+    def _ratio(self, prices):
+        return prices[..., self._base_idx] / prices[..., self._quote_idx]
+
+    def _add_ratio(self, prices, sign):
+        ratio = self._ratio(prices)
+        present = ~np.isnan(ratio)
+        self._ratio_sum += sign * np.where(present, ratio, 0.0)
+        self._ratio_count += sign * present
+
+    def _find_closed(self, timestamp):
+        """Цены закрытой свечи по метке времени (поиск с конца окна)"""
+        for i in range(len(self._times) - 1, -1, -1):
+            if self._times[i] == timestamp:
+                return self._prices[i]
+            if self._times[i] < timestamp:
+                return None
+        return None
+
+    def _evict(self, latest):
+        cutoff = latest - self.window_ms
+        while self._times and self._times[0] <= cutoff:
+            self._times.popleft()
+            self._evicted += 1
+            self._add_ratio(self._prices.popleft(), -1)
+        for dq in self._mins + self._maxs:
+            dq.evict(cutoff)
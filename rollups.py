@@ -0,0 +1,157 @@
+import logging
+import time
+
+import pairs
+import storage
+
+logger = logging.getLogger(__name__)
+
+MINUTE_MS = 60 * 1000
+SOURCE_TABLE = 'market_data_24h'  # Минутные свечи, из которых строятся агрегаты
+
+# Уровни агрегатов OHLC: таблица, длина интервала (мс), глубина хранения (дни).
+# Каждый уровень строится из предыдущего, поэтому хранится дольше интервала следующего
+ROLLUP_LEVELS = (
+    ('market_data_5m', 5 * MINUTE_MS, 7),
+    ('market_data_15m', 15 * MINUTE_MS, 30),
+    ('market_data_1h', 60 * MINUTE_MS, 180),
+    ('market_data_4h', 4 * 60 * MINUTE_MS, 730),
+    ('market_data_1d', 24 * 60 * MINUTE_MS, 1825),
+)
+
+# Таблицы с ценами закрытия, которые при наличии минутной истории выводятся
+# из агрегатов вместо загрузки с биржи: таблица -> (источник, длина интервала)
+DERIVED_TABLES = {
+    'market_data_180d': ('market_data_4h', 12 * 60 * MINUTE_MS),
+}
+
+# Гранулярность всех таблиц свечей - для выбора таблицы под запрос
+TABLE_RESOLUTIONS = {
+    SOURCE_TABLE: MINUTE_MS,
+    **{table_name: resolution for table_name, resolution, _ in ROLLUP_LEVELS},
+    **{table_name: resolution for table_name, (_, resolution) in DERIVED_TABLES.items()},
+}
+
+
+def ensure_rollup_tables(conn, assets=None):
+    """Создаёт таблицы агрегатов и заполняет пустые из уже сохранённых минутных свечей"""
+    assets = assets if assets is not None else pairs.get_assets()
+    columns = [f'{kind}_{asset.lower()}' for asset in assets for kind in storage.OHLC_KINDS]
+    empty = False
+    for table_name, _, _ in ROLLUP_LEVELS:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} (timestamp INTEGER PRIMARY KEY)")
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+        for column in columns:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} REAL")
+        empty = empty or storage.first_timestamp(conn, table_name) is None
+
+    if empty:
+        first, last = conn.execute(f"SELECT MIN(timestamp), MAX(timestamp) FROM {SOURCE_TABLE}").fetchone()
+        if first is not None:
+            update_rollups(conn, first, last, assets)
+            logger.info("Агрегаты построены по сохранённым минутным свечам")
+
+
+def update_rollups(conn, start, end, assets=None):
+    """
+    Пересчитывает интервалы всех уровней, затронутые минутными свечами в [start, end] (мс).
+    Каждый уровень считается из предыдущего, поэтому пересчёт стоит O(числа интервалов).
+    """
+    assets = assets if assets is not None else pairs.get_assets()
+    source = SOURCE_TABLE
+    with conn:
+        for table_name, resolution, _ in ROLLUP_LEVELS:
+            start = start // resolution * resolution
+            end = (end // resolution + 1) * resolution - 1
+            _rebuild_buckets(conn, table_name, source, resolution, start, end, assets)
+            source = table_name
+
+
+def trim_rollups(conn, now_ms=None):
+    """Удаляет интервалы, вышедшие за глубину хранения уровня"""
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    with conn:
+        for table_name, _, days in ROLLUP_LEVELS:
+            conn.execute(f"DELETE FROM {table_name} WHERE timestamp < ?", (now_ms - days * 24 * 60 * MINUTE_MS,))
+
+
+def derivable_since(conn, table_name, last_timestamp):
+    """
+    Начало пересчёта выводимой таблицы от её последней свечи или None, если
+    минутная история её не покрывает и свечи нужно загрузить с биржи.
+    """
+    if table_name not in DERIVED_TABLES or last_timestamp is None:
+        return None
+    _, resolution = DERIVED_TABLES[table_name]
+    start = last_timestamp // resolution * resolution
+    first = storage.first_timestamp(conn, SOURCE_TABLE)
+    return start if first is not None and first <= start else None
+
+
+def derive_table(conn, table_name, start, assets=None):
+    """Пересчитывает цены закрытия выводимой таблицы с start (мс); возвращает последнюю метку"""
+    assets = assets if assets is not None else pairs.get_assets()
+    source, resolution = DERIVED_TABLES[table_name]
+    columns = [pairs.asset_column(asset) for asset in assets]
+    select = storage.bucket_ohlc_select(
+        source, storage.ohlc_columns(conn, source, assets), resolution, "WHERE timestamp >= ?"
+    )
+    with conn:
+        storage.ensure_market_table(conn, table_name, assets)
+        conn.execute(
+            f"INSERT INTO {table_name} (timestamp, {', '.join(columns)}) "
+            f"SELECT bucket, {', '.join(f'close_{i}' for i in range(len(columns)))} FROM ({select}) "
+            f"WHERE true ON CONFLICT(timestamp) DO UPDATE SET "
+            f"{', '.join(f'{column} = excluded.{column}' for column in columns)}",
+            (start,)
+        )
+    return conn.execute(f"SELECT MAX(timestamp) FROM {table_name}").fetchone()[0]
+
+
+def select_table(conn, table_name, start=None, resolution=None, ohlc=False):
+    """
+    Самая грубая таблица, из которой можно ответить на запрос к table_name с
+    агрегацией resolution (мс): её интервал делит resolution, а история покрывает
+    начало запроса. Возвращает (таблица, начало запроса в мс).
+    """
+    if not resolution or table_name not in TABLE_RESOLUTIONS:
+        return table_name, start
+    if start is None:
+        # Без явного начала ответ ограничен историей запрошенной таблицы
+        start = storage.first_timestamp(conn, table_name)
+        if start is None:
+            return table_name, start
+
+    best, best_resolution = table_name, TABLE_RESOLUTIONS[table_name]
+    for candidate, candidate_resolution in TABLE_RESOLUTIONS.items():
+        if candidate_resolution <= best_resolution or resolution % candidate_resolution:
+            continue
+        # OHLC из таблиц с одними ценами закрытия потерял бы high/low внутри интервала
+        if ohlc and candidate in DERIVED_TABLES:
+            continue
+        first = storage.first_timestamp(conn, candidate)
+        if first is None or first > start // resolution * resolution:
+            continue
+        best, best_resolution = candidate, candidate_resolution
+
+    if best != table_name:
+        # Интервал запроса, в который попадает start, берётся целиком
+        start = start // resolution * resolution
+    return best, start
+
+
+def _rebuild_buckets(conn, table_name, source, resolution, start, end, assets):
+    columns = storage.ohlc_columns(conn, source, assets)
+    not_null = ' AND '.join(f'{close} IS NOT NULL' for *_, close in columns)
+    select = storage.bucket_ohlc_select(
+        source, columns, resolution, f"WHERE timestamp >= ? AND timestamp <= ? AND {not_null}"
+    )
+    names = [f'{kind}_{asset.lower()}' for asset in assets for kind in storage.OHLC_KINDS]
+    # WHERE true отделяет SELECT с JOIN от ON CONFLICT (требование грамматики SQLite)
+    conn.execute(
+        f"INSERT INTO {table_name} (timestamp, {', '.join(names)}) {select} "
+        f"WHERE true ON CONFLICT(timestamp) DO UPDATE SET "
+        f"{', '.join(f'{name} = excluded.{name}' for name in names)}",
+        (start, end)
+    )
@@ -1,5 +1,9 @@
+import argparse
+import cProfile
 import http.server
 import shutil
+import signal
+import socket
 import socketserver
 import sys
 import webbrowser
@@ -8,22 +12,155 @@ import time
 import threading
 import sqlite3
 import json
+import gzip
+import queue
+import zlib
 from datetime import datetime
 from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
 import logging
 
-from data_processor import DataProcessor
+from data_processor import DataProcessor, RESULT_SHAPES
+from cache import VersionedCache
+from shared_payload import SharedPayloads
+from stream import EventBroadcaster, HEARTBEAT_INTERVAL
+import alerts
+import alignment
 import db_utils
+import instrumentation
+import live_feed
+import pairs
+import rollups
+import storage
+import venues
+import wire_format
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-DB_PATH = db_utils.get_db_path()
+DB_PATH = storage.get_db_path()
+
+# Готовые JSON-ответы /api/processed-data (и их сжатые варианты),
+# сбрасываются после каждого обновления данных
+processed_cache = VersionedCache(db_utils.get_data_version)
+
+# Подписчики /api/stream и состояние последней рассылки (время последней точки и нормализация)
+broadcaster = EventBroadcaster()
+_last_published = {'time': None, 'norm_key': None}
+
+# Последние срабатывания правил оповещений для /api/alerts
+recent_alerts = alerts.MemorySink()
+
+# Режим pre-fork: готовые ответы /api/processed-data, которые главный процесс
+# публикует после каждого обновления, а рабочие отдают без пересчёта
+shared_payloads = None
+# Метрики главного процесса (загрузка, этапы обработки) для /api/metrics рабочих
+shared_metrics = None
+METRICS_FILE_NAME = 'metrics.bin'
+METRICS_PUBLISH_INTERVAL = 5  # Секунды между публикациями метрик главного процесса
+
+# Ответы меньше этого размера не сжимаем
+COMPRESS_MIN_SIZE = 1024
+
+# Форматы тела /api/processed-data: JSON или двоичный колоночный (wire_format)
+RESPONSE_FORMATS = {'json': 'application/json', 'bin': wire_format.CONTENT_TYPE}
+
+# /api/market-data: строк в одной пачке ответа и способы агрегации по интервалам
+MARKET_DATA_CHUNK_ROWS = 2000
+MARKET_DATA_AGGREGATES = ('last', 'ohlc')
+
+# Префиксы путей API и имена обработчиков handle_<имя> (имя - и метка в метриках запросов)
+API_ROUTES = (
+    ('/api/market-data', 'market_data'),
+    ('/api/processed-data', 'processed_data'),
+    ('/api/stream', 'stream'),
+    ('/api/venue-spreads', 'venue_spreads'),
+    ('/api/alerts', 'alerts'),
+    ('/api/metrics', 'metrics'),
+)
+
+
+def choose_encoding(accept_encoding):
+    """Выбирает сжатие по заголовку Accept-Encoding: 'gzip', 'deflate' или None"""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ('gzip', 'deflate'):
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def make_compressor(encoding):
+    """Потоковый компрессор для выбранного метода сжатия или None"""
+    if encoding == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.compressobj(6)
+    return None
+
+
+def parse_int_param(params, name, minimum=None):
+    """Целочисленный параметр запроса или None; ValueError при неверном значении"""
+    value = params.get(name, [None])[0]
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be >= {minimum}")
+    return value
+
+
+def iter_json_rows(cursor, names, chunk_rows=None):
+    """Массив JSON строк курсора пачками по chunk_rows строк: один json.dumps на пачку"""
+    chunk_rows = chunk_rows or MARKET_DATA_CHUNK_ROWS
+    yield b'['
+    separator = b''
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+        chunk = json.dumps([
+            {"timestamp": storage.format_timestamp(row[0]), **dict(zip(names, row[1:]))}
+            for row in rows
+        ])
+        yield separator + chunk[1:-1].encode()
+        separator = b','
+    yield b']'
+
+
+@instrumentation.timed()
+def compress_body(body, encoding):
+    """Сжатие тела ответа выбранным методом"""
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    if encoding == 'deflate':
+        return zlib.compress(body, 6)
+    return body
 
 
 class AutoRefreshHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1: соединение остаётся открытым между запросами (keep-alive)
+    protocol_version = 'HTTP/1.1'
+    # Простаивающее keep-alive соединение закрывается через timeout секунд
+    timeout = 30
+    # Каталог для статистики cProfile по каждому запросу (--profile); None - без профилирования
+    profile_dir = None
+
     def __init__(self, *args, **kwargs):
         self.base_directory = Path(__file__).parent
         self.templates_dir = self.base_directory / 'templates'
@@ -61,92 +198,283 @@ class AutoRefreshHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header('Cache-Control', 'no-store, max-age=0')
         super().end_headers()
 
+    def send_response(self, code, message=None):
+        # Код ответа запоминается для метрик запросов
+        self.status_code = code
+        super().send_response(code, message)
+
     def do_GET(self):
+        route = next((name for prefix, name in API_ROUTES if self.path.startswith(prefix)), 'static')
+        self.status_code = None
+        # Поток SSE живёт всё соединение: его не профилируем и не включаем в гистограмму
+        profiler = cProfile.Profile() if self.profile_dir and route != 'stream' else None
+        started = time.perf_counter()
         try:
-            if self.path.startswith('/api/market-data'):
-                return self.handle_market_data()
-            elif self.path.startswith('/api/processed-data'):  # Новый эндпоинт
-                return self.handle_processed_data()
-
-            return super().do_GET()
+            if profiler is not None:
+                profiler.enable()
+            if route == 'static':
+                return super().do_GET()
+            return getattr(self, f'handle_{route}')()
         except Exception as e:
             logger.error(f"Request handling error: {e}")
             self.send_error(500, "Internal Server Error")
+        finally:
+            elapsed = time.perf_counter() - started
+            if route != 'stream':
+                instrumentation.observe('http_request_duration_seconds', elapsed, handler=route)
+            instrumentation.inc('http_requests_total', handler=route, status=str(self.status_code))
+            if profiler is not None:
+                profiler.disable()
+                self.dump_profile(profiler, route)
+
+    def dump_profile(self, profiler, route):
+        """Статистика cProfile запроса в profile_dir/<время в нс>-<обработчик>.prof"""
+        path = Path(self.profile_dir) / f"{time.time_ns()}-{route}.prof"
+        try:
+            profiler.dump_stats(path)
+            logger.info(f"Профиль запроса {self.path} записан в {path}")
+        except OSError as e:
+            logger.error(f"Не удалось записать профиль запроса: {e}")
 
     def handle_processed_data(self):
         """Отдает полностью обработанные данные для фронтенда"""
         try:
-            # Получаем обработанные данные
-            processed_data = DataProcessor.get_processed_data()
-            if not processed_data:
+            # Фильтр пар: ?pair=SOL/ETH,BTC/SOL или ?pair=SOL/ETH&pair=BTC/SOL
+            params = parse_qs(urlsplit(self.path).query)
+            names = [name for value in params.get('pair', []) for name in value.split(',') if name.strip()]
+            try:
+                pair_list = pairs.select_pairs(names)
+            except ValueError as e:
+                self.send_error(400, "Unknown pair", str(e))
+                return
+
+            # Формат рядов: points (по умолчанию) или columnar
+            shape = params.get('shape', ['points'])[0]
+            if shape not in RESULT_SHAPES:
+                self.send_error(400, f"Unknown shape {shape}")
+                return
+
+            # Двоичный формат (?format=bin или Accept: application/octet-stream) всегда колоночный
+            fmt = params.get('format', [None])[0] or self.preferred_format()
+            if fmt not in RESPONSE_FORMATS:
+                self.send_error(400, f"Unknown format {fmt}")
+                return
+            if fmt == 'bin':
+                shape = 'columnar'
+
+            # Дельта: ?since=<время последней точки клиента>&norm_key=<отпечаток нормализации>
+            since = params.get('since', [None])[0]
+            if since is not None:
+                try:
+                    since = int(float(since))
+                except ValueError:
+                    self.send_error(400, "Invalid since")
+                    return
+
+            # В режиме pre-fork ответы для всех пар уже готовы в общей памяти
+            norm_key = params.get('norm_key', [None])[0]
+            if shared_payloads is not None and not names and self.send_shared_body(shape, since, norm_key, fmt):
+                return
+
+            # Получаем обработанные данные (из кеша, если версия данных не менялась).
+            # Версия запоминается до чтения тела: сжатый вариант кешируется под ней
+            version = db_utils.get_data_version()
+            key, body = get_processed_body(pair_list, shape, since, norm_key, fmt, version)
+            if body is None:
                 self.send_error(404, "Data not found")
                 return
 
+            # Сжатый вариант тоже кешируется: сжатие выполняется один раз на версию данных.
+            # Если версия сменилась после чтения тела, сжатое старое тело не кешируется
+            encoding = self.negotiate_encoding(body)
+            if encoding:
+                body = processed_cache.get(key + (encoding,), lambda: compress_body(body, encoding), version)
+
             # Отправляем ответ
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(processed_data).encode())
+            self.send_body(body, RESPONSE_FORMATS[fmt], encoding, vary='Accept, Accept-Encoding')
 
         except Exception as e:
             logger.error(f"Processed data error: {e}")
             self.send_error(500, "Internal Server Error")
 
-    def handle_market_data(self):
-        """Оптимизированный обработчик API"""
+    def send_shared_body(self, shape, since, norm_key, fmt='json'):
+        """Отправляет готовый ответ из общей памяти без копирования; False - такого ответа там нет"""
+        meta = shared_payloads.meta()
+        if since is not None and norm_key != meta.get('norm_key'):
+            since = None
+        body = shared_payloads.get(shared_payload_key(shape, since, fmt=fmt))
+        if body is None:
+            return False
+        encoding = self.negotiate_encoding(body)
+        if encoding:
+            body = shared_payloads.get(shared_payload_key(shape, since, encoding, fmt))
+            if body is None:
+                return False
+        self.send_body(body, RESPONSE_FORMATS[fmt], encoding, vary='Accept, Accept-Encoding')
+        return True
+
+    def preferred_format(self):
+        """Формат ответа по заголовку Accept: двоичный, только если клиент просит его явно"""
+        accept = self.headers.get('Accept') or ''
+        return 'bin' if wire_format.CONTENT_TYPE in accept else 'json'
+
+    def handle_stream(self):
+        """Поток Server-Sent Events: новые точки рассылаются сразу после обновления данных"""
+        subscriber = broadcaster.subscribe()
         try:
-            # Проверяем параметры запроса
-            if '?' not in self.path:
-                table_name = "market_data_24h"
-            else:
-                query = self.path.split('?')[1]
-                params = dict(p.split('=') for p in query.split('&'))
-                table_name = f"market_data_{params.get('table', '24h')}"
-
-            # Быстрая проверка существования таблицы
-            conn = sqlite3.connect(DB_PATH)
-            logger.info(f"Используем базу данных по пути: {DB_PATH}")
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-            if not cursor.fetchone():
-                self.send_error(404, f"Table {table_name} not found")
-                return
-
-            # Оптимизированный запрос с лимитом
-            cursor.execute(f"""
-                SELECT timestamp, close_btc, close_eth
-                FROM {table_name} 
-                ORDER BY timestamp DESC 
-            """)
-
-            # Быстрое формирование ответа
             self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('X-Data-Source', table_name)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.close_connection = True
             self.end_headers()
+            self.wfile.write(b'retry: 5000\n\n')
+            self.wfile.flush()
+
+            while True:
+                try:
+                    frame = subscriber.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    frame = b': ping\n\n'
+                if frame is None:
+                    break
+                self.wfile.write(frame)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("Клиент отключился от потока")
+        finally:
+            broadcaster.unsubscribe(subscriber)
+
+    def handle_alerts(self):
+        """Правила оповещений и их последние срабатывания"""
+        body = json.dumps({
+            'rules': [rule.describe() for rule in alerts.get_engine().rules],
+            'alerts': recent_alerts.recent(),
+        }, ensure_ascii=False).encode()
+        self.send_body(body, 'application/json', self.negotiate_encoding(body))
+
+    def handle_venue_spreads(self):
+        """Межплощадочный базис активов: ?asset=BTC,ETH (по умолчанию - все активы пар)"""
+        params = parse_qs(urlsplit(self.path).query)
+        assets = [name.strip().upper() for value in params.get('asset', []) for name in value.split(',') if name.strip()]
+        unknown = sorted(set(assets) - set(pairs.get_assets()))
+        if unknown:
+            self.send_error(400, "Unknown asset", ', '.join(unknown))
+            return
+        assets = assets or pairs.get_assets()
+
+        def build():
+            with storage.connection() as conn:
+                return serialize({asset: venues.venue_spreads(conn, asset) for asset in assets})
+
+        # Свечи площадок догружаются тем же циклом обновления, что и основные таблицы
+        body = processed_cache.get(('venue_spreads', tuple(assets)), build)
+        self.send_body(body, 'application/json', self.negotiate_encoding(body))
+
+    def handle_metrics(self):
+        """Метрики производительности в текстовом формате Prometheus"""
+        body = instrumentation.render_prometheus().encode()
+        self.send_body(body, 'text/plain; version=0.0.4; charset=utf-8', self.negotiate_encoding(body))
+
+    def negotiate_encoding(self, body):
+        """Метод сжатия ответа для текущего клиента или None"""
+        if len(body) < COMPRESS_MIN_SIZE:
+            return None
+        return choose_encoding(self.headers.get('Accept-Encoding'))
+
+    def send_body(self, body, content_type, encoding=None, vary='Accept-Encoding'):
+        """Отправляет готовое тело ответа с Content-Length (нужен для keep-alive)"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Vary', vary)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_market_data(self):
+        """
+        Сырые цены таблицы: ?table=24h|180d|5m|15m|1h|4h|1d&from=&to= (unix-время, с)&limit=
+        &resolution=<минуты>&agg=last|ohlc. Ответ строится пачками строк и
+        передаётся кусками (chunked), не дожидаясь конца выборки.
+        """
+        params = parse_qs(urlsplit(self.path).query)
+        table_name = f"market_data_{params.get('table', ['24h'])[0]}"
+        try:
+            start, end, limit, resolution = (
+                parse_int_param(params, name, minimum)
+                for name, minimum in (('from', 0), ('to', 0), ('limit', 1), ('resolution', 1))
+            )
+        except ValueError as e:
+            self.send_error(400, "Invalid parameter", str(e))
+            return
+        agg = params.get('agg', ['last'])[0]
+        if agg not in MARKET_DATA_AGGREGATES:
+            self.send_error(400, f"Unknown agg {agg}")
+            return
 
-            # Потоковая передача данных
-            self.wfile.write(b'[')
-            first = True
-            for row in cursor:
-                if not first:
-                    self.wfile.write(b',')
-                first = False
-                self.wfile.write(json.dumps({
-                    "timestamp": row[0],
-                    "close_btc": row[1],
-                    "close_eth": row[2]
-                }).encode())
-            self.wfile.write(b']')
+        try:
+            with storage.connection() as conn:
+                # Быстрая проверка существования таблицы
+                exists = conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,)
+                ).fetchone()
+                if not exists:
+                    self.send_error(404, f"Table {table_name} not found")
+                    return
+
+                # Агрегированный запрос обслуживается самой грубой подходящей таблицей агрегатов
+                resolution = resolution * 60 * 1000 if resolution else None
+                source, start = rollups.select_table(
+                    conn, table_name, start * 1000 if start is not None else None, resolution, agg == 'ohlc'
+                )
+                cursor, names = storage.query_market_data(
+                    conn, source,
+                    start=start,
+                    end=end * 1000 if end is not None else None,
+                    limit=limit,
+                    resolution=resolution,
+                    ohlc=agg == 'ohlc',
+                )
+                self.send_chunked(
+                    iter_json_rows(cursor, names), 'application/json',
+                    choose_encoding(self.headers.get('Accept-Encoding')),
+                    {'X-Data-Source': source},
+                )
 
         except sqlite3.Error as e:
             logger.error(f"Database error: {e}")
             self.send_error(500, "Database operation failed")
+
+    def send_chunked(self, chunks, content_type, encoding=None, headers=None):
+        """Отправляет тело кусками (Transfer-Encoding: chunked), сжимая поток на лету"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        compressor = make_compressor(encoding)
+        try:
+            for chunk in chunks:
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                self.write_chunk(chunk)
+            if compressor:
+                self.write_chunk(compressor.flush())
+            self.wfile.write(b'0\r\n\r\n')
         except Exception as e:
-            logger.error(f"API error: {e}")
-            self.send_error(500, "Internal Server Error")
-        finally:
-            conn.close()
+            # Заголовки уже отправлены: обрываем соединение, клиент увидит незавершённый ответ
+            logger.error(f"Ошибка передачи ответа: {e}")
+            self.close_connection = True
+
+    def write_chunk(self, chunk):
+        if chunk:
+            self.wfile.write(b'%x\r\n%b\r\n' % (len(chunk), chunk))
 
     @classmethod
     def start_background_updater(cls, interval=60):
@@ -156,6 +484,10 @@ class AutoRefreshHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                     logger.info(f"Запуск обновления данных в {time.ctime()}...")  # Логируем время
                     db_utils.main()
                     logger.info("Данные успешно обновлены")
+                    # Версия в базе - для серверов, запущенных с --external-ingest
+                    db_utils.publish_data_version()
+                    instrumentation.set_gauge('updater_last_success_timestamp_seconds', time.time())
+                    publish_update()
                 except Exception as e:
                     logger.error(f"Ошибка: {e}")
                 time.sleep(interval)
@@ -166,81 +498,342 @@ class AutoRefreshHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         return thread
 
 
+def get_processed_result(pair_list, shape, version=None):
+    """Обработанные данные (словарь) и ключ выборки в кеше; None - данных нет"""
+    key = (tuple(pair.name for pair in pair_list), shape)
+    return key, processed_cache.get(
+        key + ('result',), lambda: DataProcessor.get_processed_data(pair_list, shape), version
+    )
+
+
+def get_processed_body(pair_list, shape, since=None, norm_key=None, fmt='json', version=None):
+    """
+    Тело ответа /api/processed-data в формате fmt и его ключ в кеше: дельта с точки
+    since, если отпечаток нормализации клиента совпадает с текущим, иначе полный
+    ответ. Тело None - данных нет. version - версия данных, на которой начата
+    обработка запроса: тело из данных устаревшей версии не кешируется под новой.
+    """
+    if version is None:
+        version = db_utils.get_data_version()
+    key, result = get_processed_result(pair_list, shape, version)
+    if result is None:
+        return key, None
+    if fmt != 'json':
+        key += (fmt,)
+
+    # Полный ответ отдаётся, если клиент ещё ничего не получал или сменилась нормализация
+    if since is not None and norm_key == result['norm_key']:
+        key += ('delta', since)
+        return key, processed_cache.get(key, lambda: serialize(DataProcessor.build_delta(result, since), fmt), version)
+    return key, processed_cache.get(key, lambda: serialize(result, fmt), version)
+
+
+def serialize(result, fmt='json'):
+    """Ответ API в байты JSON или двоичного колоночного формата"""
+    if fmt == 'bin':
+        with instrumentation.span('serialize_bin'):
+            return wire_format.encode_columnar(result)
+    with instrumentation.span('serialize_json'):
+        return json.dumps(result).encode()
+
+
+def collect_metrics():
+    """Значения для /api/metrics, вычисляемые в момент запроса"""
+    hits, misses = processed_cache.hits, processed_cache.misses
+    samples = [
+        ('cache_requests_total', 'counter', {'cache': 'processed', 'result': 'hit'}, hits),
+        ('cache_requests_total', 'counter', {'cache': 'processed', 'result': 'miss'}, misses),
+        ('stream_subscribers', 'gauge', {}, broadcaster.subscriber_count),
+    ]
+    if hits + misses:
+        samples.append(('cache_hit_ratio', 'gauge', {'cache': 'processed'}, hits / (hits + misses)))
+    # Полноту рядов записывает процесс загрузки - берём её из базы
+    with storage.connection() as conn:
+        for row in alignment.get_completeness(conn):
+            ratio = row['present'] / row['expected'] if row['expected'] else 1.0
+            samples.append(('series_completeness_ratio', 'gauge', {'table': row['table_name'], 'asset': row['asset']}, ratio))
+    return samples
+
+
+instrumentation.register_collector(collect_metrics)
+
+
+def publish_update(evaluate_alerts=True):
+    """
+    Обработка обновления данных: проверка правил оповещений, рассылка подписчикам
+    потока и (в главном процессе pre-fork) публикация готовых ответов рабочим.
+    evaluate_alerts=False - правила проверяет процесс загрузки (ingest_worker.py).
+    """
+    pair_list = pairs.get_pairs()
+    version = db_utils.get_data_version()
+    _, result = get_processed_result(pair_list, 'columnar', version)
+    if result is None:
+        return
+
+    # Правила оповещений проверяются на тех же данных, что уходят подписчикам
+    if evaluate_alerts:
+        alerts.get_engine().evaluate(result)
+
+    previous_time = _last_published['time']
+    publish_stream(pair_list, result, version)
+    if shared_payloads is not None:
+        publish_shared_payloads(pair_list, previous_time)
+
+
+def publish_stream(pair_list, result, version=None):
+    """
+    Рассылает подписчикам потока новые точки. Событие - тот же ответ, что получил
+    бы клиент, запросивший дельту от предыдущей рассылки, поэтому тело общее
+    с опросом и сериализуется один раз на всех подписчиков.
+    """
+    _, body = get_processed_body(pair_list, 'columnar', _last_published['time'], _last_published['norm_key'], version=version)
+    _last_published.update(time=result['time'][-1] if result['time'] else None, norm_key=result['norm_key'])
+    delivered = broadcaster.publish('update', body)
+    logger.info(f"Обновление отправлено {delivered} подписчикам потока")
+
+
+def publish_worker_update():
+    """Новая версия данных в рабочем процессе pre-fork: рассылка только его подписчикам потока"""
+    if not broadcaster.subscriber_count:
+        return
+    pair_list = pairs.get_pairs()
+    version = db_utils.get_data_version()
+    _, result = get_processed_result(pair_list, 'columnar', version)
+    if result is not None:
+        publish_stream(pair_list, result, version)
+
+
+def shared_payload_key(shape, since=None, encoding=None, fmt='json'):
+    key = f"{shape}|{'' if since is None else since}|{encoding or ''}"
+    return key if fmt == 'json' else f"{key}|{fmt}"
+
+
+def publish_shared_payloads(pair_list=None, previous_time=None):
+    """
+    Публикует в общую память ответы /api/processed-data для всех пар: полные в
+    каждом формате и колоночные дельты (JSON и двоичные), которые запрашивает дашборд - от
+    предыдущего обновления и от последней точки. Сжатые варианты готовятся сразу.
+    """
+    pair_list = pair_list or pairs.get_pairs()
+    version = db_utils.get_data_version()
+    bodies = {}
+    norm_key = None
+    for shape in RESULT_SHAPES:
+        _, result = get_processed_result(pair_list, shape, version)
+        if result is None:
+            return
+        norm_key = result['norm_key']
+        sinces = [None]
+        formats = ['json']
+        if shape == 'columnar':
+            formats.append('bin')
+            if result['time']:
+                sinces += {previous_time, result['time'][-1]} - {None}
+        for fmt in formats:
+            for since in sinces:
+                body = get_processed_body(pair_list, shape, since, norm_key, fmt, version)[1]
+                bodies[shared_payload_key(shape, since, fmt=fmt)] = body
+                if len(body) >= COMPRESS_MIN_SIZE:
+                    for encoding in ('gzip', 'deflate'):
+                        bodies[shared_payload_key(shape, since, encoding, fmt)] = compress_body(body, encoding)
+
+    shared_payloads.publish(bodies, {'norm_key': norm_key, 'version': version})
+    logger.info(f"Опубликовано готовых ответов для рабочих процессов: {len(bodies)}")
+
+
+def publish_master_metrics(interval=METRICS_PUBLISH_INTERVAL):
+    """Главный процесс pre-fork: периодически публикует снимок своих метрик рабочим"""
+    while True:
+        shared_metrics.publish({'snapshot': json.dumps(instrumentation.snapshot()).encode()})
+        time.sleep(interval)
+
+
+def read_master_metrics():
+    """Источник метрик рабочего процесса: последний снимок метрик главного процесса"""
+    body = shared_metrics.get('snapshot')
+    return [] if body is None else [('master', json.loads(bytes(body)))]
+
+
 def fetch_from_sqlite(table_name):
     """Получаем данные из SQLite"""
-    conn = sqlite3.connect(DB_PATH)
-    logger.info(f"Используем базу данных по пути: {DB_PATH}")
-    cursor = conn.cursor()
-
-    try:
-        # Проверяем существование таблицы
-        cursor.execute(f"""
-            SELECT timestamp, close_btc, close_eth
-            FROM {table_name} 
-            ORDER BY timestamp DESC
-        """)
-        rows = cursor.fetchall()
+    with storage.connection() as conn:
+        cursor, names = storage.query_market_data(conn, table_name)
         return [{
-            "timestamp": row[0],
-            "close_btc": row[1],
-            "close_eth": row[2]
-        } for row in rows]
-    finally:
-        conn.close()
+            "timestamp": storage.format_timestamp(row[0]),
+            **dict(zip(names, row[1:]))
+        } for row in cursor]
 
 
 def init_database():
-    """Инициализация БД (если не существует)"""
+    """Инициализация БД (если не существует); схема существующей приводится к текущей версии"""
     if not DB_PATH.exists():
         logger.info("Создаем новую базу данных...")
-        logger.info(f"Используем базу данных по пути: {DB_PATH}")
-        conn = sqlite3.connect(DB_PATH)
-        try:
-            # Создаем таблицы (пример структуры)
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS market_data_24h (
-                    timestamp TEXT PRIMARY KEY,
-                    close_btc REAL,
-                    close_eth REAL
-                )
-            """)
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS market_data_180d (
-                    timestamp TEXT PRIMARY KEY,
-                    close_btc REAL,
-                    close_eth REAL
-                )
-            """)
-            conn.commit()
-        finally:
-            conn.close()
+    logger.info(f"Используем базу данных по пути: {DB_PATH}")
+    with storage.connection() as conn, conn:
+        # Блокировка записи: несколько процессов с одной базой не добавляют колонки одновременно
+        conn.execute("BEGIN IMMEDIATE")
+        # Создаем таблицы с колонками всех зарегистрированных активов
+        for table_name in db_utils.SYNC_WINDOWS:
+            storage.ensure_market_table(conn, table_name)
+        rollups.ensure_rollup_tables(conn)
+
+
+def init_alerts(shared=False):
+    """
+    Приёмники оповещений: файл журнала и webhook из ALERT_WEBHOOK_URL, а также
+    подписчики потока и /api/alerts этого процесса или (shared=True, pre-fork)
+    таблица alert_events, из которой срабатывания пересылают рабочие процессы
+    """
+    engine = alerts.get_engine()
+    for sink in alerts.delivery_sinks(shared):
+        engine.add_sink(sink)
+    if not shared:
+        engine.add_sink(alerts.BroadcastSink(broadcaster))
+        engine.add_sink(recent_alerts)
+
+
+def start_alert_relay():
+    """Правила проверяет другой процесс: его срабатывания пересылаются подписчикам потока и в /api/alerts"""
+    alerts.watch_events([alerts.BroadcastSink(broadcaster), recent_alerts], history=recent_alerts)
 
 
 def check_data_in_database():
     """Проверяем наличие таблиц и данных"""
-    logger.info(f"Используем базу данных по пути: {DB_PATH}")
-
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        cursor = conn.cursor()
+    with storage.connection() as conn:
         for table in ['market_data_24h', 'market_data_180d']:
-            cursor.execute(f"SELECT COUNT(*) FROM {table}")
-            count = cursor.fetchone()[0]
+            count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
             logger.info(f"Table {table} contains {count} records")
-    finally:
-        conn.close()
 
 
-def run_server(port=8080):
-    """Запуск HTTP сервера"""
-    db_utils.main()
+def on_published_version():
+    """Процесс загрузки опубликовал новую версию данных (и уже проверил по ней оповещения)"""
+    instrumentation.set_gauge('updater_last_success_timestamp_seconds', time.time())
+    publish_update(evaluate_alerts=False)
+
+
+def start_ingest(live=False, external_ingest=False):
+    """
+    Источник обновлений данных: фоновый поток синхронизации (и поток цен при live)
+    или отслеживание версии, публикуемой отдельным процессом загрузки.
+    Первая синхронизация выполняется фоновым потоком: сервер сразу отдаёт статику
+    и данные, уже лежащие в базе. В режиме потока она же догружает историю и окно 180d.
+    """
+    if external_ingest:
+        db_utils.watch_published_version(on_published_version)
+        logger.info("Данные обновляет отдельный процесс загрузки (ingest_worker.py)")
+    else:
+        AutoRefreshHTTPRequestHandler.start_background_updater()
+        if live:
+            live_feed.start_ingestor(on_update=publish_update, on_flush=db_utils.publish_data_version)
+
+
+def run_prefork(port, workers, live=False, external_ingest=False):
+    """
+    Pre-fork: workers рабочих процессов принимают соединения с общего сокета.
+    Главный процесс не обслуживает запросы: он обновляет данные и после каждого
+    обновления публикует готовые ответы в общую память; рабочие отдают их без
+    пересчёта и сериализации, а о смене версии узнают через базу.
+    Оповещения проверяет главный процесс (журнал и webhook) и записывает
+    срабатывания в базу, рабочие пересылают их своим подписчикам и в /api/alerts.
+    Метрики главного процесса рабочие отдают в /api/metrics с меткой process="master".
+    """
+    global shared_payloads, shared_metrics
+    shared_payloads = SharedPayloads()
+    shared_metrics = SharedPayloads(shared_payloads.directory, METRICS_FILE_NAME)
+    # Соединения SQLite и потоки не переживают fork: процессы создаются до их запуска
+    storage.get_pool().close()
+    listener = socket.create_server(("", port), backlog=socket.SOMAXCONN)
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_worker(listener, external_ingest)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    listener.close()
+    logger.info(f"Сервер запущен на порту {port}: {workers} рабочих процессов")
+    # SIGTERM главному процессу завершает и рабочие процессы
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    start_ingest(live, external_ingest)
+    # Ответы из данных, уже лежащих в базе, доступны до первой синхронизации
+    threading.Thread(target=publish_shared_payloads, daemon=True).start()
+    threading.Thread(target=publish_master_metrics, daemon=True).start()
+    threading.Thread(
+        target=lambda: (time.sleep(1), webbrowser.open(f'http://localhost:{port}/index.html')),
+        daemon=True
+    ).start()
 
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        shared_payloads.remove()
+
+
+def serve_worker(listener, external_ingest=False):
+    """Рабочий процесс pre-fork: обслуживает запросы с унаследованного сокета"""
+    db_utils.watch_published_version(publish_worker_update)
+    start_alert_relay()
+    instrumentation.register_source(read_master_metrics)
+    if external_ingest:
+        instrumentation.register_source(db_utils.read_metrics_snapshots)
+    httpd = http.server.ThreadingHTTPServer(listener.getsockname(), AutoRefreshHTTPRequestHandler, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = listener
+    httpd.server_name = socket.getfqdn()
+    httpd.server_port = listener.getsockname()[1]
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_server(port=8080, threaded=True, live=False, profile_dir=None, external_ingest=False, workers=1):
+    """
+    Запуск HTTP сервера (threaded=True - каждый запрос в отдельном потоке).
+    live=True - цены окна 24h дополнительно принимаются из websocket-потоков биржи,
+    метрики и подписчики /api/stream обновляются по мере прихода цен.
+    profile_dir - каталог, куда пишется статистика cProfile каждого запроса.
+    external_ingest=True - сервер не загружает данные сам, а отдаёт то, что лежит
+    в базе, и следит за версией данных, которую публикует ingest_worker.py;
+    оповещения проверяет ingest_worker.py, сервер пересылает их подписчикам,
+    а метрики загрузки отдаёт в /api/metrics.
+    workers > 1 - режим pre-fork (см. run_prefork).
+    """
+    if profile_dir:
+        Path(profile_dir).mkdir(parents=True, exist_ok=True)
+        AutoRefreshHTTPRequestHandler.profile_dir = profile_dir
+        logger.info(f"Профилирование запросов включено: {profile_dir}")
     init_database()
-    AutoRefreshHTTPRequestHandler.start_background_updater()
     check_data_in_database()
+    prefork = workers > 1 and hasattr(os, 'fork')
+    if workers > 1 and not prefork:
+        logger.warning("Режим pre-fork недоступен на этой платформе, запускается один процесс")
+    # С отдельным процессом загрузки правила проверяет он, серверы только пересылают срабатывания
+    if not external_ingest:
+        init_alerts(shared=prefork)
+    if prefork:
+        return run_prefork(port, workers, live, external_ingest)
+    start_ingest(live, external_ingest)
+    if external_ingest:
+        start_alert_relay()
+        # Метрики загрузки (записанные строки, этапы) публикует ingest_worker.py через базу
+        instrumentation.register_source(db_utils.read_metrics_snapshots)
 
     try:
-        with socketserver.TCPServer(("", port), AutoRefreshHTTPRequestHandler) as httpd:
+        server_class = http.server.ThreadingHTTPServer if threaded else socketserver.TCPServer
+        with server_class(("", port), AutoRefreshHTTPRequestHandler) as httpd:
             logger.info(f"Сервер запущен на порту {port}")
             logger.info(f"API доступно: http://localhost:{port}/api/market-data?table=24h")
             logger.info(f"Пример данных: http://localhost:{port}/api/market-data?table=180d")
@@ -256,4 +849,17 @@ def run_server(port=8080):
 
 
 if __name__ == "__main__":
-    run_server(8000)
+    parser = argparse.ArgumentParser(description="Локальный HTTP сервер мониторинга спреда")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--live', action='store_true', help="Принимать цены из websocket-потоков биржи")
+    parser.add_argument('--profile', action='store_true', help="Статистика cProfile каждого запроса в profiles/")
+    parser.add_argument('--external-ingest', action='store_true', help="Данные обновляет ingest_worker.py")
+    parser.add_argument('--workers', type=int, default=1, help="Рабочих процессов (pre-fork при > 1)")
+    args = parser.parse_args()
+    run_server(
+        args.port,
+        live=args.live,
+        profile_dir='profiles' if args.profile else None,
+        external_ingest=args.external_ingest,
+        workers=args.workers,
+    )
@@ -6,13 +6,15 @@ dll_dir = "C:/Windows/System32"
 msvcp = os.path.join(dll_dir, "msvcp140.dll")
 vcomp = os.path.join(dll_dir, "vcomp140.dll")
 build_exe_options = {
-    "packages": ["os", "sqlite3", "http.server", "socketserver", "threading", "time", "json", "webbrowser"],
+    "packages": ["os", "sqlite3", "http.server", "socketserver", "threading", "time", "json", "webbrowser",
+                 # pandas и ccxt импортируются лениво (lazy_modules), сборщик их не находит сам
+                 "pandas", "ccxt"],
     "include_files": [
         "templates/",
         "market_data.db"
         # Не включаем DLL сюда — они будут скопированы вручную
     ],
-    "excludes": ["tkinter"],
+    "excludes": ["tkinter", "sklearn", "scipy"],
 }
 
 
@@ -0,0 +1,87 @@
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+SHM_DIR = '/dev/shm'  # Файлы здесь живут в памяти; без него - обычный временный каталог
+HEADER = struct.Struct('<Q')  # Длина JSON-заголовка перед телами
+FILE_NAME = 'payloads.bin'
+
+
+class SharedPayloads:
+    """
+    Готовые тела ответов, общие для процессов. Файл: длина заголовка, JSON-заголовок
+    (индекс тел и метаданные), затем тела подряд. Публикация пишет новый файл и
+    атомарно заменяет прежний; читатель отображает файл в память и отдаёт срезы
+    без копирования. Отображение прежнего файла живёт, пока его срезы отправляются.
+    """
+
+    def __init__(self, directory=None, file_name=FILE_NAME):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='spread-payloads-', dir=SHM_DIR if os.path.isdir(SHM_DIR) else None)
+        self.directory = directory
+        self.path = os.path.join(directory, file_name)
+        self._lock = threading.Lock()
+        self._signature = None  # (inode, mtime, размер) отображённого файла
+        self._map = None
+        self._base = 0
+        self._index = {}
+        self._meta = {}
+
+    def publish(self, bodies, meta=None):
+        """Публикует тела {ключ: bytes} и метаданные одним файлом"""
+        index = {}
+        offset = 0
+        for key, body in bodies.items():
+            index[key] = (offset, len(body))
+            offset += len(body)
+        header = json.dumps({'index': index, 'meta': meta or {}}).encode()
+
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(len(header)))
+            f.write(header)
+            for body in bodies.values():
+                f.write(body)
+        os.replace(tmp, self.path)
+
+    def get(self, key):
+        """Тело по ключу (memoryview отображения) или None"""
+        with self._lock:
+            self._refresh()
+            if key not in self._index:
+                return None
+            offset, length = self._index[key]
+            start = self._base + offset
+            return memoryview(self._map)[start:start + length]
+
+    def meta(self):
+        """Метаданные последней публикации"""
+        with self._lock:
+            self._refresh()
+            return dict(self._meta)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _refresh(self):
+        # Стоимость проверки - один stat; файл отображается заново только после публикации
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == self._signature:
+            return
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = HEADER.unpack_from(mapped)[0]
+        header = json.loads(mapped[HEADER.size:HEADER.size + size])
+        self._map = mapped
+        self._base = HEADER.size + size
+        self._index = header['index']
+        self._meta = header['meta']
+        self._signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
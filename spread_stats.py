@@ -0,0 +1,146 @@
+from typing import NamedTuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from metrics import epoch_ms
+
+ZSCORE_WINDOW = 240  # Свечей в окне z-score и хедж-коэффициента (4 часа минутных свечей)
+MIN_PERIODS = 30  # При меньшем числе свечей в окне значение не определено
+COINT_WINDOW = 720  # Свечей в выборке теста Энгла-Грейнджера
+COINT_INTERVAL_MS = 60 * 60 * 1000  # Тест повторяется на свечах с меткой, кратной часу
+COINT_LEVEL = '5%'  # Уровень значимости для флага cointegrated
+
+# Критические значения MacKinnon (2010) для теста Энгла-Грейнджера (два ряда, константа):
+# tau(T) = b0 + b1 / T + b2 / T^2
+COINT_CRITICAL = {
+    '1%': (-3.89644, -10.9519, -22.527),
+    '5%': (-3.33613, -6.1101, -6.823),
+    '10%': (-3.04445, -4.2412, -2.720),
+}
+
+
+class SpreadStats(NamedTuple):
+    """Скользящие статистики спредов пар: строки - время, колонки - пары"""
+    zscore: np.ndarray  # z-score логарифма соотношения base/quote
+    hedge_ratio: np.ndarray  # Наклон OLS log(base) по log(quote)
+    coint_stat: np.ndarray  # Статистика последнего теста Энгла-Грейнджера (ступенчатый ряд)
+    coint_critical: dict  # Критические значения теста для выборки COINT_WINDOW
+    cointegrated: np.ndarray  # Последний тест отвергает отсутствие коинтеграции на COINT_LEVEL
+
+
+def rolling_sum(values, window):
+    """Суммы по последним window строкам (в начале - по всем имеющимся) за O(n) через cumsum"""
+    sums = np.cumsum(values, axis=0)
+    sums[window:] -= sums[:-window].copy()
+    return sums
+
+
+def rolling_zscore(values, window=ZSCORE_WINDOW, min_periods=MIN_PERIODS):
+    """
+    Отклонение от скользящего среднего в скользящих стандартных отклонениях.
+    NaN не входят в окно (min_periods считается по значениям) и дают NaN.
+    """
+    valid = ~np.isnan(values)
+    # Сдвиг к первому значению уменьшает потерю точности в суммах квадратов
+    x = np.where(valid, values - _first_valid(values), 0.0)
+    count = rolling_sum(valid.astype(float), window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = rolling_sum(x, window) / count
+        var = rolling_sum(x * x, window) / count - mean ** 2
+        std = np.sqrt(np.maximum(var, 0))
+        zscore = np.where(std > 0, (x - mean) / std, 0.0)
+    return np.where(valid & (count >= min_periods), zscore, np.nan)
+
+
+def rolling_hedge_ratio(y, x, window=ZSCORE_WINDOW, min_periods=MIN_PERIODS):
+    """Наклон скользящей регрессии OLS y = alpha + beta * x по скользящим суммам (строки с NaN пропускаются)"""
+    valid = ~(np.isnan(y) | np.isnan(x))
+    y = np.where(valid, y - _first_valid(np.where(valid, y, np.nan)), 0.0)
+    x = np.where(valid, x - _first_valid(np.where(valid, x, np.nan)), 0.0)
+    count = rolling_sum(valid.astype(float), window)
+    sum_x = rolling_sum(x, window)
+    sum_y = rolling_sum(y, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = rolling_sum(x * x, window) - sum_x ** 2 / count
+        sxy = rolling_sum(x * y, window) - sum_x * sum_y / count
+        beta = sxy / sxx
+    return np.where(valid & (count >= min_periods) & (sxx > 0), beta, np.nan)
+
+
+def engle_granger(y, x, ends, window=COINT_WINDOW):
+    """
+    Статистика теста Энгла-Грейнджера на выборках из window свечей, оканчивающихся
+    в строках ends: OLS y по x, затем тест Дики-Фуллера (без лагов) остатков.
+    Все выборки считаются разом на страйдовых view рядов без копирования окон.
+    """
+    ends = np.asarray(ends, dtype=int)
+    if not len(ends):
+        return np.empty(0)
+    ys = sliding_window_view(y, window)[ends - window + 1]
+    xs = sliding_window_view(x, window)[ends - window + 1]
+    yc = ys - ys.mean(axis=1, keepdims=True)
+    xc = xs - xs.mean(axis=1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = (xc * yc).sum(axis=1) / (xc * xc).sum(axis=1)
+        residuals = yc - beta[:, np.newaxis] * xc
+
+        # Δe_t = gamma * e_{t-1} + ε: t-статистика gamma
+        lagged = residuals[:, :-1]
+        diff = np.diff(residuals, axis=1)
+        lagged_ss = (lagged * lagged).sum(axis=1)
+        gamma = (lagged * diff).sum(axis=1) / lagged_ss
+        errors = diff - gamma[:, np.newaxis] * lagged
+        se = np.sqrt((errors * errors).sum(axis=1) / (window - 2) / lagged_ss)
+        return gamma / se
+
+
+def critical_values(sample_size=COINT_WINDOW):
+    """Критические значения теста Энгла-Грейнджера для выборки sample_size"""
+    return {
+        level: b0 + b1 / sample_size + b2 / sample_size ** 2
+        for level, (b0, b1, b2) in COINT_CRITICAL.items()
+    }
+
+
+def calculate_spread_stats(metrics, window=ZSCORE_WINDOW, coint_window=COINT_WINDOW):
+    """SpreadStats по ценам PairMetrics; тесты коинтеграции - на свечах, кратных COINT_INTERVAL_MS"""
+    base_idx, quote_idx = metrics.asset_indices()
+    log_prices = np.log(metrics.prices)
+    log_base = log_prices[:, base_idx]
+    log_quote = log_prices[:, quote_idx]
+
+    zscore = rolling_zscore(log_base - log_quote, window)
+    hedge_ratio = rolling_hedge_ratio(log_base, log_quote, window)
+
+    # Моменты тестов привязаны ко времени, а не к позиции в окне, и не сдвигаются с окном
+    rows = len(log_prices)
+    ends = np.flatnonzero(epoch_ms(metrics.timestamps) % COINT_INTERVAL_MS == 0)
+    ends = ends[ends >= coint_window - 1]
+    coint_stat = np.full((rows, len(metrics.pairs)), np.nan)
+    if len(ends):
+        # Ступенчатый ряд: каждая строка несёт статистику последнего теста
+        latest = np.searchsorted(ends, np.arange(rows), side='right') - 1
+        tested = latest >= 0
+        for k in range(len(metrics.pairs)):
+            stats = engle_granger(log_base[:, k], log_quote[:, k], ends, coint_window)
+            coint_stat[tested, k] = stats[latest[tested]]
+
+    critical = critical_values(coint_window)
+    return SpreadStats(
+        zscore=zscore,
+        hedge_ratio=hedge_ratio,
+        coint_stat=coint_stat,
+        coint_critical=critical,
+        cointegrated=coint_stat[-1] < critical[COINT_LEVEL] if rows else np.zeros(0, dtype=bool),
+    )
+
+
+def _first_valid(values):
+    """Первое не-NaN значение каждой колонки (0 для колонки без значений)"""
+    if not len(values):
+        return np.zeros(values.shape[1:])
+    valid = ~np.isnan(values)
+    first = np.take_along_axis(values, valid.argmax(axis=0)[np.newaxis], axis=0)[0]
+    return np.where(valid.any(axis=0), first, 0.0)
@@ -0,0 +1,276 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import pairs
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1  # 1 - метки времени свечей INTEGER (мс, UTC) вместо текста
+POOL_SIZE = 8
+BUSY_TIMEOUT = 30  # Секунды ожидания блокировки записи
+MARKET_TZ = ZoneInfo('Europe/Moscow')
+OHLC_KINDS = ('open', 'high', 'low', 'close')
+
+_pool_instance = None
+_pool_lock = threading.Lock()
+
+
+def get_db_path():
+    """Получает правильный путь к базе данных, учитывая запуск как EXE и удаляет 'lib\\library.zip' из пути"""
+    # Каталог данных можно переопределить, например для бенчмарков на отдельной базе
+    if os.environ.get('MARKET_DATA_DIR'):
+        return Path(os.environ['MARKET_DATA_DIR']) / 'market_data.db'
+
+    if hasattr(sys, '_MEIPASS'):
+        # Если программа упакована в EXE, извлекаем базу данных из архивированного файла
+        base_path = sys._MEIPASS
+    else:
+        # Если запущено как скрипт, используем текущую директорию
+        base_path = Path(__file__).parent
+
+    # Преобразуем путь в строку для дальнейших манипуляций
+    base_path_str = str(base_path)
+
+    # Удаляем 'lib\library.zip' из пути, если она там есть
+    if 'lib\\library.zip' in base_path_str:
+        base_path_str = base_path_str.replace('lib\\library.zip', '')
+
+    # Возвращаем путь, добавив 'market_data.db'
+    db_path = Path(base_path_str) / 'market_data.db'
+
+    return db_path
+
+
+def format_timestamp(timestamp_ms):
+    """Метка времени свечи (мс) в прежнем текстовом виде: '2025-01-01 12:00:00+03:00'"""
+    return datetime.fromtimestamp(timestamp_ms / 1000, MARKET_TZ).isoformat(sep=' ')
+
+
+class ConnectionPool:
+    """
+    Пул соединений с базой в режиме WAL: читатели не блокируются записью
+    обновления. Соединение выдаётся одному потоку на время блока with и
+    возвращается в пул; незавершённая транзакция при возврате откатывается.
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = []
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL NORMAL не теряет целостность при сбое, но реже вызывает fsync
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+
+def get_pool():
+    """Пул соединений (Singleton); при создании схема базы приводится к текущей версии"""
+    global _pool_instance
+    with _pool_lock:
+        if _pool_instance is None:
+            pool = ConnectionPool(get_db_path())
+            with pool.connection() as conn:
+                migrate(conn)
+            _pool_instance = pool
+        return _pool_instance
+
+
+def connection():
+    """Соединение из общего пула: with storage.connection() as conn: ..."""
+    return get_pool().connection()
+
+
+def ensure_market_table(conn, table_name, assets=None):
+    """Создаёт таблицу рыночных данных и добавляет колонки цен недостающих активов"""
+    columns = [pairs.asset_column(asset) for asset in (assets if assets is not None else pairs.get_assets())]
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {table_name} "
+        f"(timestamp INTEGER PRIMARY KEY{''.join(f', {column} REAL' for column in columns)})"
+    )
+
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+    for column in columns:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} REAL")
+            logger.info(f"Добавлена колонка {column} в {table_name}")
+
+
+def upsert_rows(conn, table_name, assets, rows):
+    """
+    Запись строк (timestamp в мс, цены в порядке assets) одной транзакцией:
+    существующие свечи обновляются, новые добавляются
+    """
+    columns = [pairs.asset_column(asset) for asset in assets]
+    with conn:
+        ensure_market_table(conn, table_name, assets)
+        conn.executemany(
+            f"INSERT INTO {table_name} (timestamp, {', '.join(columns)}) "
+            f"VALUES (?{', ?' * len(columns)}) "
+            f"ON CONFLICT(timestamp) DO UPDATE SET "
+            f"{', '.join(f'{column} = excluded.{column}' for column in columns)}",
+            rows
+        )
+    return len(rows)
+
+
+def migrate(conn):
+    """Приводит схему базы к SCHEMA_VERSION"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'market\\_data\\_%' ESCAPE '\\'"
+    )]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table_name in tables:
+            _migrate_timestamps(conn, table_name)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _migrate_timestamps(conn, table_name):
+    """Перенос таблицы с текстовыми метками времени в таблицу с INTEGER (мс, UTC)"""
+    info = list(conn.execute(f"PRAGMA table_info({table_name})"))
+    if any(row[1] == 'timestamp' and row[2].upper() == 'INTEGER' for row in info):
+        return
+    columns = [row[1] for row in info if row[1] != 'timestamp']
+
+    # strftime понимает смещение '+03:00' и приводит время к UTC
+    timestamp_ms = "CAST(strftime('%s', timestamp) AS INTEGER) * 1000"
+    conn.execute(f"ALTER TABLE {table_name} RENAME TO {table_name}_text")
+    conn.execute(
+        f"CREATE TABLE {table_name} "
+        f"(timestamp INTEGER PRIMARY KEY{''.join(f', {column} REAL' for column in columns)})"
+    )
+    conn.execute(
+        f"INSERT OR REPLACE INTO {table_name} (timestamp{''.join(f', {column}' for column in columns)}) "
+        f"SELECT {timestamp_ms}{''.join(f', {column}' for column in columns)} "
+        f"FROM {table_name}_text WHERE strftime('%s', timestamp) IS NOT NULL ORDER BY timestamp"
+    )
+    conn.execute(f"DROP TABLE {table_name}_text")
+    count = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    logger.info(f"Таблица {table_name} переведена на целочисленные метки времени ({count} записей)")
+
+
+def query_market_data(conn, table_name, assets=None, start=None, end=None, limit=None, resolution=None, ohlc=False):
+    """
+    Строки таблицы в окне [start, end] (мс) от новых к старым, не больше limit.
+
+    resolution (мс) - агрегация по интервалам, выровненным по эпохе: метка интервала -
+    его начало, цена - последняя цена интервала, а при ohlc=True - open/high/low/close.
+    Возвращает (курсор, имена значений строки после timestamp).
+    """
+    assets = assets if assets is not None else pairs.get_assets()
+    columns = [pairs.asset_column(asset) for asset in assets]
+    where, params = _window_filter(start, end)
+    # LIMIT -1 в SQLite - без ограничения
+    limit = -1 if limit is None else int(limit)
+
+    if not resolution:
+        sql = (f"SELECT timestamp, {', '.join(columns)} FROM {table_name} {where} "
+               f"ORDER BY timestamp DESC LIMIT ?")
+        return conn.execute(sql, (*params, limit)), columns
+
+    resolution = int(resolution)
+    if not ohlc:
+        # Голые колонки рядом с единственным MAX() берутся из строки с максимальным timestamp
+        sql = (f"SELECT bucket, {', '.join(columns)} FROM ("
+               f"SELECT timestamp / {resolution} * {resolution} AS bucket, MAX(timestamp), {', '.join(columns)} "
+               f"FROM {table_name} {where} GROUP BY bucket) ORDER BY bucket DESC LIMIT ?")
+        return conn.execute(sql, (*params, limit)), columns
+
+    names = [f'{kind}_{asset.lower()}' for asset in assets for kind in OHLC_KINDS]
+    select = bucket_ohlc_select(table_name, ohlc_columns(conn, table_name, assets), resolution, where)
+    return conn.execute(f"{select} ORDER BY b.bucket DESC LIMIT ?", (*params, limit)), names
+
+
+def ohlc_columns(conn, table_name, assets):
+    """
+    Колонки (open, high, low, close) каждого актива. В таблицах, где хранится
+    только цена закрытия, все четыре - колонка close.
+    """
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+    columns = []
+    for asset in assets:
+        close = pairs.asset_column(asset)
+        names = [f'{kind}_{asset.lower()}' for kind in OHLC_KINDS[:3]]
+        columns.append(tuple(name if name in existing else close for name in names) + (close,))
+    return columns
+
+
+def bucket_ohlc_select(table_name, columns, resolution, where=''):
+    """
+    SELECT интервалов длиной resolution (мс), выровненных по эпохе: колонка bucket
+    (начало интервала), затем open_i, high_i, low_i, close_i для каждого актива.
+    Первая и последняя строки интервала достаются по первичному ключу.
+    """
+    extrema = ', '.join(
+        f'MAX({high}) AS high_{i}, MIN({low}) AS low_{i}' for i, (_, high, low, _) in enumerate(columns)
+    )
+    values = ', '.join(
+        f'o.{open_} AS open_{i}, b.high_{i}, b.low_{i}, c.{close} AS close_{i}'
+        for i, (open_, _, _, close) in enumerate(columns)
+    )
+    return (f"SELECT b.bucket, {values} FROM ("
+            f"SELECT timestamp / {int(resolution)} * {int(resolution)} AS bucket, "
+            f"MIN(timestamp) AS first_ts, MAX(timestamp) AS last_ts, {extrema} "
+            f"FROM {table_name} {where} GROUP BY bucket) b "
+            f"JOIN {table_name} o ON o.timestamp = b.first_ts "
+            f"JOIN {table_name} c ON c.timestamp = b.last_ts")
+
+
+def first_timestamp(conn, table_name):
+    """Метка самой ранней строки таблицы или None"""
+    return conn.execute(f"SELECT MIN(timestamp) FROM {table_name}").fetchone()[0]
+
+
+def _window_filter(start, end):
+    conditions, params = [], []
+    if start is not None:
+        conditions.append("timestamp >= ?")
+        params.append(int(start))
+    if end is not None:
+        conditions.append("timestamp <= ?")
+        params.append(int(end))
+    return ('WHERE ' + ' AND '.join(conditions) if conditions else ''), params
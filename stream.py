@@ -0,0 +1,67 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 15  # Секунды между комментариями-пингами, держащими соединение открытым
+SUBSCRIBER_QUEUE_SIZE = 16
+
+
+def format_event(event, data):
+    """Кадр Server-Sent Events из имени события и готовых байт данных (одна строка JSON)"""
+    return b'event: ' + event.encode() + b'\ndata: ' + data + b'\n\n'
+
+
+class EventBroadcaster:
+    """
+    Рассылка событий подписчикам SSE. Кадр события формируется один раз и
+    раскладывается по очередям подписчиков; медленный подписчик, чья очередь
+    переполнена, отключается, чтобы не задерживать остальных.
+    """
+
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event, data):
+        """Рассылает событие всем подписчикам; возвращает число получателей"""
+        frame = format_event(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        delivered = 0
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(frame)
+                delivered += 1
+            except queue.Full:
+                logger.warning("Подписчик не успевает читать поток, отключаем")
+                self.unsubscribe(subscriber)
+                # None в очереди - сигнал обработчику закрыть соединение
+                self._close(subscriber)
+        return delivered
+
+    @staticmethod
+    def _close(subscriber):
+        try:
+            subscriber.get_nowait()
+        except queue.Empty:
+            pass
+        subscriber.put_nowait(None)
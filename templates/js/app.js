@@ -1,6 +1,7 @@
 // Глобальные переменные для хранения экземпляров графиков
 const chartInstances = {};
 let autoRefreshTimer = null;
+let eventSource = null;
 const BTC_COLOR = "#FF9900"
 const ETH_COLOR = "#627EEA"
 async function initApp() {
@@ -94,8 +95,8 @@ async function initApp() {
         // 3. Загружаем данные
         await updateCharts();
 
-        initAutoRefresh(60);
-        setTimeout(() => initAutoRefresh(), 2000);
+        // 4. Подписываемся на поток обновлений (при недоступности - опрос)
+        startStream();
     } catch (error) {
         console.error('Ошибка инициализации приложения:', error);
         showError('Ошибка при запуске приложения');
@@ -130,36 +131,83 @@ function stopAutoRefresh() {
         autoRefreshTimer = null;
     }
 }
-// Обновление данных графиков
-async function updateCharts() {
+
+// Поток Server-Sent Events: сервер присылает новые точки сразу после обновления
+// данных. Пока поток подключён, опрос выключен; при обрыве включается снова,
+// а EventSource сам переподключается
+function startStream() {
+    if (!window.EventSource) {
+        initAutoRefresh();
+        return;
+    }
+
+    eventSource = new EventSource(API_CONFIG.endpoints.stream);
+
+    eventSource.addEventListener('open', () => {
+        console.log('Поток обновлений подключён');
+        stopAutoRefresh();
+        // За время отключения могли пропустить события - догоняем опросом
+        updateCharts();
+    });
+
+    eventSource.addEventListener('update', async event => {
+        try {
+            // null - дельта не стыкуется с локальными данными, updateCharts запросит недостающее
+            const data = acceptData(JSON.parse(event.data));
+            await updateCharts(data);
+        } catch (error) {
+            console.error('Ошибка обработки события потока:', error);
+        }
+    });
+
+    // Срабатывание серверного правила оповещений
+    eventSource.addEventListener('alert', event => {
+        const alert = JSON.parse(event.data);
+        console.warn('Оповещение:', alert);
+        showError(`Оповещение ${alert.rule}: ${alert.message}`);
+    });
+
+    eventSource.addEventListener('error', () => {
+        console.warn('Поток обновлений недоступен, переходим на опрос');
+        if (!autoRefreshTimer) initAutoRefresh();
+    });
+}
+
+// Обновление данных графиков; data - уже принятые данные из потока, иначе запрос
+async function updateCharts(data = null) {
     try {
         const loader = document.getElementById('loading-indicator');
         if (loader) loader.style.display = 'block';
 
-        const data = await fetchData();
+        if (!data) data = await fetchData();
         if (!data) {
             console.log("No data received, skipping chart update");
             return;
         }
 
+        const points = name => columnsToPoints(data.time, data[name]);
+        // Дельта дописывается в графики через update(), полный ответ заменяет данные
+        const incremental = Boolean(data.delta);
+
         // Обновляем все графики
-        updateChartIfValid('btcUsdt', 'btc_usdt', data.btc);
-        updateChartIfValid('ethUsdt', 'eth_usdt', data.eth);
+        updateChartIfValid('btcUsdt', 'btc_usdt', points('btc'), incremental);
+        updateChartIfValid('ethUsdt', 'eth_usdt', points('eth'), incremental);
 
-        updateChartIfValid('btcInEth', 'btc_in_eth', data.btc_as_eth);
-        updateChartIfValid('btcInEth', 'eth_usdt', data.eth);
+        updateChartIfValid('btcInEth', 'btc_in_eth', points('btc_as_eth'), incremental);
+        updateChartIfValid('btcInEth', 'eth_usdt', points('eth'), incremental);
 
         if (data.btc_as_eth_norm && data.eth_norm) {
-            updateChartIfValid('normalized', 'btc_normalized', data.btc_as_eth_norm);
-            updateChartIfValid('normalized', 'eth_normalized', data.eth_norm);
+            updateChartIfValid('normalized', 'btc_normalized', points('btc_as_eth_norm'), incremental);
+            updateChartIfValid('normalized', 'eth_normalized', points('eth_norm'), incremental);
         }
 
-        updateChartIfValid('priceDiffNorm', 'price_difference_norm', data.percentage_diff_norm);
+        updateChartIfValid('priceDiffNorm', 'price_difference_norm', points('percentage_diff_norm'), incremental);
         updateChartIfValid('priceDiffNorm', 'relative_spread', data.relative_spread);
 
-        updateChartIfValid('priceDiff', 'price_difference', data.percentage_diff);
+        updateChartIfValid('priceDiff', 'price_difference', points('percentage_diff'), incremental);
 
-        updateStats(data);
+        // Статистика считается по всему окну, а не только по дельте
+        updateStats(lastMarketData);
 
         calculateInput();
 
@@ -182,9 +230,12 @@ window.addEventListener('beforeunload', () => {
     if (autoRefreshTimer) {
         clearInterval(autoRefreshTimer);
     }
+    if (eventSource) {
+        eventSource.close();
+    }
 });
 
-function updateChartIfValid(chartName, seriesName, data) {
+function updateChartIfValid(chartName, seriesName, data, incremental = false) {
     if (!chartInstances[chartName]) {
         console.warn(`График ${chartName} не инициализирован`);
         return;
@@ -199,8 +250,11 @@ function updateChartIfValid(chartName, seriesName, data) {
     }
     try {
         const validData = formatChartData(data);
-        if (validData.length > 0) {
-            chartInstances[chartName].series[seriesName].setData(validData);
+        const series = chartInstances[chartName].series[seriesName];
+        if (incremental) {
+            validData.forEach(point => series.update(point));
+        } else if (validData.length > 0) {
+            series.setData(validData);
         }
     } catch (error) {
         console.error(`Ошибка обновления графика ${chartName}:`, error);
@@ -208,14 +262,14 @@ function updateChartIfValid(chartName, seriesName, data) {
 }
 
 function updateStats(data) {
-    if (!data?.percentage_diff_norm || !Array.isArray(data.percentage_diff_norm)) {
+    if (!data?.percentage_diff_norm || !isColumn(data.percentage_diff_norm)) {
         console.warn('Нет данных для статистики');
         return;
     }
 
     try {
-        const diffs = data.percentage_diff_norm
-            .map(item => parseFloat(item?.value))
+        const diffs = Array.from(data.percentage_diff_norm)
+            .map(value => parseFloat(value))
             .filter(value => !isNaN(value));
 
         if (diffs.length === 0) return;
@@ -81,6 +81,17 @@ function createMultiSeriesChart(containerId, seriesConfig) {
 }
 
 
+// Преобразование колоночного ряда (общая ось времени + значения) в точки графика
+function columnsToPoints(times, values) {
+    if (!isColumn(times) || !isColumn(values)) return [];
+
+    const points = new Array(Math.min(times.length, values.length));
+    for (let i = 0; i < points.length; i++) {
+        points[i] = { time: times[i], value: values[i] };
+    }
+    return points;
+}
+
 function formatChartData(data) {
     if (!Array.isArray(data)) return [];
 
@@ -2,36 +2,189 @@ const API_CONFIG = {
     baseUrl: window.location.origin,
     endpoints: {
         processedData: '/api/processed-data',
+        stream: '/api/stream',
     },
     defaultTable: '24h'
 };
 
+// Двоичный колоночный формат ответа (см. wire_format.py на сервере)
+const BINARY_FORMAT = {
+    contentType: 'application/octet-stream',
+    magic: 'SPRB',
+    version: 1,
+    preambleSize: 12,
+    alignment: 8,
+};
+
+// Последний полный набор данных (с уже применёнными дельтами)
 let lastMarketData = null;
 
+// Ряд значений: обычный массив (JSON) или типизированный (двоичный формат)
+function isColumn(value) {
+    return Array.isArray(value) || (ArrayBuffer.isView(value) && !(value instanceof DataView));
+}
+
+// Разбор двоичного ответа: ось time и ряды - типизированные массивы поверх
+// полученного буфера (ряды без копирования), скаляры - из JSON-заголовка
+function decodeBinaryPayload(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== BINARY_FORMAT.magic || view.getUint8(4) !== BINARY_FORMAT.version) {
+        throw new Error("Unsupported binary payload");
+    }
+    const headerLength = view.getUint32(8, true);
+    let offset = BINARY_FORMAT.preambleSize;
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, offset, headerLength)));
+    offset += headerLength;
+
+    const length = header.length;
+    // int64 собирается из двух половин: быстрее BigInt, а секунды Unix точно представимы в Number
+    const rawTime = new Uint32Array(buffer, offset, 2 * length);
+    const time = new Float64Array(length);
+    for (let i = 0; i < length; i++) time[i] = rawTime[2 * i] + rawTime[2 * i + 1] * 4294967296;
+    offset += rawTime.byteLength;
+
+    const data = { ...header.fields, time, pairs: {} };
+    Object.keys(header.pairs).forEach(name => {
+        data.pairs[name] = { ...header.pairs[name], time };
+    });
+    header.columns.forEach(([pair, key, dtype]) => {
+        const ArrayType = dtype === 'f8' ? Float64Array : Float32Array;
+        const column = new ArrayType(buffer, offset, length);
+        const padding = (BINARY_FORMAT.alignment - column.byteLength % BINARY_FORMAT.alignment) % BINARY_FORMAT.alignment;
+        offset += column.byteLength + padding;
+        (pair === null ? data : data.pairs[pair])[key] = column;
+    });
+    return data;
+}
+
+// Участок base с позиции first до start, продолженный tail. Если один из рядов
+// типизированный (двоичный ответ и JSON-событие потока), результат тоже типизированный, null -> NaN
+function concatColumns(base, first, start, tail) {
+    if (Array.isArray(base) && Array.isArray(tail)) return base.slice(first, start).concat(tail);
+    const ArrayType = ArrayBuffer.isView(base) ? base.constructor : tail.constructor;
+    const kept = start - first;
+    const merged = new ArrayType(kept + tail.length);
+    for (let i = 0; i < kept; i++) merged[i] = base[first + i] === null ? NaN : base[first + i];
+    for (let i = 0; i < tail.length; i++) merged[kept + i] = tail[i] === null ? NaN : tail[i];
+    return merged;
+}
+
+// Запрос дельты возможен, если уже есть данные: сервер вернёт точки начиная с
+// последней известной, либо полный ответ, если сменилась нормализация
+function buildProcessedDataUrl() {
+    // Добавляем случайный параметр для избежания кеширования
+    // Колоночный формат: общая ось time и массивы значений рядов
+    let url = `/api/processed-data?shape=columnar&_=${Date.now()}`;
+
+    if (lastMarketData && lastMarketData.time.length > 0) {
+        const lastTime = lastMarketData.time[lastMarketData.time.length - 1];
+        url += `&since=${lastTime}&norm_key=${encodeURIComponent(lastMarketData.norm_key)}`;
+    }
+    return url;
+}
+
+// Индекс первого элемента отсортированного массива, не меньшего value
+function lowerBound(values, value) {
+    let low = 0;
+    let high = values.length;
+    while (low < high) {
+        const mid = (low + high) >> 1;
+        if (values[mid] < value) low = mid + 1;
+        else high = mid;
+    }
+    return low;
+}
+
+// Применение дельты к колоночной записи: ряды, совпадающие по длине с осью time,
+// обрезаются по since, дополняются новыми точками и теряют точки раньше windowStart
+// (ушедшие из окна сервера); остальные поля заменяются
+function mergeColumns(base, delta, since, windowStart) {
+    const start = lowerBound(base.time, since);
+    const first = windowStart === undefined ? 0 : Math.min(lowerBound(base.time, windowStart), start);
+    const merged = { ...base };
+
+    Object.keys(delta).forEach(key => {
+        const value = delta[key];
+        const isSeries = key === 'time' || (isColumn(value) && isColumn(base[key])
+            && key !== 'relative_spread' && value.length === delta.time.length);
+        merged[key] = isSeries ? concatColumns(base[key], first, start, value) : value;
+    });
+    return merged;
+}
+
+function mergeDelta(base, delta) {
+    const windowStart = delta.window_start ?? undefined;
+    const merged = mergeColumns(base, delta, delta.since, windowStart);
+
+    merged.pairs = {};
+    Object.keys(delta.pairs || {}).forEach(name => {
+        const basePair = base.pairs && base.pairs[name];
+        merged.pairs[name] = basePair
+            ? mergeColumns(basePair, delta.pairs[name], delta.since, windowStart)
+            : delta.pairs[name];
+    });
+    delete merged.delta;
+    delete merged.since;
+    delete merged.window_start;
+    return merged;
+}
+
+// Дельта применима, если она начинается не позже последней известной точки и
+// посчитана при той же нормализации; иначе нужен полный ответ
+function canMergeDelta(base, delta) {
+    if (!base || base.time.length === 0) return false;
+    return delta.since <= base.time[base.time.length - 1] && delta.norm_key === base.norm_key;
+}
+
+// Общая обработка ответа опроса и события потока: проверка формата, слияние
+// с текущими данными и сохранение статистики. null - дельта неприменима.
+// Если окно сдвинулось и начальные точки отброшены, возвращаются все данные
+// без признака дельты, чтобы графики перерисовались по обрезанному окну
+function acceptData(data) {
+    if (!data || !isColumn(data.time) || !data.btc || !data.eth) {
+        throw new Error("Invalid data format received");
+    }
+
+    if (data.delta) {
+        if (!canMergeDelta(lastMarketData, data)) return null;
+        const previousStart = lastMarketData.time[0];
+        lastMarketData = mergeDelta(lastMarketData, data);
+        if (lastMarketData.time[0] !== previousStart) data = lastMarketData;
+    } else {
+        lastMarketData = data;
+    }
+
+    localStorage.setItem('avg_ratio_24h', String(data.avg_ratio_24h));
+    localStorage.setItem('avg_ratio_180d', String(data.avg_ratio_180d));
+    localStorage.setItem('btcMin', String(data.btc_as_eth_min));
+    localStorage.setItem('btcMax', String(data.btc_as_eth_max));
+    localStorage.setItem('ethMin', String(data.eth_min));
+    localStorage.setItem('ethMax', String(data.eth_max));
+
+    return data;
+}
+
 async function fetchData() {
     try {
-        // Добавляем случайный параметр для избежания кеширования
-        const url = `/api/processed-data?_=${Date.now()}`;
-        const response = await fetch(url);
+        const url = buildProcessedDataUrl();
+        // Двоичный формат в разы компактнее JSON и разбирается без JSON.parse рядов
+        const response = await fetch(url, { headers: { Accept: `${BINARY_FORMAT.contentType}, application/json;q=0.5` } });
 
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json();
-
-        if (!data || !data.btc || !data.eth) {
-            throw new Error("Invalid data format received");
+        const contentType = response.headers.get('Content-Type') || '';
+        const data = contentType.startsWith(BINARY_FORMAT.contentType)
+            ? decodeBinaryPayload(await response.arrayBuffer())
+            : await response.json();
+        // Дельта опроса всегда строится от последней точки клиента
+        if (data && data.delta && !canMergeDelta(lastMarketData, data)) {
+            lastMarketData = null;
+            throw new Error("Delta does not match local data");
         }
-
-        localStorage.setItem('avg_ratio_24h', String(data.avg_ratio_24h));
-        localStorage.setItem('avg_ratio_180d', String(data.avg_ratio_180d));
-        localStorage.setItem('btcMin', String(data.btc_as_eth_min));
-        localStorage.setItem('btcMax', String(data.btc_as_eth_max));
-        localStorage.setItem('ethMin', String(data.eth_min));
-        localStorage.setItem('ethMax', String(data.eth_max));
-
-        return data;
+        return acceptData(data);
 
     } catch (error) {
         console.error('Data fetch error:', error);
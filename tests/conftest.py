@@ -0,0 +1,25 @@
+import http.server
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+# Модули проекта лежат в корне репозитория. База и история - во временном
+# каталоге: тесты не трогают рабочие данные
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('MARKET_DATA_DIR', tempfile.mkdtemp(prefix='spread-monitor-tests-'))
+
+
+@pytest.fixture
+def api_url():
+    """Адрес HTTP-сервера дашборда на свободном порту (без фоновой загрузки данных)"""
+    import run_server
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), run_server.AutoRefreshHTTPRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
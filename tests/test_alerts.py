@@ -0,0 +1,72 @@
+import time
+
+import alerts
+import ingest_worker
+import storage
+from data_processor import DataProcessor
+
+
+def alert(n):
+    return {'rule': 'wide', 'pair': 'BTC/ETH', 'metric': 'percentage_diff_norm',
+            'time': 1_700_000_000 + 60 * n, 'value': 0.5 + n, 'message': f"#{n}"}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+
+def clear_events():
+    with storage.connection() as conn, conn:
+        alerts.ensure_events_table(conn)
+        conn.execute("DELETE FROM alert_events")
+
+
+def test_database_sink_keeps_latest_events():
+    clear_events()
+    sink = alerts.DatabaseSink(keep=3)
+    for n in range(5):
+        sink.deliver(alert(n))
+    with storage.connection() as conn:
+        events = alerts.read_events(conn)
+        assert [event['message'] for _, event in events] == ['#2', '#3', '#4']
+        assert [event['message'] for _, event in alerts.read_events(conn, limit=2)] == ['#3', '#4']
+        assert alerts.read_events(conn, events[-1][0]) == []
+
+
+def test_relay_delivers_history_and_new_events_once():
+    clear_events()
+    writer = alerts.DatabaseSink()
+    writer.deliver(alert(0))
+
+    # Рабочий процесс: история - в /api/alerts, новые срабатывания - ещё и подписчикам потока
+    history = alerts.MemorySink()
+    stream = alerts.MemorySink()
+    alerts.watch_events([stream, history], history=history, interval=0.01)
+    assert [a['message'] for a in history.recent()] == ['#0']
+
+    writer.deliver(alert(1))
+    writer.deliver(alert(2))
+    assert wait_for(lambda: len(stream.recent()) == 2)
+    time.sleep(0.05)
+    assert [a['message'] for a in stream.recent()] == ['#1', '#2']
+    assert [a['message'] for a in history.recent()] == ['#0', '#1', '#2']
+
+
+def test_ingest_worker_evaluates_rules_once_for_all_servers(monkeypatch):
+    clear_events()
+    engine = alerts.AlertEngine([alerts.parse_rule({'name': 'wide', 'pair': 'BTC/ETH', 'above': 0.5})],
+                                [alerts.DatabaseSink()])
+    monkeypatch.setattr(alerts, '_engine_instance', engine)
+    result = {'pair': 'BTC/ETH', 'time': [60, 120, 180], 'percentage_diff_norm': [0.7, 0.8, 0.9], 'pairs': {}}
+    monkeypatch.setattr(DataProcessor, 'get_processed_data', staticmethod(lambda pair_list, shape: result))
+    published = []
+    monkeypatch.setattr(ingest_worker.db_utils, 'publish_data_version', lambda: published.append(True))
+
+    ingest_worker.publish()
+    with storage.connection() as conn:
+        events = alerts.read_events(conn)
+    assert [(event['rule'], event['time'], event['value']) for _, event in events] == [('wide', 120, 0.8)]
+    assert published == [True]
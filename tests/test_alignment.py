@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import alignment
+
+MINUTE_MS = 60_000
+
+
+def test_fill_tolerance_from_environment(monkeypatch):
+    monkeypatch.delenv('GAP_FILL_TOLERANCE', raising=False)
+    assert alignment.get_fill_tolerance() == alignment.FILL_TOLERANCE_CANDLES
+    monkeypatch.setenv('GAP_FILL_TOLERANCE', '0')
+    assert alignment.get_fill_tolerance() == 0
+    for value in ('-1', 'три'):
+        monkeypatch.setenv('GAP_FILL_TOLERANCE', value)
+        with pytest.raises(ValueError):
+            alignment.get_fill_tolerance()
+
+
+def test_tolerance_limits_filled_gap():
+    times = np.array([0, 1, 2, 6, 7]) * MINUTE_MS
+    series = {'BTC': (times, np.arange(5.0)), 'ETH': (np.arange(8) * MINUTE_MS, np.ones(8))}
+    _, prices, stats = alignment.align_series(series, MINUTE_MS, tolerance=2)
+    assert np.isnan(prices[5, 0]) and prices[4, 0] == 2.0
+    assert stats['BTC'] == alignment.SeriesCompleteness(8, 5, 2, 1)
+
+    _, _, stats = alignment.align_series(series, MINUTE_MS, tolerance=0)
+    assert stats['BTC'] == alignment.SeriesCompleteness(8, 5, 0, 3)
+
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import backtest
+import pairs
+from normalization import scale_to_bounds
+
+PAIRS = [pairs.parse_pair('BTC/ETH'), pairs.parse_pair('SOL/ETH')]
+SIGNAL = np.array([0.0, 0.6, 0.3, 0.05, -0.7, -0.2, 0.0])
+RETURNS = np.array([0.0, 0.01, -0.02, 0.03, 0.01, 0.02, -0.01])
+
+
+def random_prices(count, seed=5):
+    rng = np.random.default_rng(seed)
+    return np.array([60000.0, 3000.0, 150.0]) * np.exp(np.cumsum(rng.normal(0, 0.003, (count, 3)), axis=0))
+
+
+def test_positions_enter_hold_and_exit():
+    position = backtest.positions(SIGNAL, np.array([0.5]), np.array([0.1]))
+    # Вход в шорт выше 0.5, удержание между порогами, выход ниже 0.1 по модулю, затем лонг ниже -0.5
+    assert position[:, 0].tolist() == [0, -1, -1, 0, 1, 1, 0]
+
+
+def test_evaluate_charges_costs_on_each_change():
+    fee, slippage = 0.001, 0.0005
+    metrics = backtest.evaluate(SIGNAL, RETURNS, [0.5], [0.1], fee, slippage)
+
+    # held = [0, 0, -1, -1, 0, 1, 1], смены позиции на барах 1, 3, 4, 6 по 2 * (fee + slippage) на ногах
+    cost = 2 * (fee + slippage)
+    net = np.array([0, -cost, 0.02, -0.03 - cost, -cost, 0.02, -0.01 - cost])
+    equity = np.cumsum(net)
+    assert metrics['pnl'][0] == pytest.approx(equity[-1])
+    assert metrics['pnl'][0] == pytest.approx(-0.012)
+    # Пик 0.017 на баре 2, минимум -0.019 на баре 4
+    assert metrics['max_drawdown'][0] == pytest.approx(0.036)
+    assert metrics['turnover'][0] == 8
+    assert metrics['trades'][0] == 2
+    assert metrics['exposure'][0] == pytest.approx(4 / 7)
+
+
+def test_trailing_signal_matches_per_pair_reference():
+    prices = random_prices(300)
+    window = 50
+    signal = backtest.trailing_signal(prices, PAIRS, window)
+    assert signal.shape == (300, 2)
+
+    assets = pairs.get_assets(PAIRS)
+    frame = pd.DataFrame(prices, columns=assets)
+    for k, pair in enumerate(PAIRS):
+        base, quote = frame[pair.base], frame[pair.quote]
+        avg_ratio = np.round((base / quote).rolling(window, min_periods=1).mean(), 2)
+        base_rolling, quote_rolling = base.rolling(window, min_periods=1), quote.rolling(window, min_periods=1)
+        base_norm = scale_to_bounds(np.round(base / avg_ratio, 2), np.round(base_rolling.min() / avg_ratio, 2),
+                                    np.round(base_rolling.max() / avg_ratio, 2))
+        quote_norm = scale_to_bounds(quote, quote_rolling.min(), quote_rolling.max())
+        np.testing.assert_allclose(signal[:, k], (base_norm - quote_norm).to_numpy())
+
+
+def test_serial_and_process_pool_sweeps_match(monkeypatch):
+    prices = random_prices(400)
+    signal = backtest.trailing_signal(prices, PAIRS, 60)
+    returns = backtest.spread_returns(prices, PAIRS)
+    entries, exits = [0.2, 0.4, 0.6, 0.8], [0.0, 0.1, 0.3]
+    # Маленькие блоки: на каждую пару приходится несколько заданий
+    monkeypatch.setattr(backtest, 'BLOCK_CELLS', 400 * 3)
+
+    serial = backtest.sweep(signal, returns, PAIRS, entries, exits, workers=1)
+    parallel = backtest.sweep(signal, returns, PAIRS, entries, exits, workers=2)
+    assert len(serial) == 2 * sum(exit < entry for entry in entries for exit in exits)
+    assert serial == parallel
@@ -0,0 +1,62 @@
+import threading
+
+from cache import VersionedCache
+
+
+class Versions:
+    def __init__(self):
+        self.value = 1
+
+    def __call__(self):
+        return self.value
+
+
+def test_value_is_cached_per_version():
+    versions = Versions()
+    cache = VersionedCache(versions)
+    calls = []
+    assert cache.get('key', lambda: calls.append(1) or 'v1') == 'v1'
+    assert cache.get('key', lambda: calls.append(1) or 'other') == 'v1'
+    versions.value = 2
+    assert cache.get('key', lambda: calls.append(1) or 'v2') == 'v2'
+    assert len(calls) == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_value_from_stale_input_is_not_cached():
+    # Запрос прочитал тело версии 1, обновление сменило версию, затем запрос сжимает
+    versions = Versions()
+    cache = VersionedCache(versions)
+    body = cache.get('body', lambda: 'old-data')
+    version = 1
+    versions.value = 2
+    assert cache.get('gz', lambda: f'gz({body})', version) == 'gz(old-data)'
+
+    # Следующий запрос версии 2 получает сжатие новых данных, а не закешированное старое
+    body = cache.get('body', lambda: 'new-data')
+    assert cache.get('gz', lambda: f'gz({body})', 2) == 'gz(new-data)'
+
+
+def test_concurrent_requests_share_one_computation():
+    cache = VersionedCache(Versions())
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'value'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('key', compute))) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ['value'] * 4
+    assert len(calls) == 1
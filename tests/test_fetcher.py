@@ -0,0 +1,86 @@
+import threading
+import time
+
+import ccxt
+import pytest
+
+import fetcher
+from mock_exchange import RecordedExchange
+
+MINUTE_MS = 60_000
+T0 = 1_700_000_000_000 // MINUTE_MS * MINUTE_MS
+
+
+class FlakyExchange(RecordedExchange):
+    """Записанная биржа, первые failures запросов которой падают с сетевой ошибкой"""
+
+    def __init__(self, recording, failures):
+        super().__init__(recording)
+        self.failures = failures
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def fetch_ohlcv(self, symbol, timeframe='1m', since=None, limit=None):
+        with self._lock:
+            self.requests.append((symbol, since, limit, time.monotonic()))
+            if self.failures:
+                self.failures -= 1
+                raise ccxt.NetworkError("connection reset")
+        return super().fetch_ohlcv(symbol, timeframe, since, limit)
+
+
+def minutes(count, start=T0, price=100.0):
+    return [[start + i * MINUTE_MS, price, price, price, price + i, 1.0] for i in range(count)]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(fetcher, 'BACKOFF_BASE', 0.001)
+
+
+def test_jobs_are_split_into_pages_and_merged():
+    count = 2 * fetcher.FETCH_LIMIT + 500
+    exchange = FlakyExchange({'BTC/USDT': {'1m': minutes(count)}, 'ETH/USDT': {'1m': minutes(30, price=10.0)}}, 0)
+    until = T0 + (count - 1) * MINUTE_MS
+    scheduler = fetcher.FetchScheduler(exchange, rate_limit_ms=0)
+
+    result = scheduler.fetch([
+        fetcher.FetchJob('btc', 'BTC/USDT', '1m', T0, until),
+        fetcher.FetchJob('eth', 'ETH/USDT', '1m', T0 + 10 * MINUTE_MS, T0 + 19 * MINUTE_MS),
+    ])
+    # Три страницы BTC с шагом FETCH_LIMIT свечей и одна ETH
+    btc_pages = sorted(since for symbol, since, _, _ in exchange.requests if symbol == 'BTC/USDT')
+    assert btc_pages == [T0 + page * fetcher.FETCH_LIMIT * MINUTE_MS for page in range(3)]
+    assert all(limit == fetcher.FETCH_LIMIT for _, _, limit, _ in exchange.requests)
+    assert result['btc'] == minutes(count)
+    # Свечи после until отбрасываются
+    assert [candle[0] for candle in result['eth']] == [T0 + i * MINUTE_MS for i in range(10, 20)]
+
+
+def test_pages_share_one_rate_limit():
+    exchange = FlakyExchange({'BTC/USDT': {'1m': minutes(5 * fetcher.FETCH_LIMIT)}}, 0)
+    interval_ms = 20
+    scheduler = fetcher.FetchScheduler(exchange, max_workers=8, rate_limit_ms=interval_ms)
+    began = time.monotonic()
+    scheduler.fetch_one('BTC/USDT', '1m', T0, T0 + (5 * fetcher.FETCH_LIMIT - 1) * MINUTE_MS)
+
+    # Пять страниц в пяти потоках, но k-й запрос уходит не раньше k интервалов от начала
+    started = sorted(moment for _, _, _, moment in exchange.requests)
+    assert len(started) == 5
+    for k, moment in enumerate(started):
+        assert moment - began >= k * interval_ms / 1000 - 1e-3
+
+
+def test_network_errors_are_retried_then_raised():
+    recording = {'BTC/USDT': {'1m': minutes(10)}}
+    until = T0 + 9 * MINUTE_MS
+    exchange = FlakyExchange(recording, fetcher.MAX_RETRIES)
+    scheduler = fetcher.FetchScheduler(exchange, rate_limit_ms=0)
+    assert scheduler.fetch_one('BTC/USDT', '1m', T0, until) == minutes(10)
+    assert len(exchange.requests) == fetcher.MAX_RETRIES + 1
+
+    exchange = FlakyExchange(recording, fetcher.MAX_RETRIES + 1)
+    scheduler = fetcher.FetchScheduler(exchange, rate_limit_ms=0)
+    with pytest.raises(ccxt.NetworkError):
+        scheduler.fetch_one('BTC/USDT', '1m', T0, until)
+    assert len(exchange.requests) == fetcher.MAX_RETRIES + 1
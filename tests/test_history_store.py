@@ -0,0 +1,146 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from history_store import DAY_MS, GROW_SLOTS, TIMEFRAME_MS, HistoryStore, backfill, fcntl
+from mock_exchange import RecordedExchange
+
+T0 = 1_700_000_040_000  # Не на границе суток
+
+
+def test_backfill_from_another_store_keeps_appends(tmp_path):
+    # Сервер и отдельный процесс докачки работают с одним каталогом
+    server = HistoryStore(tmp_path)
+    server.append('BTC', [T0, T0 + TIMEFRAME_MS], [0.5, 1.5])
+    backfill = HistoryStore(tmp_path)
+    backfill.append('BTC', [T0 - 2 * DAY_MS], [9.0])
+    server.append('BTC', [T0 + 2 * TIMEFRAME_MS], [3.0])
+
+    reader = HistoryStore(tmp_path)
+    first, values = reader.view('BTC', T0, T0 + 2 * TIMEFRAME_MS)
+    assert first == T0
+    assert values.tolist() == [0.5, 1.5, 3.0]
+    first, values = reader.view('BTC', T0 - 2 * DAY_MS, T0 - 2 * DAY_MS)
+    assert first == T0 - 2 * DAY_MS
+    assert values.tolist() == [9.0]
+    assert reader.last_timestamp('BTC') == T0 + 2 * TIMEFRAME_MS
+
+
+def _append_every_other(directory, offset, count):
+    store = HistoryStore(directory)
+    for i in range(offset, count, 2):
+        # Запись то в прошлое, то в будущее: файлы разных суток создаются вперемешку
+        timestamp = T0 + (i if i % 4 < 2 else -i) * 60 * TIMEFRAME_MS
+        store.append('ETH', [timestamp], [float(i)])
+
+
+def test_concurrent_writers_do_not_lose_candles(tmp_path):
+    count = 200
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_append_every_other, args=(tmp_path, offset, count)) for offset in (0, 1)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    store = HistoryStore(tmp_path)
+    first, values = store.view('ETH')
+    expected = {T0 + (i if i % 4 < 2 else -i) * 60 * TIMEFRAME_MS: float(i) for i in range(count)}
+    timestamps = first + np.arange(len(values)) * TIMEFRAME_MS
+    present = ~np.isnan(values)
+    assert dict(zip(timestamps[present].tolist(), values[present].tolist())) == expected
+    assert store.last_timestamp('ETH') == max(expected)
+
+
+def test_load_prices_spans_day_files(tmp_path):
+    store = HistoryStore(tmp_path)
+    timestamps = T0 + np.arange(3000) * TIMEFRAME_MS
+    store.append_rows([(t, (float(i), float(-i))) for i, t in enumerate(timestamps)], ['BTC', 'ETH'])
+    loaded, prices = store.load_prices(['BTC', 'ETH'])
+    assert loaded.tolist() == timestamps.tolist()
+    assert prices[:, 0].tolist() == list(map(float, range(3000)))
+    assert store.column('BTC').first_missing(T0, timestamps[-1]) is None
+
+
+def test_legacy_column_is_imported(tmp_path):
+    origin = T0 // DAY_MS * DAY_MS
+    values = np.full(2 * 1440, np.nan)
+    values[[5, 1500]] = [1.0, 2.0]
+    values.tofile(tmp_path / 'BTC_USDT.1m.f8')
+    (tmp_path / 'BTC_USDT.1m.json').write_text(f'{{"origin": {origin}, "timeframe": "1m", "last": null}}')
+
+    first, loaded = HistoryStore(tmp_path).view('BTC', origin, origin + 1500 * TIMEFRAME_MS)
+    assert first == origin
+    assert loaded[5] == 1.0 and loaded[1500] == 2.0
+    assert np.isnan(loaded).sum() == 1499
+    assert not (tmp_path / 'BTC_USDT.1m.f8').exists()
+
+
+def test_candles_are_partitioned_by_utc_day(tmp_path):
+    store = HistoryStore(tmp_path)
+    day = T0 // DAY_MS
+    midnight = (day + 1) * DAY_MS
+    store.append('BTC', [midnight - TIMEFRAME_MS, midnight], [1.0, 2.0])
+
+    column = store.column('BTC')
+    assert column.days() == [day, day + 1]
+    for d in (day, day + 1):
+        assert column.day_path(d).stat().st_size == GROW_SLOTS * 8
+    assert np.fromfile(column.day_path(day))[-1] == 1.0
+    assert np.fromfile(column.day_path(day + 1))[0] == 2.0
+
+    # Внутри суток - view memmap, через границу суток - копия
+    _, values = store.view('BTC', midnight, midnight + 10 * TIMEFRAME_MS)
+    assert isinstance(values.base, np.memmap)
+    first, values = store.view('BTC', midnight - TIMEFRAME_MS, midnight)
+    assert first == midnight - TIMEFRAME_MS and values.tolist() == [1.0, 2.0]
+    assert values.base is None
+
+
+def _hold_lock(directory, locked, release):
+    with HistoryStore(directory).column('BTC').locked():
+        locked.set()
+        release.wait(10)
+
+
+@pytest.mark.skipif(fcntl is None, reason="flock недоступен")
+def test_column_lock_is_exclusive_across_processes(tmp_path):
+    context = multiprocessing.get_context('fork')
+    locked, release = context.Event(), context.Event()
+    holder = context.Process(target=_hold_lock, args=(tmp_path, locked, release))
+    holder.start()
+    try:
+        assert locked.wait(10)
+        lock_path = HistoryStore(tmp_path).column('BTC').lock_path
+        with open(lock_path, 'a+b') as f:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            release.set()
+            holder.join(10)
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        release.set()
+        holder.join(10)
+    assert holder.exitcode == 0
+
+
+def test_backfill_skips_known_exchange_gaps(tmp_path):
+    start = T0 // TIMEFRAME_MS * TIMEFRAME_MS
+    timestamps = [start + i * TIMEFRAME_MS for i in range(30) if not 10 <= i < 13]
+    exchange = RecordedExchange({'BTC/USDT': {'1m': [[t, 1, 1, 1, float(t), 1] for t in timestamps]}})
+    store = HistoryStore(tmp_path)
+
+    assert backfill(exchange, ['BTC'], start, timestamps[-1], store) == 27
+    assert store.column('BTC').first_missing(start, timestamps[-1]) is None
+
+    # Пропуск биржи запомнен: повторная докачка не начинается с него заново
+    calls = exchange.calls
+    assert backfill(exchange, ['BTC'], start, timestamps[-1], store) == 0
+    assert exchange.calls == calls
+    assert np.isnan(store.view('BTC', start + 10 * TIMEFRAME_MS, start + 12 * TIMEFRAME_MS)[1]).all()
+
+    # Новая свеча после конца истории по-прежнему считается отсутствующей
+    assert store.column('BTC').first_missing(start, timestamps[-1] + TIMEFRAME_MS) == timestamps[-1] + TIMEFRAME_MS
@@ -0,0 +1,65 @@
+import pytest
+
+import db_utils
+import ingest_worker
+import instrumentation
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Пустые метрики процесса на время теста"""
+    for name in ('_histograms', '_counters', '_gauges'):
+        monkeypatch.setattr(instrumentation, name, {})
+    for name in ('_collectors', '_sources'):
+        monkeypatch.setattr(instrumentation, name, [])
+
+
+def test_render_prometheus_format(registry):
+    for value in (0.0003, 0.002, 0.002, 50.0):
+        instrumentation.observe('span_seconds', value, span='read_180d')
+    instrumentation.inc('rows_ingested_total', 5, table='market_data_24h')
+    instrumentation.inc('rows_ingested_total', 2, table='market_data_24h')
+    instrumentation.set_gauge('stream_subscribers', 3)
+    instrumentation.register_collector(lambda: [('cache_hit_ratio', 'gauge', {'cache': 'a"b\\c\nd'}, 0.5)])
+
+    lines = instrumentation.render_prometheus().splitlines()
+    assert lines[:2] == ['# HELP spread_monitor_span_seconds Длительность этапов обработки',
+                         '# TYPE spread_monitor_span_seconds histogram']
+    buckets = [line for line in lines if line.startswith('spread_monitor_span_seconds_bucket')]
+    assert len(buckets) == len(instrumentation.DEFAULT_BUCKETS) + 1
+    # Корзины накопленные, последняя - +Inf со всеми наблюдениями
+    assert buckets[0] == 'spread_monitor_span_seconds_bucket{span="read_180d",le="0.0005"} 1'
+    assert 'spread_monitor_span_seconds_bucket{span="read_180d",le="0.0025"} 3' in buckets
+    assert buckets[-2] == 'spread_monitor_span_seconds_bucket{span="read_180d",le="30.0"} 3'
+    assert buckets[-1] == 'spread_monitor_span_seconds_bucket{span="read_180d",le="+Inf"} 4'
+    assert 'spread_monitor_span_seconds_sum{span="read_180d"} 50.0043' in lines
+    assert 'spread_monitor_span_seconds_count{span="read_180d"} 4' in lines
+
+    assert lines.count('# TYPE spread_monitor_rows_ingested_total counter') == 1
+    assert 'spread_monitor_rows_ingested_total{table="market_data_24h"} 7' in lines
+    assert '# TYPE spread_monitor_stream_subscribers gauge' in lines
+    assert 'spread_monitor_stream_subscribers 3' in lines
+    # Кавычки, обратная косая черта и перевод строки в значениях меток экранируются
+    assert 'spread_monitor_cache_hit_ratio{cache="a\\"b\\\\c\\nd"} 0.5' in lines
+
+
+def test_ingest_worker_metrics_are_relayed_through_database(registry, monkeypatch):
+    db_utils.create_tables()
+    monkeypatch.setattr(db_utils, 'main', lambda: instrumentation.inc('rows_ingested_total', 60, table='market_data_24h'))
+    with instrumentation.span('get_data_page'):
+        pass
+
+    # Процесс загрузки: синхронизация и публикация
+    ingest_worker.run_once()
+    published = db_utils.read_metrics_snapshots()
+    assert [process for process, _ in published] == ['ingest']
+
+    # Сервер: своих метрик загрузки нет, снимок приходит из базы
+    for name in ('_histograms', '_counters', '_gauges'):
+        monkeypatch.setattr(instrumentation, name, {})
+    instrumentation.register_source(db_utils.read_metrics_snapshots)
+    lines = instrumentation.render_prometheus().splitlines()
+    assert 'spread_monitor_rows_ingested_total{process="ingest",table="market_data_24h"} 60' in lines
+    assert 'spread_monitor_span_seconds_count{process="ingest",span="get_data_page"} 1' in lines
+    lag = [line for line in lines if line.startswith('spread_monitor_updater_lag_seconds{process="ingest"}')]
+    assert len(lag) == 1 and 0 <= float(lag[0].split()[-1]) < 5
@@ -0,0 +1,64 @@
+import time
+
+import db_utils
+import live_feed
+import pairs
+import storage
+
+MINUTE_MS = 60_000
+
+
+def candle(timestamp, close):
+    return [timestamp, close, close, close, close, 1.0]
+
+
+def read_rows(table_name, columns):
+    with storage.connection() as conn:
+        rows = conn.execute(f"SELECT timestamp, {', '.join(columns)} FROM {table_name} ORDER BY timestamp")
+        return [tuple(row) for row in rows]
+
+
+def test_replay_flushes_closed_candles_and_keeps_open_one_pending(monkeypatch):
+    db_utils.create_tables(clear=True)
+    t0 = int(time.time() * 1000) // MINUTE_MS * MINUTE_MS - 10 * MINUTE_MS
+    t = [t0 + i * MINUTE_MS for i in range(5)]
+    exchange = live_feed.ReplayExchange({
+        pairs.asset_symbol('BTC'): [candle(t[0], 100), candle(t[1], 101), candle(t[2], 102), candle(t[3], 103),
+                                    candle(t[4], 104), candle(t[4], 105)],
+        # В потоке ETH нет свечи t[2]
+        pairs.asset_symbol('ETH'): [candle(t[0], 10), candle(t[1], 11), candle(t[3], 13), candle(t[4], 14)],
+    })
+    flushes, updates = [], []
+    ingestor = live_feed.LiveIngestor(exchange, ['BTC', 'ETH'], on_flush=lambda: flushes.append(True),
+                                      on_update=lambda: updates.append(True))
+    monkeypatch.setattr(live_feed, '_ingestor_instance', ingestor)
+
+    # Цикл идёт до конца записи, затем закрытые свечи записываются в базу
+    ingestor.run()
+
+    columns = [pairs.asset_column('BTC'), pairs.asset_column('ETH')]
+    rows = read_rows(live_feed.LIVE_TABLE, columns)
+    assert rows == [(t[0], 100, 10), (t[1], 101, 11), (t[2], 102, 11), (t[3], 103, 13)]
+    assert flushes == [True] and updates == [True]
+    assert ingestor.aggregator.closed_rows() == []
+
+    # Незакрытая свеча есть только в памяти, с последней ревизией цены
+    assert ingestor.current_rows(['BTC', 'ETH']) == [(t[4], (105.0, 14.0))]
+    assert live_feed.current_rows(['ETH', 'BTC']) == [(t[4], (14.0, 105.0))]
+    assert live_feed.current_rows(['SOL']) == []
+
+
+def test_aggregator_fills_missing_asset_from_carry():
+    aggregator = live_feed.CandleAggregator(['BTC', 'ETH'])
+    aggregator.update_candle('BTC', candle(0, 100))
+    aggregator.update_candle('ETH', candle(0, 10))
+    aggregator.update_candle('BTC', candle(MINUTE_MS, 101))
+    # ETH пропустил минуту; пока строка открыта, она видна с ценой ETH из предыдущей
+    assert aggregator.current_rows() == [(0, (100.0, 10.0)), (MINUTE_MS, (101.0, 10.0))]
+
+    aggregator.update_candle('BTC', candle(2 * MINUTE_MS, 102))
+    aggregator.update_candle('ETH', candle(2 * MINUTE_MS, 12))
+    assert aggregator.closed_rows() == [(0, (100.0, 10.0)), (MINUTE_MS, (101.0, 10.0))]
+    # Запоздавшее обновление закрытой свечи не принимается
+    assert aggregator.update_candle('ETH', candle(MINUTE_MS, 11)) is False
+    assert aggregator.current_rows()[-1] == (2 * MINUTE_MS, (102.0, 12.0))
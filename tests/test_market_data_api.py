@@ -0,0 +1,116 @@
+import gzip
+import json
+import sqlite3
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+
+import db_utils
+import rollups
+import run_server
+import storage
+
+MINUTE_MS = 60_000
+ASSETS = ['BTC', 'ETH']
+T0 = 1_700_000_000_000 // (24 * 60 * MINUTE_MS) * (24 * 60 * MINUTE_MS)
+COUNT = 60
+
+
+@pytest.fixture
+def prices():
+    """Час минутных свечей в market_data_24h и его агрегаты"""
+    db_utils.create_tables(clear=True)
+    values = np.column_stack([60000.0 + np.arange(COUNT) * 10 % 70, 3000.0 - np.arange(COUNT) % 9])
+    with storage.connection() as conn:
+        for table_name, _, _ in rollups.ROLLUP_LEVELS:
+            with conn:
+                conn.execute(f"DELETE FROM {table_name}")
+        storage.upsert_rows(conn, rollups.SOURCE_TABLE, ASSETS,
+                            [(T0 + i * MINUTE_MS, *map(float, values[i])) for i in range(COUNT)])
+        rollups.update_rollups(conn, T0, T0 + (COUNT - 1) * MINUTE_MS, ASSETS)
+    return values
+
+
+def get(url, headers=None):
+    with urllib.request.urlopen(urllib.request.Request(url, headers=headers or {})) as response:
+        body = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return json.loads(body), response.headers
+
+
+def status(url):
+    try:
+        urllib.request.urlopen(url).close()
+    except urllib.error.HTTPError as e:
+        return e.code
+    return 200
+
+
+def ts(i):
+    return storage.format_timestamp(T0 + i * MINUTE_MS)
+
+
+def test_window_and_limit(api_url, prices):
+    rows, headers = get(f"{api_url}/api/market-data?table=24h&from={(T0 + 10 * MINUTE_MS) // 1000}"
+                        f"&to={(T0 + 19 * MINUTE_MS) // 1000}")
+    assert headers['X-Data-Source'] == 'market_data_24h'
+    # От новых к старым, границы окна включительно
+    assert [row['timestamp'] for row in rows] == [ts(i) for i in range(19, 9, -1)]
+    assert rows[0]['close_btc'] == prices[19, 0]
+
+    rows, _ = get(f"{api_url}/api/market-data?table=24h&limit=3", {'Accept-Encoding': 'gzip'})
+    assert [row['timestamp'] for row in rows] == [ts(59), ts(58), ts(57)]
+
+
+def test_downsampled_rows_come_from_rollups(api_url, prices):
+    rows, headers = get(f"{api_url}/api/market-data?table=24h&from={T0 // 1000}&resolution=5")
+    assert headers['X-Data-Source'] == 'market_data_5m'
+    assert len(rows) == COUNT // 5
+    # Цена интервала - цена закрытия его последней минуты
+    assert rows[-1] == {'timestamp': ts(0), 'close_btc': prices[4, 0], 'close_eth': prices[4, 1]}
+
+    # Ни один агрегат не делит 7 минут - агрегируется исходная таблица
+    rows, headers = get(f"{api_url}/api/market-data?table=24h&from={T0 // 1000}&resolution=7")
+    assert headers['X-Data-Source'] == 'market_data_24h'
+    first = T0 // (7 * MINUTE_MS) * 7 * MINUTE_MS
+    assert [row['timestamp'] for row in rows][-2:] == [storage.format_timestamp(first + 7 * MINUTE_MS),
+                                                        storage.format_timestamp(first)]
+
+
+def test_ohlc_aggregation(api_url, prices):
+    rows, headers = get(f"{api_url}/api/market-data?table=24h&from={T0 // 1000}&resolution=15&agg=ohlc")
+    assert headers['X-Data-Source'] == 'market_data_15m'
+    assert len(rows) == COUNT // 15
+    for row in rows:
+        i = [ts(k) for k in range(COUNT)].index(row['timestamp'])
+        window = prices[i:i + 15]
+        assert row == {
+            'timestamp': ts(i),
+            'open_btc': window[0, 0], 'high_btc': window[:, 0].max(),
+            'low_btc': window[:, 0].min(), 'close_btc': window[-1, 0],
+            'open_eth': window[0, 1], 'high_eth': window[:, 1].max(),
+            'low_eth': window[:, 1].min(), 'close_eth': window[-1, 1],
+        }
+
+
+def test_invalid_parameters(api_url, prices):
+    assert status(f"{api_url}/api/market-data?limit=0") == 400
+    assert status(f"{api_url}/api/market-data?limit=ten") == 400
+    assert status(f"{api_url}/api/market-data?from=-5") == 400
+    assert status(f"{api_url}/api/market-data?resolution=5&agg=median") == 400
+    assert status(f"{api_url}/api/market-data?table=2h") == 404
+
+
+def test_json_rows_are_valid_across_chunks():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE t (timestamp INTEGER, v REAL)")
+    conn.executemany("INSERT INTO t VALUES (?, ?)", [(T0 + i * MINUTE_MS, i / 2) for i in range(5)])
+    chunks = list(run_server.iter_json_rows(conn.execute("SELECT * FROM t ORDER BY timestamp"), ['v'], chunk_rows=2))
+    assert len(chunks) == 5  # '[', три пачки, ']'
+    assert json.loads(b''.join(chunks)) == [{'timestamp': ts(i), 'v': i / 2} for i in range(5)]
+
+    empty = conn.execute("SELECT * FROM t WHERE 0")
+    assert json.loads(b''.join(run_server.iter_json_rows(empty, ['v']))) == []
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from normalization import min_max_scale
+
+preprocessing = pytest.importorskip('sklearn.preprocessing')
+
+
+def test_min_max_scale_matches_sklearn():
+    rng = np.random.default_rng(3)
+    values = np.column_stack([
+        rng.normal(100, 5, 500),
+        rng.uniform(-1, 1, 500),
+        np.full(500, 42.0),  # нулевой размах
+    ])
+    expected = preprocessing.MinMaxScaler().fit_transform(values)
+    np.testing.assert_allclose(min_max_scale(values), expected, rtol=0, atol=1e-12)
+    assert not min_max_scale(values)[:, 2].any()
@@ -0,0 +1,66 @@
+import json
+
+import numpy as np
+
+import pairs
+import run_server
+from cache import VersionedCache
+from data_processor import LEGACY_SERIES_KEYS, SERIES_FIELDS, DataProcessor
+
+
+def columnar_result(times, norm_key='n1'):
+    result = {key: [float(t) for t in times] for key in LEGACY_SERIES_KEYS}
+    result.update(time=list(times), norm_key=norm_key, relative_spread=[], pairs={})
+    return result
+
+
+def test_delta_carries_server_window_start():
+    delta = DataProcessor.build_delta(columnar_result([60, 120, 180, 240]), 180)
+    assert delta['time'] == [180, 240]
+    assert delta['window_start'] == 60
+
+    points = {key: [{'time': t, 'value': 1.0} for t in (120, 180)] for key in LEGACY_SERIES_KEYS}
+    points['pairs'] = {}
+    assert DataProcessor.build_delta(points, 180)['window_start'] == 120
+
+
+def test_body_from_stale_result_is_not_cached(monkeypatch):
+    versions = {'value': 1}
+    monkeypatch.setattr(run_server, 'processed_cache', VersionedCache(lambda: versions['value']))
+    data = {'value': columnar_result([60, 120])}
+    monkeypatch.setattr(DataProcessor, 'get_processed_data', staticmethod(lambda pair_list, shape: data['value']))
+
+    # Запрос прочитал данные версии 1, а сериализует уже после публикации версии 2
+    versions['value'] = 2
+    _, body = run_server.get_processed_body([], 'columnar', version=1)
+    assert json.loads(body)['time'] == [60, 120]
+
+    data['value'] = columnar_result([60, 120, 180])
+    _, body = run_server.get_processed_body([], 'columnar', version=2)
+    assert json.loads(body)['time'] == [60, 120, 180]
+
+
+def test_columnar_shape_matches_points_shape():
+    rng = np.random.default_rng(2)
+    pair_list = [pairs.parse_pair('BTC/ETH'), pairs.parse_pair('SOL/ETH')]
+    columns = [pairs.asset_column(asset) for asset in pairs.get_assets(pair_list)]
+    prices = np.array([60000.0, 3000.0, 150.0]) * np.exp(np.cumsum(rng.normal(0, 0.002, (300, 3)), axis=0))
+    rows = [{'timestamp': 1_700_000_000_000 + i * 60_000, **dict(zip(columns, map(float, row)))}
+            for i, row in enumerate(prices)]
+
+    points = DataProcessor.process_market_data(rows, rows, pair_list, shape='points')
+    columnar = DataProcessor.process_market_data(rows, rows, pair_list, shape='columnar')
+
+    def as_points(entry):
+        # Колоночная запись в виде рядов точек: общая ось time раскладывается по рядам
+        converted = {key: value for key, value in entry.items() if key not in ('time', 'pairs')}
+        for key in entry:
+            if key in LEGACY_SERIES_KEYS or key in SERIES_FIELDS:
+                converted[key] = [{'time': t, 'value': v} for t, v in zip(entry['time'], entry[key])]
+        return converted
+
+    assert len(columnar['time']) == 300
+    assert as_points(columnar) == {key: value for key, value in points.items() if key != 'pairs'}
+    assert columnar['pairs'].keys() == points['pairs'].keys() == {'SOL/ETH'}
+    assert as_points(columnar['pairs']['SOL/ETH']) == points['pairs']['SOL/ETH']
+    assert columnar['norm_key'] == points['norm_key']
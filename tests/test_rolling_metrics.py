@@ -0,0 +1,163 @@
+import json
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import data_processor
+import db_utils
+import pairs
+import storage
+from data_processor import DataProcessor
+from metrics import calculate_pair_metrics
+from rolling_metrics import RollingMetricsEngine
+
+MINUTE_MS = 60_000
+PAIRS = [pairs.parse_pair('BTC/ETH'), pairs.parse_pair('SOL/ETH')]
+
+
+def random_prices(rng, count):
+    # Случайное блуждание цен BTC, ETH, SOL
+    start = np.array([60000.0, 3000.0, 150.0])
+    return start * np.exp(np.cumsum(rng.normal(0, 0.002, (count, 3)), axis=0))
+
+
+def batch_metrics(times, prices, window_ms):
+    """Пакетный расчёт по свечам окна (last - window_ms, last]"""
+    rows = [
+        {'timestamp': int(t), **{pairs.asset_column(asset): p[k] for k, asset in enumerate(pairs.get_assets(PAIRS))}}
+        for t, p in zip(times, prices) if t > times[-1] - window_ms
+    ]
+    return calculate_pair_metrics(rows, PAIRS)
+
+
+def assert_same_metrics(rolling, batch):
+    assert list(rolling.timestamps) == list(batch.timestamps)
+    np.testing.assert_allclose(rolling.prices, batch.prices)
+    for field in ('avg_ratio', 'base_as_quote', 'base_as_quote_norm', 'quote_norm',
+                  'percentage_diff_normalized', 'percentage_diff'):
+        np.testing.assert_allclose(getattr(rolling, field), getattr(batch, field), atol=1e-9, err_msg=field)
+
+
+def test_snapshot_matches_batch_metrics_through_push_pending_and_eviction():
+    rng = np.random.default_rng(7)
+    window_ms = 60 * MINUTE_MS
+    engine = RollingMetricsEngine(PAIRS, window_ms=window_ms)
+    count = 150
+    times = np.arange(count) * MINUTE_MS + 1_700_000_000_000
+    prices = random_prices(rng, count)
+
+    for i in range(count - 1):
+        engine.push(times[i], prices[i])
+        if i in (30, 59, 60, 100):
+            assert_same_metrics(engine.snapshot(), batch_metrics(times[:i + 1], prices[:i + 1], window_ms))
+
+    # Незакрытая свеча перезаписывается несколько раз; в расчёте участвует только последняя версия
+    pending = prices[-1].copy()
+    for revision in (0.99, 1.02, 1.0):
+        engine.set_pending(times[-1], pending * revision)
+    assert_same_metrics(engine.snapshot(), batch_metrics(times, prices, window_ms))
+    assert len(engine) == 60
+
+    # Новая незакрытая свеча закрывает предыдущую и вытесняет старейшую свечу окна
+    next_time = times[-1] + MINUTE_MS
+    next_prices = prices[-1] * 1.01
+    engine.set_pending(next_time, next_prices)
+    all_times = np.append(times, next_time)
+    all_prices = np.vstack([prices, next_prices])
+    assert_same_metrics(engine.snapshot(), batch_metrics(all_times, all_prices, window_ms))
+    assert engine.first_timestamp == all_times[-60]
+
+
+def test_pair_order_shares_one_engine_and_engines_are_evicted(monkeypatch):
+    db_utils.create_tables(clear=True)
+    assets = pairs.get_assets(PAIRS)
+    count = 90
+    times = np.arange(count) * MINUTE_MS + int(time.time() * 1000) // MINUTE_MS * MINUTE_MS - count * MINUTE_MS
+    prices = random_prices(np.random.default_rng(3), count)
+    with storage.connection() as conn:
+        storage.ensure_market_table(conn, 'market_data_24h', assets)
+        storage.upsert_rows(conn, 'market_data_24h', assets, [(int(t), *map(float, p)) for t, p in zip(times, prices)])
+    monkeypatch.setattr(data_processor, '_rolling_engines', OrderedDict())
+    monkeypatch.setattr(data_processor, 'ROLLING_ENGINES_MAX', 2)
+
+    with storage.connection() as conn:
+        forward = data_processor.sync_rolling_metrics(conn, PAIRS)
+        backward = data_processor.sync_rolling_metrics(conn, PAIRS[::-1])
+    assert len(data_processor._rolling_engines) == 1
+    assert backward.pairs == PAIRS[::-1] and backward.assets == ['SOL', 'ETH', 'BTC']
+    assert_same_metrics(forward, batch_metrics(times, prices, 24 * 60 * MINUTE_MS))
+    assert_same_metrics(backward.reorder(PAIRS), forward)
+    np.testing.assert_array_equal(backward.base_as_quote[:, 0], forward.base_as_quote[:, 1])
+
+    # Третий набор пар вытесняет давно не запрошенный
+    btc_sol = [pairs.parse_pair('BTC/SOL')]
+    with storage.connection() as conn:
+        data_processor.sync_rolling_metrics(conn, btc_sol)
+        data_processor.sync_rolling_metrics(conn, PAIRS[:1])
+        data_processor.sync_rolling_metrics(conn, btc_sol)
+        data_processor.sync_rolling_metrics(conn, PAIRS[1:])
+    assert list(data_processor._rolling_engines) == [tuple(btc_sol), tuple(PAIRS[1:])]
+
+
+def test_missing_asset_only_blanks_its_pairs():
+    rng = np.random.default_rng(11)
+    count = 120
+    times = np.arange(count) * MINUTE_MS + 1_700_000_000_000
+    prices = random_prices(rng, count)
+    # SOL нет в первых 20 и в 70-75 свечах
+    gaps = np.zeros(count, dtype=bool)
+    gaps[:20] = gaps[70:76] = True
+    prices[gaps, 2] = np.nan
+
+    batch = batch_metrics(times, prices, count * MINUTE_MS)
+    assert len(batch.timestamps) == count
+    # BTC/ETH считается по всем строкам, как без SOL
+    only_btc_eth = calculate_pair_metrics(
+        [{'timestamp': int(t), 'close_btc': p[0], 'close_eth': p[1]} for t, p in zip(times, prices)], PAIRS[:1]
+    )
+    for field in ('avg_ratio', 'base_as_quote_norm', 'quote_norm', 'percentage_diff_normalized'):
+        np.testing.assert_allclose(getattr(batch, field)[..., 0], getattr(only_btc_eth, field)[..., 0], err_msg=field)
+    # SOL/ETH - по строкам, где есть SOL, в остальных NaN
+    assert np.isnan(batch.base_as_quote_norm[gaps, 1]).all()
+    sol_eth = prices[~gaps][:, [2, 1]]
+    assert batch.avg_ratio[1] == np.round((sol_eth[:, 0] / sol_eth[:, 1]).mean(), 2)
+    assert np.nanmin(batch.base_as_quote_norm[:, 1]) == 0 and np.nanmax(batch.base_as_quote_norm[:, 1]) == 1
+
+    # Скользящий движок совпадает с пакетным расчётом и на строках с пропусками
+    engine = RollingMetricsEngine(PAIRS, window_ms=count * MINUTE_MS)
+    assert engine.apply_rows([(t, p) for t, p in zip(times, prices)], closed_before=times[-1])
+    # Перечитанные строки с NaN не считаются ревизией
+    assert engine.apply_rows([(t, p) for t, p in zip(times[68:], prices[68:])], closed_before=times[-1])
+    assert_same_metrics(engine.snapshot(), batch)
+
+    result = DataProcessor.build_result(batch, batch, 'columnar')
+    json.dumps(result, allow_nan=False)
+    assert result['pairs']['SOL/ETH']['base_as_quote_norm'][0] is None
+    assert result['btc_as_eth_norm'][0] is not None
+
+
+def test_snapshot_derives_only_new_rows_while_window_state_is_unchanged(monkeypatch):
+    window_ms = 60 * MINUTE_MS
+    count = 200
+    times = np.arange(count) * MINUTE_MS + 1_700_000_000_000
+    # Цены колеблются внутри уже пройденного диапазона: min/max и среднее соотношение почти не меняются
+    prices = np.array([60000.0, 3000.0, 150.0]) * (1 + 0.001 * np.sin(np.arange(count))[:, np.newaxis])
+    engine = RollingMetricsEngine(PAIRS, window_ms=window_ms)
+    derived_rows = []
+    derive = engine._derive
+    monkeypatch.setattr(engine, '_derive', lambda rows, params: derived_rows.append(len(rows)) or derive(rows, params))
+
+    for i in range(count - 1):
+        engine.push(times[i], prices[i])
+        derived_rows.clear()
+        snapshot = engine.snapshot()
+        if i % 37 == 0 or i == count - 2:
+            assert_same_metrics(snapshot, batch_metrics(times[:i + 1], prices[:i + 1], window_ms))
+    # Последний вызов досчитал одну новую свечу, а не всё окно
+    assert derived_rows == [1]
+
+    engine.set_pending(times[-1], prices[-1] * 1.5)  # Новый максимум меняет нормализацию всего окна
+    derived_rows.clear()
+    assert_same_metrics(engine.snapshot(), batch_metrics(times, np.vstack([prices[:-1], prices[-1] * 1.5]), window_ms))
+    assert derived_rows == [len(engine) - 1, 1]
@@ -0,0 +1,104 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import rollups
+import storage
+
+MINUTE_MS = rollups.MINUTE_MS
+HOUR_MS = 60 * MINUTE_MS
+ASSETS = ['BTC', 'ETH']
+T0 = 1_700_000_000_000 // (24 * HOUR_MS) * (24 * HOUR_MS)  # Полночь UTC
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'market_data.db')
+    for table_name in (rollups.SOURCE_TABLE, 'market_data_180d'):
+        storage.ensure_market_table(conn, table_name, ASSETS)
+    rollups.ensure_rollup_tables(conn, ASSETS)
+    yield conn
+    conn.close()
+
+
+def minute_prices(count, seed=11):
+    rng = np.random.default_rng(seed)
+    return np.array([60000.0, 3000.0]) * np.exp(np.cumsum(rng.normal(0, 0.001, (count, 2)), axis=0))
+
+
+def insert_minutes(conn, timestamps, prices):
+    storage.upsert_rows(conn, rollups.SOURCE_TABLE, ASSETS, [(int(t), *map(float, p)) for t, p in zip(timestamps, prices)])
+    rollups.update_rollups(conn, int(min(timestamps)), int(max(timestamps)), ASSETS)
+
+
+def bucket(conn, table_name, timestamp):
+    row = conn.execute(
+        f"SELECT open_btc, high_btc, low_btc, close_btc, open_eth, high_eth, low_eth, close_eth "
+        f"FROM {table_name} WHERE timestamp = ?", (timestamp,)
+    ).fetchone()
+    return None if row is None else list(row)
+
+
+def expected_ohlc(prices):
+    return [value for k in range(prices.shape[1])
+            for value in (prices[0, k], prices[:, k].max(), prices[:, k].min(), prices[-1, k])]
+
+
+def test_rollup_buckets_hold_ohlc_of_minutes(conn):
+    timestamps = T0 + np.arange(180) * MINUTE_MS
+    prices = minute_prices(180)
+    insert_minutes(conn, timestamps, prices)
+
+    for table_name, resolution in (('market_data_5m', 5 * MINUTE_MS), ('market_data_15m', 15 * MINUTE_MS),
+                                   ('market_data_1h', HOUR_MS)):
+        per_bucket = resolution // MINUTE_MS
+        count = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+        assert count == 180 // per_bucket
+        for i in range(0, 180, per_bucket):
+            assert bucket(conn, table_name, int(timestamps[i])) == pytest.approx(expected_ohlc(prices[i:i + per_bucket]))
+
+
+def test_revised_and_late_candles_rebuild_only_their_buckets(conn):
+    timestamps = T0 + np.arange(60) * MINUTE_MS
+    prices = minute_prices(60)
+    # Свеча 42-й минуты приходит с опозданием
+    keep = np.arange(60) != 42
+    insert_minutes(conn, timestamps[keep], prices[keep])
+    assert bucket(conn, 'market_data_5m', int(T0 + 40 * MINUTE_MS)) == pytest.approx(
+        expected_ohlc(prices[40:45][[0, 1, 3, 4]])
+    )
+
+    # Метка в чужом интервале: если бы пересчитывалось всё, она бы исчезла
+    conn.execute("UPDATE market_data_5m SET high_btc = -1 WHERE timestamp = ?", (T0,))
+    conn.commit()
+
+    prices[42] = [99999.0, 1.0]
+    insert_minutes(conn, timestamps[42:43], prices[42:43])
+    prices[7] = [70000.0, 3100.0]  # Ревизия уже сохранённой свечи
+    insert_minutes(conn, timestamps[7:8], prices[7:8])
+
+    assert bucket(conn, 'market_data_5m', int(T0 + 40 * MINUTE_MS)) == pytest.approx(expected_ohlc(prices[40:45]))
+    assert bucket(conn, 'market_data_5m', int(T0 + 5 * MINUTE_MS)) == pytest.approx(expected_ohlc(prices[5:10]))
+    assert bucket(conn, 'market_data_5m', int(T0))[1] == -1
+    assert bucket(conn, 'market_data_1h', int(T0))[6] == 1.0  # low_eth часа видит позднюю свечу
+
+
+def test_select_table_picks_coarsest_dividing_table(conn):
+    timestamps = T0 + np.arange(24 * 60) * MINUTE_MS
+    insert_minutes(conn, timestamps, minute_prices(24 * 60))
+    source = rollups.SOURCE_TABLE
+
+    assert rollups.select_table(conn, source, T0, HOUR_MS) == ('market_data_1h', T0)
+    assert rollups.select_table(conn, source, T0, 2 * HOUR_MS) == ('market_data_1h', T0)
+    # 15m не делит 10 минут, 5m делит
+    assert rollups.select_table(conn, source, T0, 10 * MINUTE_MS) == ('market_data_5m', T0)
+    assert rollups.select_table(conn, source, T0, 24 * HOUR_MS, ohlc=True) == ('market_data_1d', T0)
+    # Начало запроса округляется до интервала
+    assert rollups.select_table(conn, source, T0 + 61 * MINUTE_MS, HOUR_MS) == ('market_data_1h', T0 + HOUR_MS)
+
+    # Ни одна таблица агрегатов не делит 7 минут; без агрегации - исходная таблица
+    assert rollups.select_table(conn, source, T0, 7 * MINUTE_MS) == (source, T0)
+    assert rollups.select_table(conn, source, T0) == (source, T0)
+    # Агрегаты не покрывают начало запроса
+    assert rollups.select_table(conn, source, T0 - HOUR_MS, HOUR_MS) == (source, T0 - HOUR_MS)
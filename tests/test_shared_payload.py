@@ -0,0 +1,78 @@
+import json
+import os
+import time
+
+import instrumentation
+import run_server
+from shared_payload import SharedPayloads
+
+
+def body(version, key):
+    # Тело однозначно определяется версией: по нему видно, не смешались ли публикации
+    return bytes([version % 251]) * (1000 + 37 * version) + key.encode()
+
+
+def test_publish_swaps_file_and_keeps_old_views(tmp_path):
+    writer = SharedPayloads(str(tmp_path))
+    reader = SharedPayloads(str(tmp_path))
+    assert reader.get('a') is None and reader.meta() == {}
+
+    writer.publish({'a': body(1, 'a'), 'b': body(1, 'b')}, {'version': 1})
+    old = reader.get('a')
+    inode = os.stat(writer.path).st_ino
+    assert bytes(old) == body(1, 'a') and reader.meta() == {'version': 1}
+
+    writer.publish({'a': body(2, 'a')}, {'version': 2})
+    # Файл заменён целиком, временных файлов не осталось
+    assert os.stat(writer.path).st_ino != inode
+    assert os.listdir(tmp_path) == ['payloads.bin']
+    assert bytes(reader.get('a')) == body(2, 'a')
+    assert reader.get('b') is None and reader.meta() == {'version': 2}
+    # Срез прежнего отображения, ещё не отправленный клиенту, не изменился
+    assert bytes(old) == body(1, 'a')
+
+
+def test_reads_during_concurrent_publishes_are_consistent(tmp_path):
+    SharedPayloads(str(tmp_path)).publish({'a': body(0, 'a')}, {'version': 0})
+    pid = os.fork()
+    if pid == 0:
+        try:
+            writer = SharedPayloads(str(tmp_path))
+            for version in range(1, 300):
+                writer.publish({'a': body(version, 'a'), 'b': body(version, 'b')}, {'version': version})
+        finally:
+            os._exit(0)
+
+    reader = SharedPayloads(str(tmp_path))
+    seen = set()
+    while True:
+        done = os.waitpid(pid, os.WNOHANG)[0] == pid
+        data = bytes(reader.get('a'))
+        version = (len(data) - 1001) // 37
+        assert data == body(version, 'a')
+        seen.add(version)
+        if done:
+            break
+    assert 299 in seen
+
+
+def test_worker_metrics_include_master_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, '_sources', [])
+    shared = SharedPayloads(str(tmp_path), run_server.METRICS_FILE_NAME)
+    monkeypatch.setattr(run_server, 'shared_metrics', shared)
+    instrumentation.register_source(run_server.read_master_metrics)
+    assert run_server.read_master_metrics() == []
+
+    # Снимок главного процесса: запись свечей и этап загрузки
+    master = {
+        'histograms': [['span_seconds', [['span', 'get_data_page']], [0.1, 1.0], [2, 1, 0], 0.4, 3]],
+        'counters': [['rows_ingested_total', [['table', 'market_data_24h']], 120]],
+        'gauges': [['updater_last_success_timestamp_seconds', [], time.time() - 30]],
+    }
+    shared.publish({'snapshot': json.dumps(master).encode()})
+    text = instrumentation.render_prometheus()
+    assert 'spread_monitor_rows_ingested_total{process="master",table="market_data_24h"} 120' in text
+    assert 'spread_monitor_span_seconds_bucket{process="master",span="get_data_page",le="1.0"} 3' in text
+    assert 'spread_monitor_span_seconds_count{process="master",span="get_data_page"} 3' in text
+    lag = [line for line in text.splitlines() if line.startswith('spread_monitor_updater_lag_seconds{process="master"}')]
+    assert len(lag) == 1 and 29 < float(lag[0].split()[-1]) < 40
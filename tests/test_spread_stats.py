@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import spread_stats
+
+
+def random_walks(count, columns=2, seed=13):
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.normal(0, 0.01, (count, columns)), axis=0) + 4.0
+
+
+def test_rolling_stats_skip_missing_values():
+    values = random_walks(300)
+    values[:15, 1] = np.nan
+    values[100:140, 1] = np.nan
+    window, min_periods = 60, 20
+
+    zscore = spread_stats.rolling_zscore(values, window, min_periods)
+    frame = pd.DataFrame(values).rolling(window, min_periods=min_periods)
+    expected = ((pd.DataFrame(values) - frame.mean()) / frame.std(ddof=0)).to_numpy()
+    np.testing.assert_allclose(zscore, expected, atol=1e-7)
+    # Пропуск в одном ряду не затрагивает другой
+    assert not np.isnan(zscore[min_periods - 1:, 0]).any()
+
+    y, x = values[:, 1], values[:, 0]
+    beta = spread_stats.rolling_hedge_ratio(y[:, np.newaxis], x[:, np.newaxis], window, min_periods)[:, 0]
+    pair = pd.DataFrame({'y': y, 'x': x})
+    pair.loc[np.isnan(y), 'x'] = np.nan
+    rolling = pair.rolling(window, min_periods=min_periods)
+    expected = np.where(np.isnan(y), np.nan, rolling.cov(pair['x'])['y'] / rolling.var()['x'])
+    np.testing.assert_allclose(beta, expected, atol=1e-7)
+
+
+def test_rolling_stats_match_pandas():
+    values = random_walks(500, 3)
+    window, min_periods = 120, 30
+    zscore = spread_stats.rolling_zscore(values, window, min_periods)
+    frame = pd.DataFrame(values)
+    rolling = frame.rolling(window, min_periods=min_periods)
+    np.testing.assert_allclose(zscore, ((frame - rolling.mean()) / rolling.std(ddof=0)).to_numpy(), atol=1e-7)
+    assert np.isnan(zscore[:min_periods - 1]).all() and not np.isnan(zscore[min_periods - 1:]).any()
+
+    y, x = values[:, :2], values[:, 2:]
+    beta = spread_stats.rolling_hedge_ratio(y, np.repeat(x, 2, axis=1), window, min_periods)
+    for k in range(2):
+        pair = pd.DataFrame({'y': y[:, k], 'x': x[:, 0]}).rolling(window, min_periods=min_periods)
+        expected = pair.cov().xs('y', level=1)['x'] / pair.var()['x']
+        np.testing.assert_allclose(beta[:, k], expected.to_numpy(), atol=1e-7)
+
+
+def dickey_fuller(y, x):
+    """Эталон: OLS y по x с константой и t-статистика DF остатков без константы и лагов"""
+    design = np.column_stack([np.ones_like(x), x])
+    residuals = y - design @ np.linalg.lstsq(design, y, rcond=None)[0]
+    lagged, diff = residuals[:-1], np.diff(residuals)
+    gamma = lagged @ diff / (lagged @ lagged)
+    errors = diff - gamma * lagged
+    return gamma / np.sqrt(errors @ errors / (len(diff) - 1) / (lagged @ lagged))
+
+
+def test_engle_granger_separates_cointegrated_and_independent_series():
+    rng = np.random.default_rng(21)
+    count, window = 2000, 720
+    x = np.cumsum(rng.normal(0, 0.01, count)) + 8.0
+    cointegrated = 0.7 * x + 1.0 + rng.normal(0, 0.005, count)
+    ends = np.array([window - 1, 1000, count - 1])
+    critical = spread_stats.critical_values(window)
+
+    stats = spread_stats.engle_granger(cointegrated, x, ends, window)
+    assert (stats < critical['1%']).all()
+    # Независимые блуждания отвергают отсутствие коинтеграции примерно в 5% выборок на уровне 5%
+    walks = np.cumsum(rng.normal(0, 0.01, (400, 2, window)), axis=2)
+    rejected = np.mean([spread_stats.engle_granger(a, b, [window - 1], window)[0] < critical['5%'] for a, b in walks])
+    assert 0.01 < rejected < 0.1
+    # Каждое окно считается как отдельная регрессия на своей выборке
+    for end, stat in zip(ends, stats):
+        sample = slice(end - window + 1, end + 1)
+        assert stat == pytest.approx(dickey_fuller(cointegrated[sample], x[sample]), rel=1e-9)
+    assert len(spread_stats.engle_granger(x, x, [], window)) == 0
@@ -0,0 +1,46 @@
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import storage
+
+MSK = timezone(timedelta(hours=3))
+
+
+def baseline_db(path, rows):
+    """База в исходной схеме: текстовые метки времени со смещением, как их писал pandas.to_sql"""
+    conn = sqlite3.connect(path)
+    for table_name in ('market_data_24h', 'market_data_180d'):
+        conn.execute(f"CREATE TABLE {table_name} (timestamp TEXT PRIMARY KEY, close_btc REAL, close_eth REAL)")
+        conn.executemany(f"INSERT INTO {table_name} VALUES (?, ?, ?)", rows)
+    conn.commit()
+    return conn
+
+
+def dump(conn, table_name):
+    return conn.execute(f"SELECT timestamp, close_btc, close_eth FROM {table_name} ORDER BY timestamp").fetchall()
+
+
+def test_migrate_converts_text_timestamps_to_epoch_ms(tmp_path):
+    moments = [datetime(2025, 1, 1, 12, minute, tzinfo=MSK) for minute in range(5)]
+    rows = [(moment.isoformat(sep=' '), 60000.0 + i, 3000.0 + i) for i, moment in enumerate(moments)]
+    conn = baseline_db(tmp_path / 'market_data.db', rows)
+
+    storage.migrate(conn)
+
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == storage.SCHEMA_VERSION
+    for table_name in ('market_data_24h', 'market_data_180d'):
+        info = {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+        assert info['timestamp'] == 'INTEGER'
+        expected = [(int(moment.timestamp() * 1000), 60000.0 + i, 3000.0 + i) for i, moment in enumerate(moments)]
+        assert dump(conn, table_name) == expected
+        # Обратное преобразование даёт прежний текст
+        assert [storage.format_timestamp(row[0]) for row in expected] == [row[0] for row in rows]
+    assert not conn.execute("SELECT name FROM sqlite_master WHERE name LIKE '%_text'").fetchall()
+
+    # Повторный запуск (в том числе со сброшенной версией схемы) ничего не меняет
+    before = dump(conn, 'market_data_24h')
+    storage.migrate(conn)
+    conn.execute("PRAGMA user_version = 0")
+    storage.migrate(conn)
+    assert dump(conn, 'market_data_24h') == before
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == storage.SCHEMA_VERSION
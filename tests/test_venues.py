@@ -0,0 +1,109 @@
+import time
+
+import numpy as np
+import pytest
+
+import db_utils
+import storage
+import venues
+from mock_exchange import RecordedExchange
+
+MINUTE_MS = 60_000
+CANDLES = 30
+PRICES = {
+    'binance_futures': {'BTC': 60000.0, 'ETH': 3000.0},
+    'bybit': {'BTC': 60030.0, 'ETH': 2997.0},
+}
+GAP = ('bybit', 'BTC', 10)  # На bybit нет 10-й свечи BTC
+
+
+@pytest.fixture
+def recordings(tmp_path, monkeypatch):
+    """Записанные свечи двух площадок за последние CANDLES минут, в одной из них пропуск"""
+    end = int(time.time() * 1000) // MINUTE_MS * MINUTE_MS - MINUTE_MS
+    times = [end - (CANDLES - 1 - i) * MINUTE_MS for i in range(CANDLES)]
+    for name, prices in PRICES.items():
+        venue = venues.VENUE_PRESETS[name]
+        recording = {}
+        for asset, price in prices.items():
+            ohlcv = [[t, price, price, price, price + i, 1.0] for i, t in enumerate(times)]
+            if (name, asset) == GAP[:2]:
+                del ohlcv[GAP[2]]
+            recording[venue.symbol(asset)] = {'1m': ohlcv}
+        RecordedExchange(recording).save(tmp_path / f"{name}.json")
+
+    monkeypatch.setenv('VENUES', ','.join(PRICES))
+    monkeypatch.setenv('ARBITRAGE_PAIRS', 'BTC/ETH')
+    monkeypatch.setenv(venues.RECORDINGS_ENV, str(tmp_path))
+    monkeypatch.setattr(venues, '_clients', {})
+    with storage.connection() as conn, conn:
+        venues.ensure_venue_table(conn)
+        conn.execute("DELETE FROM venue_candles")
+    return times
+
+
+def test_collect_candles_keeps_venue_gap(recordings):
+    candles = venues.collect_candles(venues.get_venues(), ['BTC', 'ETH'], recordings[0])
+
+    assert set(candles) == {(venue, asset) for venue in PRICES for asset in ('BTC', 'ETH')}
+    assert [c[0] for c in candles[('binance_futures', 'BTC')]] == recordings
+    bybit_btc = [c[0] for c in candles[('bybit', 'BTC')]]
+    assert len(bybit_btc) == CANDLES - 1
+    assert recordings[GAP[2]] not in bybit_btc
+
+
+def test_sync_venue_candles_is_idempotent(recordings):
+    assert venues.sync_venue_candles() == 4 * CANDLES - 1
+    # Повторная синхронизация перезапрашивает только последние свечи и не дублирует строки
+    venues.sync_venue_candles()
+    with storage.connection() as conn:
+        counts = dict(conn.execute(
+            "SELECT venue || '/' || asset, COUNT(*) FROM venue_candles GROUP BY venue, asset"
+        ).fetchall())
+    assert counts == {
+        'binance_futures/BTC': CANDLES, 'binance_futures/ETH': CANDLES,
+        'bybit/BTC': CANDLES - 1, 'bybit/ETH': CANDLES,
+    }
+
+
+def test_spread_matrix():
+    prices = np.array([[100.0, 101.0, 99.0], [100.0, np.nan, 102.0]])
+    spreads = venues.spread_matrix(prices)
+
+    assert spreads.shape == (2, 3, 3)
+    np.testing.assert_allclose(np.diagonal(spreads[0]), 0)
+    assert spreads[0, 1, 0] == pytest.approx(1.0)
+    assert spreads[0, 0, 2] == pytest.approx((100 / 99 - 1) * 100)
+    assert spreads[1, 0, 2] == pytest.approx((100 / 102 - 1) * 100)
+    assert np.isnan(spreads[1, 1]).all() and np.isnan(spreads[1, :, 1]).all()
+
+
+def test_venue_spreads_has_null_basis_at_gap(recordings):
+    venues.sync_venue_candles()
+    with storage.connection() as conn:
+        spreads = venues.venue_spreads(conn, 'BTC')
+
+    assert spreads['venues'] == ['binance_futures', 'bybit']
+    assert spreads['time'] == [t // 1000 for t in recordings]
+    basis = spreads['basis']['binance_futures/bybit']
+    gap = GAP[2]
+    assert basis[gap] is None
+    assert spreads['prices']['bybit'][gap] is None
+    assert spreads['prices']['binance_futures'][gap] == 60000.0 + gap
+    assert basis[0] == pytest.approx((60000.0 / 60030.0 - 1) * 100)
+
+    assert spreads['latest_time'] == recordings[-1] // 1000
+    last = CANDLES - 1
+    expected = (60000.0 + last) / (60030.0 + last)
+    assert spreads['matrix'][0][1] == pytest.approx((expected - 1) * 100)
+    assert spreads['matrix'][1][0] == pytest.approx((1 / expected - 1) * 100)
+    assert spreads['matrix'][0][0] == 0
+
+
+def test_main_tables_use_the_registry_client(recordings):
+    exchange = db_utils.initialize_exchange()
+    client, scheduler = venues.get_client(venues.VENUE_PRESETS[db_utils.MAIN_VENUE])
+    # Синхронизация таблиц и свечи площадок расходуют один бюджет запросов
+    assert exchange is client
+    assert db_utils.get_scheduler(exchange) is scheduler
+    assert venues.find_scheduler(RecordedExchange({})) is None
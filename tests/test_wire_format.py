@@ -0,0 +1,75 @@
+import json
+import math
+
+import numpy as np
+
+import pairs
+import wire_format
+from data_processor import LEGACY_SERIES_KEYS, SERIES_FIELDS, DataProcessor
+
+MINUTE_MS = 60_000
+T0 = 1_700_000_000_000 // MINUTE_MS * MINUTE_MS
+PAIRS = [pairs.parse_pair('BTC/ETH'), pairs.parse_pair('SOL/ETH')]
+
+
+def raw_rows(count, seed=3):
+    rng = np.random.default_rng(seed)
+    prices = np.array([60000.0, 3000.0, 150.0]) * np.exp(np.cumsum(rng.normal(0, 0.002, (count, 3)), axis=0))
+    columns = [pairs.asset_column(asset) for asset in pairs.get_assets(PAIRS)]
+    return [{'timestamp': T0 + i * MINUTE_MS, **dict(zip(columns, map(float, row)))} for i, row in enumerate(prices)]
+
+
+def assert_same_series(decoded, original, dtype):
+    decoded = np.array(decoded, dtype=np.float64)
+    expected = np.array([math.nan if value is None else value for value in original], dtype=np.float64)
+    np.testing.assert_array_equal(decoded, expected.astype(dtype).astype(np.float64))
+
+
+def test_columnar_round_trip():
+    rows = raw_rows(400)
+    result = DataProcessor.process_market_data(rows, rows, PAIRS, shape='columnar')
+    body = wire_format.encode_columnar(result)
+
+    magic, version, header_length = wire_format.PREAMBLE.unpack_from(body)
+    assert (magic, version) == (wire_format.MAGIC, wire_format.VERSION)
+    # Заголовок дополнен до границы 8 байт, за ним - ось time и колонки
+    assert (wire_format.PREAMBLE.size + header_length) % 8 == 0
+    header = json.loads(body[wire_format.PREAMBLE.size:wire_format.PREAMBLE.size + header_length])
+    assert header['length'] == len(result['time'])
+    widths = {key: dtype for pair, key, dtype in header['columns'] if pair is None}
+    assert widths['btc'] == widths['btc_as_eth'] == 'f8'
+    assert widths['zscore'] == widths['percentage_diff_norm'] == 'f4'
+    # Каждая колонка начинается с границы 8 байт
+    assert len(body) % 8 == 0
+    column_bytes = sum(header['length'] * int(dtype[1:]) for _, _, dtype in header['columns'])
+    padding = sum(-header['length'] * int(dtype[1:]) % 8 for _, _, dtype in header['columns'])
+    assert len(body) == wire_format.PREAMBLE.size + header_length + 8 * header['length'] + column_bytes + padding
+
+    decoded = wire_format.decode_columnar(body)
+    time_offset = wire_format.PREAMBLE.size + header_length
+    assert np.frombuffer(body, '<i8', header['length'], time_offset).tolist() == result['time']
+    assert decoded['time'] == result['time']
+    assert decoded['norm_key'] == result['norm_key']
+    assert decoded['pair'] == 'BTC/ETH'
+    for key in LEGACY_SERIES_KEYS:
+        assert_same_series(decoded[key], result[key], '<' + widths[key])
+
+    entry, original = decoded['pairs']['SOL/ETH'], result['pairs']['SOL/ETH']
+    assert entry['time'] == result['time']
+    assert entry['avg_ratio_24h'] == original['avg_ratio_24h']
+    for key in SERIES_FIELDS:
+        assert_same_series(entry[key], original[key], '<f8' if key in wire_format.FLOAT64_FIELDS else '<f4')
+    # null начала скользящих рядов приходит как NaN
+    assert original['zscore'][0] is None and math.isnan(entry['zscore'][0])
+
+
+def test_odd_length_columns_are_padded():
+    result = {'time': [60, 120, 180], 'pair': 'BTC/ETH', 'zscore': [None, 1.5, 2.0], 'btc': [1.0, 2.0, 3.0],
+              'pairs': {}}
+    body = wire_format.encode_columnar(result)
+    # time 24 байта, zscore 12 (+4 выравнивания), btc 24
+    _, _, header_length = wire_format.PREAMBLE.unpack_from(body)
+    assert len(body) == wire_format.PREAMBLE.size + header_length + 24 + 16 + 24
+    decoded = wire_format.decode_columnar(body)
+    assert math.isnan(decoded['zscore'][0]) and decoded['zscore'][1:] == [1.5, 2.0]
+    assert decoded['btc'] == [1.0, 2.0, 3.0]
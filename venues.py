@@ -0,0 +1,272 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+import fetcher
+import instrumentation
+import pairs
+import storage
+from lazy_modules import lazy_import
+from mock_exchange import RecordedExchange, record_ohlcv
+
+ccxt = lazy_import('ccxt')
+logger = logging.getLogger(__name__)
+
+# Площадки задаются через переменную окружения, например VENUES="binance_futures,binance_spot,bybit,okx"
+DEFAULT_VENUES = 'binance_futures'
+# Каталог записанных свечей (<площадка>.json): вместо бирж используется RecordedExchange
+RECORDINGS_ENV = 'VENUE_RECORDINGS'
+
+VENUE_TIMEFRAME = '1m'
+VENUE_WINDOW_HOURS = 24  # Глубина хранения свечей площадок
+VENUE_OVERLAP_CANDLES = 3  # Последние свечи перезапрашиваются, чтобы подхватить их ревизии
+
+
+class Venue(NamedTuple):
+    """Площадка: биржа ccxt и тип рынка (spot или бессрочные фьючерсы swap)"""
+    name: str
+    exchange_id: str
+    market_type: str
+
+    def symbol(self, asset):
+        """Унифицированный символ ccxt: BTC/USDT на споте, BTC/USDT:USDT для фьючерсов"""
+        symbol = pairs.asset_symbol(asset)
+        return symbol if self.market_type == 'spot' else f"{symbol}:{pairs.QUOTE_CURRENCY}"
+
+
+VENUE_PRESETS = {
+    'binance_futures': Venue('binance_futures', 'binance', 'swap'),
+    'binance_spot': Venue('binance_spot', 'binance', 'spot'),
+    'bybit': Venue('bybit', 'bybit', 'swap'),
+    'bybit_spot': Venue('bybit_spot', 'bybit', 'spot'),
+    'okx': Venue('okx', 'okx', 'swap'),
+    'okx_spot': Venue('okx_spot', 'okx', 'spot'),
+}
+
+_clients = {}  # Имя площадки -> (клиент биржи, планировщик загрузки)
+_clients_lock = threading.Lock()
+
+
+def get_venues():
+    """Зарегистрированные площадки в порядке объявления"""
+    venues = []
+    for name in os.environ.get('VENUES', DEFAULT_VENUES).split(','):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name not in VENUE_PRESETS:
+            raise ValueError(f"Неизвестная площадка: {name!r}")
+        if VENUE_PRESETS[name] not in venues:
+            venues.append(VENUE_PRESETS[name])
+    return venues
+
+
+def get_client(venue):
+    """Клиент биржи площадки и его планировщик с собственным бюджетом запросов (по одному на площадку)"""
+    with _clients_lock:
+        if venue.name not in _clients:
+            recordings = os.environ.get(RECORDINGS_ENV)
+            if recordings:
+                exchange = RecordedExchange.load(Path(recordings) / f"{venue.name}.json")
+            else:
+                exchange = getattr(ccxt, venue.exchange_id)({
+                    'enableRateLimit': True,
+                    'options': {'defaultType': venue.market_type}
+                })
+            _clients[venue.name] = (exchange, fetcher.FetchScheduler(exchange))
+        return _clients[venue.name]
+
+
+def find_scheduler(exchange):
+    """Планировщик клиента биржи из реестра площадок или None, если клиент создан не get_client"""
+    with _clients_lock:
+        for client, scheduler in _clients.values():
+            if client is exchange:
+                return scheduler
+    return None
+
+
+def ensure_venue_table(conn):
+    """Цены закрытия площадок: одна строка на площадку, актив и свечу"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS venue_candles (
+            venue TEXT,
+            asset TEXT,
+            timestamp INTEGER,
+            close REAL,
+            PRIMARY KEY (venue, asset, timestamp)
+        ) WITHOUT ROWID
+    ''')
+
+
+def collect_candles(venues, assets, since, until=None, timeframe=VENUE_TIMEFRAME):
+    """
+    Загружает свечи активов со всех площадок одновременно: у каждой площадки свой
+    клиент и бюджет запросов, поэтому медленная биржа не задерживает остальные.
+    since - мс или {(площадка, актив): мс}. Возвращает {(площадка, актив): ohlcv};
+    площадка, загрузка с которой не удалась, пропускается.
+    """
+    def fetch_venue(venue):
+        _, scheduler = get_client(venue)
+        jobs = [
+            fetcher.FetchJob(
+                (venue.name, asset), venue.symbol(asset), timeframe,
+                since[(venue.name, asset)] if isinstance(since, dict) else since, until
+            )
+            for asset in assets
+        ]
+        return scheduler.fetch(jobs)
+
+    candles = {}
+    with ThreadPoolExecutor(max_workers=max(len(venues), 1)) as pool:
+        futures = [(venue, pool.submit(fetch_venue, venue)) for venue in venues]
+        for venue, future in futures:
+            try:
+                candles.update(future.result())
+            except Exception as e:
+                logger.error(f"Ошибка загрузки свечей площадки {venue.name}: {e}")
+    return candles
+
+
+@instrumentation.timed()
+def sync_venue_candles(venues=None, assets=None):
+    """Догружает свечи площадок в venue_candles и обрезает таблицу по окну хранения"""
+    venues = venues or get_venues()
+    assets = assets or pairs.get_assets()
+    now_ms = int(time.time() * 1000)
+    window_start = now_ms - VENUE_WINDOW_HOURS * 3600 * 1000
+    overlap_ms = VENUE_OVERLAP_CANDLES * RecordedExchange.parse_timeframe(VENUE_TIMEFRAME) * 1000
+
+    with storage.connection() as conn:
+        ensure_venue_table(conn)
+        last = {
+            (venue, asset): timestamp
+            for venue, asset, timestamp in conn.execute(
+                "SELECT venue, asset, MAX(timestamp) FROM venue_candles GROUP BY venue, asset"
+            )
+        }
+    since = {
+        (venue.name, asset): max(last.get((venue.name, asset), window_start) - overlap_ms, window_start)
+        for venue in venues for asset in assets
+    }
+    candles = collect_candles(venues, assets, since)
+
+    rows = [
+        (venue, asset, int(candle[0]), float(candle[4]))
+        for (venue, asset), ohlcv in candles.items() for candle in ohlcv
+    ]
+    with storage.connection() as conn, conn:
+        ensure_venue_table(conn)
+        conn.executemany(
+            "INSERT INTO venue_candles (venue, asset, timestamp, close) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(venue, asset, timestamp) DO UPDATE SET close = excluded.close",
+            rows
+        )
+        conn.execute("DELETE FROM venue_candles WHERE timestamp < ?", (window_start,))
+    logger.info(f"Свечи площадок сохранены: {len(rows)} строк")
+    return len(rows)
+
+
+def read_venue_closes(conn, venues, asset):
+    """Ряды цен закрытия актива по площадкам: {площадка: (timestamps, closes)}"""
+    ensure_venue_table(conn)
+    series = {}
+    for venue in venues:
+        rows = conn.execute(
+            "SELECT timestamp, close FROM venue_candles WHERE venue = ? AND asset = ? ORDER BY timestamp",
+            (venue.name, asset)
+        ).fetchall()
+        values = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        series[venue.name] = (values[:, 0].astype(np.int64), values[:, 1])
+    return series
+
+
+def align_closes(series):
+    """
+    Выравнивание рядов площадок по времени: общая ось - объединение отметок всех
+    рядов, цены - матрица [время, площадка]; свеча, которой нет на площадке, - NaN.
+    """
+    times = np.unique(np.concatenate([timestamps for timestamps, _ in series.values()] or [np.empty(0, np.int64)]))
+    prices = np.full((len(times), len(series)), np.nan)
+    for k, (timestamps, closes) in enumerate(series.values()):
+        prices[np.searchsorted(times, timestamps), k] = closes
+    return times, prices
+
+
+def spread_matrix(prices):
+    """
+    Межплощадочный базис в процентах для каждой свечи: spread[t, i, j] =
+    (цена на i / цена на j - 1) * 100. Одна операция над массивом [время, i, j].
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (prices[:, :, None] / prices[:, None, :] - 1) * 100
+
+
+def venue_spreads(conn, asset, venues=None):
+    """
+    Ответ /api/venue-spreads по активу: ось time (с), цены по площадкам, матрица
+    базиса на последней свече, где актив есть на всех площадках, и ряды базиса
+    каждой пары площадок 'i/j'.
+    """
+    venues = venues or get_venues()
+    times, prices = align_closes(read_venue_closes(conn, venues, asset))
+    spreads = spread_matrix(prices)
+    names = [venue.name for venue in venues]
+
+    complete = np.flatnonzero(~np.isnan(prices).any(axis=1))
+    latest = spreads[complete[-1]] if len(complete) else np.full((len(names), len(names)), np.nan)
+    upper_i, upper_j = np.triu_indices(len(names), k=1)
+    return {
+        'asset': asset,
+        'venues': names,
+        'time': (times // 1000).tolist(),
+        'prices': dict(zip(names, _nullable(prices.T))),
+        'latest_time': int(times[complete[-1]] // 1000) if len(complete) else None,
+        'matrix': _nullable(latest),
+        'basis': dict(zip(
+            (f"{names[i]}/{names[j]}" for i, j in zip(upper_i, upper_j)),
+            _nullable(spreads[:, upper_i, upper_j].T)
+        )),
+    }
+
+
+def _nullable(matrix):
+    """Строки матрицы списками Python, NaN -> None (null в JSON)"""
+    values = matrix.astype(object)
+    values[np.isnan(matrix)] = None
+    return values.tolist()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Свечи площадок и межплощадочный базис")
+    parser.add_argument('--record', metavar='DIR', help="Записать свечи площадок в DIR для VENUE_RECORDINGS")
+    parser.add_argument('--hours', type=float, default=VENUE_WINDOW_HOURS, help="Глубина записи, часы")
+    args = parser.parse_args(argv)
+
+    venues = get_venues()
+    if args.record:
+        Path(args.record).mkdir(parents=True, exist_ok=True)
+        since = int((time.time() - args.hours * 3600) * 1000)
+        for venue in venues:
+            exchange, _ = get_client(venue)
+            symbols = [venue.symbol(asset) for asset in pairs.get_assets()]
+            record_ohlcv(exchange, symbols, VENUE_TIMEFRAME, since, Path(args.record) / f"{venue.name}.json")
+        return
+
+    sync_venue_candles(venues)
+    with storage.connection() as conn:
+        for asset in pairs.get_assets():
+            spreads = venue_spreads(conn, asset, venues)
+            logger.info(f"{asset}: базис на {spreads['latest_time']}: {spreads['matrix']}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,93 @@
+import json
+import struct
+
+import numpy as np
+
+from data_processor import LEGACY_SERIES_KEYS, SERIES_FIELDS
+
+# Двоичный формат колоночного ответа /api/processed-data (?format=bin или
+# Accept: application/octet-stream). Все числа little-endian:
+#   преамбула: магия SPRB, версия (uint8), 3 байта выравнивания, длина заголовка (uint32);
+#   заголовок: JSON со скалярами ответа и описанием колонок, дополненный пробелами
+#   до границы 8 байт;
+#   колонки подряд, каждая с границы 8 байт: сначала общая ось time (int64, секунды),
+#   затем ряды в порядке заголовка (float64 или float32, null -> NaN).
+CONTENT_TYPE = 'application/octet-stream'
+MAGIC = b'SPRB'
+VERSION = 1
+PREAMBLE = struct.Struct('<4sB3xI')
+ALIGNMENT = 8
+
+# Цены нужны с полной точностью, производным рядам хватает float32
+FLOAT64_FIELDS = frozenset({'base', 'quote', 'base_as_quote', 'btc', 'eth', 'btc_as_eth'})
+
+
+def _pad(size):
+    return -size % ALIGNMENT
+
+
+def _column(values, key):
+    # None (null в JSON) становится NaN
+    dtype = '<f8' if key in FLOAT64_FIELDS else '<f4'
+    return np.array(values, dtype=np.float64).astype(dtype, copy=False)
+
+
+def encode_columnar(result):
+    """
+    Колоночный ответ или дельту (словарь build_result/build_delta) в байты двоичного
+    формата. Ряды, совпадающие по длине с осью time, передаются колонками,
+    остальные поля - в JSON-заголовке.
+    """
+    time = np.asarray(result['time'], dtype='<i8')
+    columns = []  # (пара или None для основной, ключ, массив)
+    fields = {}
+    for key, value in result.items():
+        if key in LEGACY_SERIES_KEYS:
+            columns.append((None, key, _column(value, key)))
+        elif key not in ('time', 'pairs'):
+            fields[key] = value
+
+    pair_fields = {}
+    for name, entry in result.get('pairs', {}).items():
+        pair_fields[name] = {}
+        for key, value in entry.items():
+            if key in SERIES_FIELDS:
+                columns.append((name, key, _column(value, key)))
+            elif key != 'time':
+                pair_fields[name][key] = value
+
+    header = json.dumps({
+        'length': len(time),
+        'fields': fields,
+        'pairs': pair_fields,
+        'columns': [[pair, key, array.dtype.str[1:]] for pair, key, array in columns],
+    }).encode()
+    header += b' ' * _pad(PREAMBLE.size + len(header))
+
+    parts = [PREAMBLE.pack(MAGIC, VERSION, len(header)), header, time.tobytes()]
+    for _, _, array in columns:
+        data = array.tobytes()
+        parts.append(data + b'\0' * _pad(len(data)))
+    return b''.join(parts)
+
+
+def decode_columnar(body):
+    """Обратное преобразование encode_columnar (NaN остаются NaN) - для проверок и клиентов на Python"""
+    magic, version, header_length = PREAMBLE.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Неизвестный двоичный формат: {magic!r} v{version}")
+    offset = PREAMBLE.size
+    header = json.loads(bytes(body[offset:offset + header_length]))
+    offset += header_length
+    length = header['length']
+
+    result = dict(header['fields'])
+    result['time'] = np.frombuffer(body, '<i8', length, offset).tolist()
+    offset += 8 * length
+    result['pairs'] = {name: {**fields, 'time': result['time']} for name, fields in header['pairs'].items()}
+    for pair, key, dtype in header['columns']:
+        array = np.frombuffer(body, f'<{dtype}', length, offset)
+        offset += array.nbytes + _pad(array.nbytes)
+        target = result if pair is None else result['pairs'][pair]
+        target[key] = array.astype(np.float64).tolist()
+    return result